@@ -0,0 +1,64 @@
+#app_admit.py
+import math
+import threading
+
+
+class Admission(object):
+    """ Admission control in source tokens.
+
+    A request is admitted only if the source tokens of all admitted, unfinished requests stay within
+    `max_tokens`; otherwise it is rejected at once instead of queueing behind work the instance
+    cannot finish in time. A request larger than the whole budget is admitted when nothing else runs.
+    """
+    def __init__(self, max_tokens=4000, sec_per_token=0.02):
+        """
+        @param max_tokens (int): source tokens allowed in flight
+        @param sec_per_token (float): initial estimate of the decoding time per token, used for Retry-After
+        """
+        self.max_tokens = max_tokens
+        self.sec_per_token = sec_per_token
+        self.tokens = 0     # source tokens in flight
+        self.requests = 0   # requests in flight
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def acquire(self, tokens):
+        """ Try to admit a request of `tokens` source tokens.
+        @returns ok (bool): False if the request must be rejected
+        """
+        with self.lock:
+            if self.requests > 0 and self.tokens + tokens > self.max_tokens:
+                self.rejected += 1
+                return False
+            self.tokens += tokens
+            self.requests += 1
+            self.admitted += 1
+            return True
+
+    def release(self, tokens, elapsed=None):
+        """ Give back the budget of a finished request.
+        @param elapsed (float): seconds the request took, to refine the per-token estimate
+        """
+        with self.lock:
+            self.tokens -= tokens
+            self.requests -= 1
+            if elapsed is not None and tokens > 0:
+                self.sec_per_token = 0.9 * self.sec_per_token + 0.1 * elapsed / tokens
+
+    def timed_out(self):
+        """ Count a request that missed its deadline.
+        """
+        with self.lock:
+            self.timeouts += 1
+
+    def retry_after(self):
+        """ Seconds until the tokens in flight are likely drained, for the Retry-After header.
+        """
+        return min(max(int(math.ceil(self.tokens * self.sec_per_token)), 1), 60)
+
+    def stats(self):
+        return {'tokens': self.tokens, 'max_tokens': self.max_tokens, 'requests': self.requests,
+                'admitted': self.admitted, 'rejected': self.rejected, 'timeouts': self.timeouts,
+                'sec_per_token': self.sec_per_token}
@@ -0,0 +1,150 @@
+#app_batch.py
+from concurrent.futures import Future
+import threading
+import time
+
+
+class BatchScheduler(object):
+    """ Collects preprocessed sentences from concurrent requests and decodes them together.
+
+    Sentences are grouped by target language and by source length (bucket of `bucket` tokens),
+    so one batch never mixes directions and holds little padding. A group is flushed as soon as it
+    has `max_batch` sentences or its oldest sentence has waited `max_wait` seconds.
+    """
+    def __init__(self, translate, max_batch=16, max_wait=0.005, bucket=8, threads=1, profiler=None):
+        """
+        @param translate (callable): translate(sents, tlang, **opts) -> list of outputs, one per sentence
+        @param max_batch (int): maximum number of sentences decoded together
+        @param max_wait (float): maximum time in seconds a sentence waits for companions
+        @param bucket (int): width of the source length buckets, in tokens
+        @param threads (int): number of decoding threads
+        @param profiler (app_prof.Profiler): runs the batches holding sentences of a profiled request
+        """
+        self.fn = translate
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.bucket = bucket
+        self.profiler = profiler
+        self.groups = {}    # (tlang, opts, bucket) -> [(sent, future, time queued, deadline, profile timings)]
+        self.cond = threading.Condition()
+        self.batches = 0
+        self.sents = 0
+        self.workers = [threading.Thread(target=self.run, daemon=True) for i in range(threads)]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, sents, tlang, deadline=None, profile_timings=None, **opts):
+        """ Queue sentences for decoding.
+        @param sents (List[List[str]]): preprocessed source sentences (tokens)
+        @param tlang (str): target language, 'ko' or 'en'
+        @param deadline (float): time.time() by which the sentences are needed; a batch is decoded with
+                the earliest deadline of its sentences, passed to translate as `deadline`
+        @param profile_timings (Dict): timings of a profiled request; the batches decoding these sentences run
+                under the profiler and its statistics are added here (see app_prof.Profiler.run), shared
+                with the other requests of the batch
+        @param opts: keyword arguments of translate; sentences with different opts are not batched together
+        @returns futures (List[Future]): one future per sentence
+        """
+        futures = []
+        now = time.time()
+        opts = tuple(sorted(opts.items()))
+        with self.cond:
+            for s in sents:
+                f = Future()
+                key = (tlang, opts, len(s) // self.bucket)
+                self.groups.setdefault(key, []).append((s, f, now, deadline, profile_timings))
+                futures.append(f)
+            self.cond.notify_all()
+        return futures
+
+    def submit_group(self, sents, tlang, deadline=None, profile_timings=None, **opts):
+        """ Like submit, but one future resolving to the list of outputs once all sentences are decoded.
+        """
+        group = Future()
+        futures = self.submit(sents, tlang, deadline=deadline, profile_timings=profile_timings, **opts)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(f):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            # a cancelled group takes no result; once running it can no longer be cancelled
+            if not group.set_running_or_notify_cancel():
+                return
+            try:
+                group.set_result([f.result() for f in futures])
+            except BaseException as e:
+                group.set_exception(e)
+
+        def cancel(group):
+            if group.cancelled():
+                for f in futures:
+                    f.cancel()
+
+        if len(futures) == 0:
+            group.set_result([])
+        for f in futures:
+            f.add_done_callback(done)
+        group.add_done_callback(cancel)
+        return group
+
+    def translate(self, sents, tlang):
+        """ Decode sentences through the shared queue and wait for the results.
+        """
+        return [f.result() for f in self.submit(sents, tlang)]
+
+    def pending(self):
+        """ Number of queued sentences.
+        """
+        with self.cond:
+            return sum([len(items) for items in self.groups.values()])
+
+    def next_batch(self):
+        """ Block until a group is due and pop it. Called with the lock held.
+        """
+        while True:
+            now = time.time()
+            wait = None
+            for key, items in self.groups.items():
+                if len(items) >= self.max_batch or now - items[0][2] >= self.max_wait:
+                    batch = items[:self.max_batch]
+                    if len(items) > self.max_batch:
+                        self.groups[key] = items[self.max_batch:]
+                    else:
+                        del self.groups[key]
+                    return key[0], key[1], batch
+                due = items[0][2] + self.max_wait - now
+                wait = due if wait is None else min(wait, due)
+            self.cond.wait(wait)
+
+    def run(self):
+        while True:
+            with self.cond:
+                tlang, opts, batch = self.next_batch()
+            # cancelled sentences are dropped before their deadlines can tighten the batch's
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            deadlines = [d for _, _, _, d, _ in batch if d is not None]
+            batch = [(s, f, p) for s, f, _, _, p in batch]
+            if len(batch) == 0:
+                continue
+            opts = dict(opts)
+            if len(deadlines) > 0:
+                opts['deadline'] = min(deadlines)
+            sinks = list(dict([(id(p), p) for _, _, p in batch if p is not None]).values())
+            try:
+                if self.profiler is not None and len(sinks) > 0:
+                    outs, stats = self.profiler.run(lambda: (self.fn([s for s, _, _ in batch], tlang, **opts), {}))
+                    for timings in sinks:
+                        for k, v in stats.items():
+                            timings[k] = timings.get(k, []) + v
+                else:
+                    outs = self.fn([s for s, _, _ in batch], tlang, **opts)
+                for (_, f, _), out in zip(batch, outs):
+                    f.set_result(out)
+            except Exception as e:
+                for _, f, _ in batch:
+                    f.set_exception(e)
+            self.batches += 1
+            self.sents += len(batch)
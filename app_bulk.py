@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+app_bulk.py: Offline bulk translation of a text file, one document per line
+Output goes to OUTPUT_DIR as JSONL shards; every finished shard gets a checkpoint file, so running
+the same command again after the job was killed skips the finished shards.
+
+Usage:
+    app_bulk.py [options] INPUT_FILE OUTPUT_DIR
+
+Options:
+    -h --help                               show this screen.
+    --tlang=<str>                           target language, 'ko', 'en' or 'auto' to detect it per line [default: auto]
+    --profile=<str>                         decoding profile: quality, balanced, fast or hybrid [default: quality]
+    --calibration=<file>                    gate of the hybrid profile, written by trns/bench.py calibrate
+    --workers=<int>                         number of worker processes, 0 for the plan of app_plan.py [default: 0]
+    --shard-size=<int>                      input lines per shard [default: 2000]
+    --model=<file>                          model path [default: trns/model_bi_1105]
+    --partition                             score only the target-language rows of the output projection
+    --early-stop                            stop beam search at source-relative lengths and once settled
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+
+from docopt import docopt
+
+from app_plan import load_plan, set_thread_env, set_threads
+
+# threads per worker of the plan in NMT_PLAN (see app_plan.py); set before torch is imported
+plan = load_plan(os.environ.get('NMT_PLAN'))
+set_thread_env(plan['pool']['threads'])
+
+from app_pool import TrnsPool
+from app_utils import preproc_num, post_proc, join_sents, split_units
+from trns.get_model import nmt_model
+from trns.preproc_En import Pre_en
+from trns.preproc_kor import preproc_ko2en
+from trns.trns_koren import Trns, load_calibration
+
+# set in main() before the workers are forked
+pre_en = pre_ko = trns = None
+
+
+def shard_path(out_dir, index, ext):
+    return os.path.join(out_dir, 'shard-{:06d}.{}'.format(index, ext))
+
+
+def read_shards(input_file, out_dir, shard_size):
+    """ Read the input lazily in shards of shard_size lines, skipping the shards already checkpointed.
+    @returns shards (Iterator[Tuple[int, int, List[str]]]): shard index, line number of its first line, lines
+    """
+    lines = []
+    index = 0
+    with open(input_file) as f:
+        for n, line in enumerate(f):
+            lines.append(line.rstrip('\n'))
+            if len(lines) == shard_size:
+                if not os.path.exists(shard_path(out_dir, index, 'done')):
+                    yield index, n + 1 - len(lines), lines
+                lines = []
+                index += 1
+    if len(lines) > 0 and not os.path.exists(shard_path(out_dir, index, 'done')):
+        yield index, n + 1 - len(lines), lines
+
+
+def prep(X, tlang):
+    X = pre_en.forward(X) if tlang == 'ko' else pre_ko.forward(X)
+    X = preproc_num(X)
+    X = [s.split(' ') for s in X if s.strip() !="''"]
+    return X
+
+
+def translate_shard(job):
+    """ Translate the lines of a shard and write it with its checkpoint. Runs in a worker.
+    All sentences of a direction in the shard are decoded together, Trns sorts them by length.
+    @param job (Tuple): shard index, first line number, lines, tlang ('auto' to detect), profile, output directory
+    @returns stats (Dict): counts and time of the shard
+    """
+    index, first, lines, tlang, profile, out_dir = job
+    start = time.time()
+
+    docs = []    # (tlang, source sentences, preprocessed source sentences) per line
+    for line in lines:
+        tl, XX = split_units(line) if line.strip() != '' else ('ko', [])
+        tl = tl if tlang == 'auto' else tlang
+        docs.append((tl, XX, [prep([x], tl) for x in XX]))
+
+    outs = {}
+    for tl in ['ko', 'en']:
+        sents = list(chain(*[chain(*units) for t, _, units in docs if t == tl]))
+        outs[tl] = trns.translate(sents, tl, profile=profile) if len(sents) > 0 else []
+
+    tmp = shard_path(out_dir, index, 'jsonl.tmp')
+    tokens = 0
+    sentences = 0
+    with open(tmp, 'w') as f:
+        for n, (line, (tl, XX, units)) in enumerate(zip(lines, docs)):
+            Y = []
+            for x in units:
+                Y.append(post_proc(outs[tl][:len(x)], tl))
+                outs[tl] = outs[tl][len(x):]
+            f.write(json.dumps({'line': first + n, 'tlang': tl, 'src': line, 'tgt': join_sents(Y)},
+                               ensure_ascii=False) + '\n')
+            tokens += len(line.split())
+            sentences += len(XX)
+    os.rename(tmp, shard_path(out_dir, index, 'jsonl'))
+
+    stats = {'shard': index, 'first_line': first, 'lines': len(lines), 'sentences': sentences, 'tokens': tokens,
+             'seconds': time.time() - start}
+    with open(shard_path(out_dir, index, 'done'), 'w') as f:
+        json.dump(stats, f)
+    return stats
+
+
+def main():
+    global pre_en, pre_ko, trns
+    args = docopt(__doc__)
+    out_dir = args['OUTPUT_DIR']
+    workers = int(args['--workers']) or plan['pool']['workers']
+    os.makedirs(out_dir, exist_ok=True)
+    if args['--calibration']:
+        load_calibration(args['--calibration'])
+
+    pre_en = Pre_en()
+    pre_ko = preproc_ko2en()
+    trns = Trns(nmt_model(args['--model']))
+    trns.model.partition_output = args['--partition']
+    trns.model.early_stop = args['--early-stop']
+    pool = TrnsPool(size=workers, initializer=set_threads, initargs=(plan['pool']['threads'],))
+
+    start = time.time()
+    lines = sentences = tokens = 0
+    pending = set()
+    shards = {}     # future -> shard index
+    failed = []
+
+    def report(done):
+        nonlocal lines, sentences, tokens
+        for f in done:
+            try:
+                stats = f.result()
+            except BrokenProcessPool:
+                # a worker died; the shard has no checkpoint and is translated by the next run
+                failed.append(shards[f])
+                continue
+            lines += stats['lines']
+            sentences += stats['sentences']
+            tokens += stats['tokens']
+        elapsed = time.time() - start
+        print('{} lines, {} sentences: {:.2f} sents/s, {:.2f} tokens/s'.format(
+            lines, sentences, sentences / elapsed, tokens / elapsed), file=sys.stderr)
+
+    # at most two shards per worker are in memory
+    for index, first, shard in read_shards(args['INPUT_FILE'], out_dir, int(args['--shard-size'])):
+        if len(pending) >= 2 * workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            report(done)
+        f = pool.submit(translate_shard, (index, first, shard, args['--tlang'], args['--profile'], out_dir))
+        shards[f] = index
+        pending.add(f)
+    if len(pending) > 0:
+        report(wait(pending)[0])
+    pool.close()
+    if len(failed) > 0:
+        print('shards {} failed: a worker died, run the same command again to translate them'.format(
+            ', '.join([str(i) for i in sorted(failed)])), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
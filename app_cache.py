@@ -0,0 +1,75 @@
+#app_cache.py
+from collections import OrderedDict
+import threading
+import time
+
+
+def norm_key(X, tlang):
+    """ Cache key of a source sentence: direction plus the sentence with whitespace collapsed.
+    """
+    return tlang + '\t' + ' '.join(X.split())
+
+
+class TranslationCache(object):
+    """ Bounded LRU cache from (source sentence, direction) to the post-processed translation.
+
+    The size limit is in bytes of utf-8 text plus a fixed per-entry overhead. Entries older than
+    `ttl` seconds are treated as misses and dropped.
+    """
+    overhead = 200
+
+    def __init__(self, max_bytes=64*2**20, ttl=None):
+        """
+        @param max_bytes (int): size limit of the cache
+        @param ttl (float): lifetime of an entry in seconds, None to keep entries until evicted
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.data = OrderedDict()    # key -> (translation, size, expiry time)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, X, tlang):
+        """ Look up the translation of X, or None.
+        """
+        key = norm_key(X, tlang)
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self.drop(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, X, tlang, Y):
+        """ Store the translation Y of X, evicting the least recently used entries when full.
+        """
+        key = norm_key(X, tlang)
+        size = len(key.encode('utf-8')) + len(Y.encode('utf-8')) + self.overhead
+        if size > self.max_bytes:
+            return
+        expiry = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            if key in self.data:
+                self.drop(key)
+            self.data[key] = (Y, size, expiry)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.data)))
+                self.evictions += 1
+
+    def drop(self, key):
+        self.size -= self.data.pop(key)[1]
+
+    def stats(self):
+        return {'entries': len(self.data), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expired': self.expired}
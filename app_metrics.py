@@ -0,0 +1,72 @@
+#app_metrics.py
+import threading
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+class Metrics(object):
+    """ In-process counters and histograms, rendered in the Prometheus text format.
+    A metric is declared once with `describe` and then updated with label values, e.g.
+    metrics.observe('nmt_stage_seconds', 0.12, stage='decode', direction='en-ko').
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.kinds = {}     # name -> (kind, doc)
+        self.values = {}    # name -> {labels: counter value, or [bucket counts, sum, count]}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, doc):
+        """
+        @param kind (str): 'counter' or 'histogram'
+        """
+        self.kinds[name] = (kind, doc)
+        self.values[name] = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            h = self.values[name].get(key)
+            if h is None:
+                h = self.values[name][key] = [[0] * len(self.buckets), 0., 0]
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for name, (kind, doc) in sorted(self.kinds.items()):
+                lines.append('# HELP {} {}'.format(name, doc))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for key, v in sorted(self.values[name].items()):
+                    if kind == 'counter':
+                        lines.append('{}{} {}'.format(name, labels(key), v))
+                        continue
+                    for le, n in zip(self.buckets, v[0]):
+                        lines.append('{}_bucket{} {}'.format(name, labels(key + (('le', repr(le)),)), n))
+                    lines.append('{}_bucket{} {}'.format(name, labels(key + (('le', '+Inf'),)), v[2]))
+                    lines.append('{}_sum{} {}'.format(name, labels(key), v[1]))
+                    lines.append('{}_count{} {}'.format(name, labels(key), v[2]))
+        return '\n'.join(lines) + '\n'
+
+
+def labels(key):
+    if len(key) == 0:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(k, v) for k, v in key]) + '}'
+
+
+def server_timing(timings):
+    """ Server-Timing header value of a per-request timing breakdown (seconds, shown in ms).
+    """
+    return ', '.join(['{};dur={:.1f}'.format(k, v * 1000) for k, v in timings.items() if isinstance(v, float)])
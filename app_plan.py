@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+app_plan.py: Worker processes x intra-op threads for the CPUs this server may use
+The CPUs are the affinity mask capped by the cgroup CPU quota. A plan gives the pool backend its number
+of workers and threads per worker, and the batch backend its threads. main.py reads the plan before
+torch is imported, since OpenMP and BLAS read their thread counts once at load time.
+
+Run as a script, it sweeps the configurations on sample sentences and saves the fastest to PLAN_FILE
+(point NMT_PLAN at it). A plan is only reused on a host with the same number of CPUs.
+
+Usage:
+    app_plan.py [options] SRC_FILE PLAN_FILE
+
+Options:
+    -h --help                               show this screen.
+    --model=<file>                          model path [default: trns/model_bi_1105]
+    --tlang=<str>                           target language [default: ko]
+    --profile=<str>                         decoding profile [default: quality]
+    --batch-size=<int>                      sentences per call of the batch backend [default: 16]
+    --limit=<int>                           number of sample sentences [default: 64]
+"""
+import json
+import math
+import os
+import sys
+import time
+
+# thread counts of the OpenMP and BLAS libraries torch may load
+THREAD_ENV = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+def cgroup_quota():
+    """ CPU quota of the cgroup (v2, then v1) in CPUs, None without a limit.
+    """
+    try:
+        quota, period = open('/sys/fs/cgroup/cpu.max').read().split()
+        return None if quota == 'max' else int(quota) / int(period)
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        quota = int(open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us').read())
+        period = int(open('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read())
+        return None if quota <= 0 else quota / period
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    quota = cgroup_quota()
+    if quota is not None:
+        cpus = min(cpus, max(int(math.ceil(quota)), 1))
+    return cpus
+
+
+def default_plan(cpus):
+    """ No more busy threads than CPUs: one single-threaded worker per CPU (a request decodes a few
+    sentences, which parallelize better over processes than inside a step), all CPUs for the batch backend.
+    """
+    return {'cpus': cpus, 'pool': {'workers': cpus, 'threads': 1}, 'batch': {'threads': cpus}}
+
+
+def load_plan(file_path=None):
+    """ The plan saved in file_path if it was made for as many CPUs as are available now, else default_plan.
+    """
+    cpus = available_cpus()
+    if file_path and os.path.exists(file_path):
+        plan = json.load(open(file_path))
+        if plan.get('cpus') == cpus:
+            return plan
+        print('plan {} was made for {} CPUs, {} available: not used'.format(file_path, plan.get('cpus'), cpus),
+              file=sys.stderr)
+    return default_plan(cpus)
+
+
+def set_thread_env(threads):
+    """ Thread counts of OpenMP and BLAS; only effective before torch is imported. Values already set
+    in the environment are kept.
+    """
+    for name in THREAD_ENV:
+        os.environ.setdefault(name, str(threads))
+
+
+def set_threads(threads):
+    """ Pool worker initializer: intra-op threads of torch in this process.
+    """
+    import torch
+    torch.set_num_threads(threads)
+
+
+_trns = None    # set before the sweep forks its workers
+
+
+def translate_one(args):
+    src_sent, tlang, profile = args
+    return _trns.translate([src_sent], tlang, profile=profile)
+
+
+def configurations(cpus):
+    """ (workers, threads) pairs with at most one busy thread per CPU.
+    """
+    return [(w, t) for w in range(1, cpus + 1) for t in range(1, cpus // w + 1)]
+
+
+def main():
+    from docopt import docopt
+
+    global _trns
+    args = docopt(__doc__)
+    cpus = available_cpus()
+    set_thread_env(1)
+
+    from app_pool import TrnsPool
+    from trns.get_model import nmt_model
+    from trns.trns_koren import Trns
+    from trns.utils import read_corpus
+
+    model = nmt_model(args['--model'])
+    _trns = Trns(model, batch_size=int(args['--batch-size']))
+    src_sents = read_corpus(args['SRC_FILE'], source='src')[:int(args['--limit'])]
+    tlang, profile = args['--tlang'], args['--profile']
+    batch_size = int(args['--batch-size'])
+    plan = default_plan(cpus)
+
+    best = 0.
+    for workers, threads in configurations(cpus):
+        pool = TrnsPool(size=workers, chunksize=1, initializer=set_threads, initargs=(threads,))
+        pool.warmup()
+        start = time.time()
+        pool.map(translate_one, [(s, tlang, profile) for s in src_sents])
+        rate = len(src_sents) / (time.time() - start)
+        pool.close()
+        print('pool  : {:2d} workers x {:2d} threads: {:8.2f} sents/s'.format(workers, threads, rate), file=sys.stderr)
+        if rate > best:
+            best = rate
+            plan['pool'] = {'workers': workers, 'threads': threads}
+
+    best = 0.
+    for threads in range(1, cpus + 1):
+        set_threads(threads)
+        start = time.time()
+        for i in range(0, len(src_sents), batch_size):
+            _trns.translate(src_sents[i:i+batch_size], tlang, profile=profile)
+        rate = len(src_sents) / (time.time() - start)
+        print('batch : {:2d} threads: {:8.2f} sents/s'.format(threads, rate), file=sys.stderr)
+        if rate > best:
+            best = rate
+            plan['batch'] = {'threads': threads}
+
+    json.dump(plan, open(args['PLAN_FILE'], 'w'))
+    print('{} CPUs: pool {} workers x {} threads, batch {} threads, saved to {}'.format(
+        cpus, plan['pool']['workers'], plan['pool']['threads'], plan['batch']['threads'], args['PLAN_FILE']),
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
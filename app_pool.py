@@ -0,0 +1,90 @@
+#app_pool.py
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import time
+
+
+class TrnsPool(object):
+    """ Long-lived pool of translation workers.
+
+    Workers are forked from the process that loaded the model, so `pre_en`, `pre_ko` and `trns`
+    are shared copy-on-write instead of being pickled per request. If a worker dies the pool is
+    rebuilt; an interrupted map is retried once, a submitted call fails with BrokenProcessPool.
+    """
+    def __init__(self, size=2, chunksize=1, initializer=None, initargs=()):
+        """
+        @param size (int): number of worker processes
+        @param chunksize (int): number of items sent to a worker in one round trip
+        @param initializer (callable): run once in every new worker
+        @param initargs (tuple): arguments of initializer
+        """
+        self.size = size
+        self.chunksize = chunksize
+        self.initializer = initializer
+        self.initargs = initargs
+        self.restarts = 0
+        self.lock = threading.Lock()
+        self.executor = self.new_executor()
+
+    def new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.size, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=self.initializer, initargs=self.initargs)
+
+    def restart(self, broken):
+        """ Replace a broken executor. Concurrent callers that saw the same failure restart it only once.
+        """
+        with self.lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False)
+                self.executor = self.new_executor()
+                self.restarts += 1
+
+    def warmup(self):
+        """ Fork all workers now rather than on the first request.
+        """
+        list(self.map(abs, range(self.size), chunksize=1))
+
+    def map(self, fn, items, chunksize=None, deadline=None):
+        """ Run fn over items in the workers and return the results in order.
+        @param fn (callable): module level function (it is pickled by reference)
+        @param items (list): arguments, one per call
+        @param chunksize (int): overrides the pool's default chunk size
+        @param deadline (float): time.time() by which all results are needed; past it, calls not yet
+            started are cancelled and concurrent.futures.TimeoutError is raised
+        @returns results (list)
+        """
+        items = list(items)
+        chunksize = chunksize or self.chunksize
+        for retry in range(2):
+            executor = self.executor
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                return list(executor.map(fn, items, chunksize=chunksize, timeout=timeout))
+            except BrokenProcessPool:
+                self.restart(executor)
+                if retry > 0:
+                    raise
+
+    def submit(self, fn, *args):
+        """ Submit a single call. It is not retried: if a worker dies its future fails with
+        BrokenProcessPool, and the pool is rebuilt for the next calls.
+        """
+        executor = self.executor
+        try:
+            f = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.restart(executor)
+            executor = self.executor
+            f = executor.submit(fn, *args)
+
+        def check(f):
+            if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+                self.restart(executor)
+
+        f.add_done_callback(check)
+        return f
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,140 @@
+#app_prof.py
+import cProfile
+import glob
+import json
+import os
+import pstats
+import random
+import re
+import time
+
+import torch
+
+
+class Profiler(object):
+    """ Profiles a random fraction of requests with cProfile, and with torch.autograd.profiler around
+    the model calls.
+
+    Work done in pool workers, or in the batch scheduler's threads, is profiled there with `run`; the
+    request thread is profiled with `profile_request`, which merges the workers' statistics into one
+    profile per request. Every profile is written to `directory` as <name>.prof (pstats),
+    <name>.torch.txt (torch operator table) and <name>.json (request size, direction, time); only the
+    newest `keep` are kept.
+    """
+    name_re = re.compile('^[0-9]{8}-[0-9]{6}-[0-9]+-[0-9]+$')
+
+    def __init__(self, directory, rate, keep=50, torch_profile=True):
+        """
+        @param directory (str): where profiles are written, created if missing
+        @param rate (float): fraction of requests to profile
+        @param keep (int): number of profiles kept
+        @param torch_profile (bool): also run torch.autograd.profiler around the model calls
+        """
+        self.directory = directory
+        self.rate = rate
+        self.keep = keep
+        self.torch_profile = torch_profile
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def sample(self):
+        """ Whether to profile the current request.
+        """
+        return random.random() < self.rate
+
+    def run(self, fn, *args, **kwargs):
+        """ Call fn, which returns (result, timings), under the profilers. The statistics go to
+        timings['profile'] and timings['torch_profile'] for `profile_request` to collect.
+        """
+        pr = cProfile.Profile()
+        pr.enable()
+        try:
+            if self.torch_profile:
+                with torch.autograd.profiler.profile() as tp:
+                    result, timings = fn(*args, **kwargs)
+            else:
+                result, timings = fn(*args, **kwargs)
+        finally:
+            pr.disable()
+        timings['profile'] = timings.get('profile', []) + [pstats.Stats(pr).stats]
+        if self.torch_profile:
+            try:
+                table = tp.key_averages().table(sort_by='self_cpu_time_total', row_limit=40)
+            except (AttributeError, TypeError):     # torch 1.0: no self time, no row limit
+                table = tp.key_averages().table(sort_by='cpu_time_total')
+            timings['torch_profile'] = timings.get('torch_profile', []) + [table]
+        return result, timings
+
+    def profile_request(self, meta, timings, fn, *args, **kwargs):
+        """ Call fn in this thread under cProfile and write the profile of the request, merged with
+        the statistics the workers left in timings.
+        @param meta (Dict): request description stored with the profile
+        @param timings (Dict): timings dict fn fills in; the profiling entries are removed from it
+        @returns result: what fn returns
+        """
+        pr = cProfile.Profile()
+        start = time.time()
+        pr.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            pr.disable()
+            meta = dict(meta, seconds=time.time() - start, pid=os.getpid(), created=start)
+            self.save(meta, [pstats.Stats(pr).stats] + timings.pop('profile', []), timings.pop('torch_profile', []))
+
+    def save(self, meta, stats, tables):
+        self.count += 1
+        name = '{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid(), self.count)
+        st = pstats.Stats()
+        for d in stats:
+            s = pstats.Stats()
+            s.stats = d
+            s.get_top_level_stats()
+            st.add(s)
+        st.dump_stats(os.path.join(self.directory, name + '.prof'))
+        if len(tables) > 0:
+            with open(os.path.join(self.directory, name + '.torch.txt'), 'w') as f:
+                f.write('\n\n'.join(tables))
+        with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+            json.dump(dict(meta, name=name), f)
+        self.rotate()
+
+    def rotate(self):
+        for path in self.metas()[self.keep:]:
+            for p in glob.glob(path[:-len('.json')] + '.*'):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass    # removed by another worker
+
+    def metas(self):
+        """ Paths of the profile descriptions, newest first.
+        """
+        paths = []
+        for p in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                paths.append((os.path.getmtime(p), p))
+            except FileNotFoundError:
+                pass
+        return [p for _, p in sorted(paths, reverse=True)]
+
+    def list(self):
+        """ Descriptions of the kept profiles, newest first.
+        """
+        profiles = []
+        for path in self.metas():
+            try:
+                with open(path) as f:
+                    profiles.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                pass    # being rotated or written
+        return profiles
+
+    def path(self, name, kind):
+        """ File of a profile, or None if the name or kind is not valid.
+        @param kind (str): 'prof' or 'torch.txt'
+        """
+        if self.name_re.match(name) is None or kind not in ('prof', 'torch.txt'):
+            return None
+        path = os.path.join(self.directory, name + '.' + kind)
+        return path if os.path.exists(path) else None
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+app_tm.py: Persistent translation memory shared by all workers of main:app
+
+Usage:
+    app_tm.py export [options] TM_FILE OUTPUT_FILE
+    app_tm.py import [options] TM_FILE INPUT_FILE
+    app_tm.py purge [options] TM_FILE
+
+Options:
+    -h --help                               show this screen.
+    --model=<file>                          model path [default: trns/model_bi_1105]
+    --vocab=<file>                          vocab file [default: trns/vocab.json]
+    --decoding=<str>                        decoding configuration of the entries, ':' separated as in the
+                                            model version main.py logs at startup [default: ]
+    --any-version                           import / export entries of every model and vocab version
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from docopt import docopt
+
+from app_cache import norm_key
+
+
+def file_hash(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def decoding_config(partition_output=False, shortlist_files=(), quantized=False, early_stop=False):
+    """ Decoding settings that change translations besides the model and vocab, as parts of the model version.
+    @param partition_output (bool): NMT.partition_output
+    @param shortlist_files (List[str]): vocabulary shortlists (trns/shortlist.py)
+    @param quantized (bool): int8 model
+    @param early_stop (bool): NMT.early_stop
+    @returns decoding (List[str])
+    """
+    decoding = ['partition'] if partition_output else []
+    decoding += ['shortlist={}@{}'.format(os.path.basename(f), file_hash(f)) for f in shortlist_files]
+    if quantized:
+        decoding.append('int8')
+    if early_stop:
+        decoding.append('early_stop')
+    return decoding
+
+
+def model_version(model_path='trns/model_bi_1105', vocab_path='trns/vocab.json', decoding=()):
+    """ Version stamp of translations: model file name followed by the decoding configuration (see
+    decoding_config), and a hash of the vocabulary.
+    """
+    return ':'.join([os.path.basename(model_path)] + list(decoding)), file_hash(vocab_path)
+
+
+class TranslationMemory(object):
+    """ On-disk translation memory (SQLite in WAL mode) keyed by a hash of the normalized source
+    sentence and the direction. Every entry records the model and vocab version it was made with;
+    lookups only see entries of the current version.
+    """
+    def __init__(self, path, model, vocab, timeout=30.):
+        """
+        @param path (str): SQLite file, on local disk
+        @param model (str): model version
+        @param vocab (str): vocab hash
+        @param timeout (float): seconds to wait for a lock held by another worker
+        """
+        self.path = path
+        self.model = model
+        self.vocab = vocab
+        self.timeout = timeout
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        conn = self.conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute("""CREATE TABLE IF NOT EXISTS tm (
+                            hash TEXT NOT NULL,
+                            tlang TEXT NOT NULL,
+                            model TEXT NOT NULL,
+                            vocab TEXT NOT NULL,
+                            src TEXT NOT NULL,
+                            tgt TEXT NOT NULL,
+                            created REAL NOT NULL,
+                            PRIMARY KEY (hash, tlang, model, vocab))""")
+        conn.commit()
+
+    def conn(self):
+        """ sqlite3 connections cannot be shared between threads or forked processes.
+        """
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+            self.local.conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    @staticmethod
+    def hash(X, tlang):
+        return hashlib.sha1(norm_key(X, tlang).encode('utf-8')).hexdigest()
+
+    def get(self, X, tlang):
+        """ Look up the translation of X made by the current model, or None.
+        """
+        row = self.conn().execute('SELECT tgt FROM tm WHERE hash=? AND tlang=? AND model=? AND vocab=?',
+                                  (self.hash(X, tlang), tlang, self.model, self.vocab)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put_many(self, items, tlang):
+        """ Store translations in one transaction.
+        @param items (List[Tuple[str, str]]): (source sentence, translation) pairs
+        @param tlang (str): target language
+        """
+        now = time.time()
+        conn = self.conn()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO tm VALUES (?,?,?,?,?,?,?)',
+                             [(self.hash(X, tlang), tlang, self.model, self.vocab, X, Y, now) for X, Y in items])
+        self.writes += len(items)
+
+    def purge(self):
+        """ Delete the entries of other model or vocab versions.
+        @returns n (int): number of deleted entries
+        """
+        conn = self.conn()
+        with conn:
+            n = conn.execute('DELETE FROM tm WHERE model!=? OR vocab!=?', (self.model, self.vocab)).rowcount
+        return n
+
+    def export(self, f, any_version=False):
+        """ Write entries as JSON lines.
+        @returns n (int): number of exported entries
+        """
+        query = 'SELECT tlang, model, vocab, src, tgt, created FROM tm'
+        args = ()
+        if not any_version:
+            query += ' WHERE model=? AND vocab=?'
+            args = (self.model, self.vocab)
+        n = 0
+        for tlang, model, vocab, src, tgt, created in self.conn().execute(query, args):
+            f.write(json.dumps({'tlang': tlang, 'model': model, 'vocab': vocab, 'src': src, 'tgt': tgt,
+                                'created': created}, ensure_ascii=False) + '\n')
+            n += 1
+        return n
+
+    def load(self, f, any_version=False, chunk=10000):
+        """ Read entries written by `export`. Entries of other versions are skipped unless any_version.
+        @returns n (int): number of imported entries
+        """
+        conn = self.conn()
+        rows = []
+        n = 0
+        for line in f:
+            e = json.loads(line)
+            if not any_version and (e['model'] != self.model or e['vocab'] != self.vocab):
+                continue
+            rows.append((self.hash(e['src'], e['tlang']), e['tlang'], e['model'], e['vocab'], e['src'], e['tgt'],
+                         e['created']))
+            if len(rows) >= chunk:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO tm VALUES (?,?,?,?,?,?,?)', rows)
+                n += len(rows)
+                rows = []
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO tm VALUES (?,?,?,?,?,?,?)', rows)
+        return n + len(rows)
+
+    def stats(self):
+        return {'model': self.model, 'vocab': self.vocab, 'hits': self.hits, 'misses': self.misses,
+                'writes': self.writes}
+
+
+def main():
+    args = docopt(__doc__)
+    model, vocab = model_version(args['--model'], args['--vocab'], [d for d in args['--decoding'].split(':') if d != ''])
+    tm = TranslationMemory(args['TM_FILE'], model, vocab)
+
+    if args['export']:
+        with open(args['OUTPUT_FILE'], 'w') as f:
+            n = tm.export(f, any_version=args['--any-version'])
+        print('exported {} entries to {}'.format(n, args['OUTPUT_FILE']))
+    elif args['import']:
+        with open(args['INPUT_FILE']) as f:
+            n = tm.load(f, any_version=args['--any-version'])
+        print('imported {} entries from {}'.format(n, args['INPUT_FILE']))
+    elif args['purge']:
+        print('deleted {} entries of other versions'.format(tm.purge()))
+
+
+if __name__ == '__main__':
+    main()
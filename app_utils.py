@@ -225,4 +225,34 @@ def to_normal(sents):
         
     snts = p1.sub(' ',' '.join(snts)) 
     snts = q10.sub('\g<num4>,',z3.sub("'s ",z2.sub('\g<qt2> ',z1.sub(' \g<qt1>',snts))))   
-    return z4.sub('\n\n',p1.sub(' ',snts))
\ No newline at end of file
+    return z4.sub('\n\n',p1.sub(' ',snts))
+
+
+def detect_tlang(X):
+    """ Target language of X: 'ko' if X is mostly latin letters, else 'en'.
+    """
+    enko_count = sum([1 if ord(c) in range(65,123) else -1 for c in X])
+    
+    return 'ko' if enko_count > 0 else 'en'
+
+def split_units(X):
+    """ Detect the direction of X and split it into source sentences.
+    @returns tlang (str), XX (List[str])
+    """
+    tlang = detect_tlang(X)
+    
+    XX = to_start(X)
+    XX = 'Æ'.join(XX) #.split('Ë')
+    XX = XX.split('Æ') #or x in XX] 
+    return tlang, XX
+
+def post_proc(X, tlang):
+    """ Post-process the translations of one source sentence (to_normal for Korean, rid_blank for English).
+    """
+    return to_normal(X) if tlang == 'ko' else rid_blank(X)
+
+def join_sents(sents):
+    """ Join post-processed sentences into a document, keeping the paragraph breaks.
+    """
+    p = re.compile('\s*\n\n\s*')
+    return p.sub('\n\n',' '.join([s for s in sents if s.strip(' ') != ''])).strip()
@@ -1,67 +1,512 @@
 #app.py
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, stream_with_context, abort, send_file
 
 app = Flask(__name__)
 
-from app_utils import to_start, rid_blank, preproc_num, to_normal
+import os
+from app_plan import load_plan, set_thread_env, set_threads
+
+# 'pool' : each sentence is preprocessed and decoded in a worker process
+# 'batch' : sentences of concurrent requests are decoded together in this process
+backend = os.environ.get('NMT_BACKEND', 'pool')
+# workers x threads from the plan of app_plan.py in NMT_PLAN, or from the CPUs available; set before
+# torch is imported. NMT_POOL_SIZE / NMT_THREADS > 0 override the plan.
+plan = load_plan(os.environ.get('NMT_PLAN'))
+threads = int(os.environ.get('NMT_THREADS', 0)) or plan[backend if backend == 'batch' else 'pool']['threads']
+set_thread_env(threads)
+
+from app_utils import to_start, rid_blank, preproc_num, to_normal, post_proc, join_sents, split_units, detect_tlang
 from trns.get_model import trns_model
+from trns.trns_koren import DECODING_PROFILES, planned_decoding, load_calibration
 import random
 
-from multiprocessing import Pool
+from app_pool import TrnsPool
+from app_batch import BatchScheduler
+from app_cache import TranslationCache
+from app_tm import TranslationMemory, model_version, decoding_config
+from app_admit import Admission
+from app_metrics import Metrics, server_timing
+from app_prof import Profiler
+from concurrent.futures import as_completed, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from itertools import chain
+import json
+import sys
 import time
 
-pre_en, pre_ko, trns = trns_model()
+# NMT_SHORTLIST: comma separated lexical tables (trns/shortlist.py) to decode with vocabulary shortlists
+# NMT_QUANTIZE: decision of trns/bench.py quantize; the model is quantized to int8 if it was accepted
+# NMT_EOJEOL_CACHE: Korean eojeol kept segmented per worker, warm-started from NMT_EOJEOL_WARM (trns/preproc_kor.py)
+shortlist_files = [f for f in os.environ.get('NMT_SHORTLIST', '').split(',') if f != '']
+pre_en, pre_ko, trns = trns_model(shortlist_files,
+                                  os.environ.get('NMT_QUANTIZE') or None,
+                                  int(os.environ.get('NMT_EOJEOL_CACHE', 100000)),
+                                  os.environ.get('NMT_EOJEOL_WARM') or None)
+# NMT_PARTITION_OUTPUT=1 scores only the target-language rows of the output projection (NMT.partition_output)
+trns.model.partition_output = os.environ.get('NMT_PARTITION_OUTPUT', '0') == '1'
+# NMT_EARLY_STOP=1 limits beam search to source-relative lengths and stops it once settled (NMT.early_stop)
+trns.model.early_stop = os.environ.get('NMT_EARLY_STOP', '0') == '1'
+# NMT_HYBRID_CALIBRATION: gate of the 'hybrid' decoding profile, written by trns/bench.py calibrate
+if os.environ.get('NMT_HYBRID_CALIBRATION'):
+    load_calibration(os.environ['NMT_HYBRID_CALIBRATION'])
+
+set_threads(threads)
+
+metrics = Metrics()
+metrics.describe('nmt_stage_seconds', 'histogram', 'Time spent per request in each stage.')
+metrics.describe('nmt_requests_total', 'counter', 'Translation requests by endpoint.')
+metrics.describe('nmt_sentences_total', 'counter', 'Source sentences translated, cache hits included.')
+metrics.describe('nmt_tokens_total', 'counter', 'Source tokens (whitespace separated) of translated sentences.')
+metrics.describe('nmt_decode_steps_total', 'counter', 'Decoder time steps of beam search.')
+metrics.describe('nmt_eojeol_cache_total', 'counter', 'Korean eojeol segmentation cache lookups by result.')
 
-def mp(X):
-    X = pre_en.forward(X) #for x in X]
+# NMT_PROFILE_RATE > 0 profiles that fraction of requests into NMT_PROFILE_DIR (see /profiles)
+profile_rate = float(os.environ.get('NMT_PROFILE_RATE', 0))
+profiler = Profiler(os.environ.get('NMT_PROFILE_DIR', '/tmp/nmt_profiles'), profile_rate,
+                    keep=int(os.environ.get('NMT_PROFILE_KEEP', 50))) if profile_rate > 0 else None
+
+def add_timings(timings, t):
+    """ Add stage timings (or counts) of t to timings; profiling entries are lists and are concatenated.
+    """
+    for k, v in t.items():
+        timings[k] = timings[k] + v if k in timings else v
+
+def prep(X, tlang, timings=None):
+    cache = pre_ko.cache if tlang == 'en' else None
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    start = time.time()
+    X = pre_en.forward(X) if tlang == 'ko' else pre_ko.forward(X)
+    t = time.time()
     X = preproc_num(X) #for x in X]
     X = [s.split(' ') for s in X if s.strip() !="''"] #for x in X] #'"'
-    X = trns.translate(X,'ko') 
+    if timings is not None:
+        add_timings(timings, {'segment': t - start, 'preproc_num': time.time() - t})
+        if cache is not None:
+            add_timings(timings, {'eojeol_hit': cache.hits - hits, 'eojeol_miss': cache.misses - misses})
     return X
 
-def mpko(X):
-    X = pre_ko.forward(X) #for x in X]
-    X = preproc_num(X) #for x in X]
-    X = [s.split(' ') for s in X if s.strip() !="''"] #for x in X]
-    X = trns.translate(X,'en') 
-    return X
+def mp(X, deadline=None, profiled=False):
+    if profiled:
+        return profiler.run(mp, X, deadline)
+    timings = {}
+    X = prep(X, 'ko', timings)
+    start = time.time()
+    X = trns.translate(X,'ko', return_info=True, deadline=deadline, stats=timings) 
+    timings['decode'] = time.time() - start
+    return X, timings
 
-def nmt(X, to_start, pre_ko, pre_en, trns, Pool):
+def mpko(X, deadline=None, profiled=False):
+    if profiled:
+        return profiler.run(mpko, X, deadline)
+    timings = {}
+    X = prep(X, 'en', timings)
+    start = time.time()
+    X = trns.translate(X,'en', return_info=True, deadline=deadline, stats=timings) 
+    timings['decode'] = time.time() - start
+    return X, timings
 
-    enko_count = sum([1 if ord(c) in range(65,123) else -1 for c in X])
-    
-    XX = to_start(X)
-    XX = 'Æ'.join(XX) #.split('Ë')
-    
-    if enko_count > 0:
+def mp_api(job):
+    """ Pool worker of /api/translate.
+    @param job (Tuple[List[str], str, str, float, bool]): source sentences, target language, decoding profile,
+            deadline, whether to run under the profiler
+    @returns outs (List[List[Tuple[str, float, str]]]): (output, score, decoding) of every source sentence
+    @returns timings (Dict[str, float]): seconds spent per stage, and decode steps
+    """
+    XX, tlang, profile, deadline, profiled = job
+    if profiled:
+        return profiler.run(mp_api, (XX, tlang, profile, deadline, False))
+    timings = {}
+    XX = [prep([x], tlang, timings) for x in XX]
+    start = time.time()
+    Y = trns.translate(list(chain(*XX)), tlang, profile=profile, return_info=True, deadline=decode_deadline(deadline),
+                       stats=timings)
+    timings['decode'] = time.time() - start
+    outs = []
+    for x in XX:
+        outs.append(Y[:len(x)])
+        Y = Y[len(x):]
+    return outs, timings
 
-        XX = [[x] for x in XX.split('Æ')] #or x in XX] 
-        no_split = str(len(XX))
-        start = time.time()
-        
-        with Pool(2) as p:
-            X = p.map(mp, XX)
-
-        X = list(chain(*X))       
-        tt = time.time() - start       
-        X = to_normal(X) #for x in X]
-        Xout = X.strip() #for x in X]
-        
-    else:
-
-        XX = [[x] for x in XX.split('Æ')] #or x in XX]
+def decode_batch(sents, tlang, **opts):
+    """ Decoding function of the batch scheduler.
+    """
+    stats = {}
+    Y = trns.translate(sents, tlang, stats=stats, **opts)
+    metrics.inc('nmt_decode_steps_total', stats.get('steps', 0), direction=direction(tlang))
+    return Y
+
+def direction(tlang):
+    return {'ko': 'en-ko', 'en': 'ko-en'}.get(tlang, tlang)
+
+def record(timings, tlang, sents, tokens):
+    """ Add the timings and counts of a request to the metrics.
+    @param timings (Dict): seconds per stage; 'steps', 'batches', 'eojeol_hit' and 'eojeol_miss' are counts
+    @param tlang (str): target language, or 'all' for stages shared by both directions
+    """
+    for stage, v in timings.items():
+        if stage == 'steps':
+            metrics.inc('nmt_decode_steps_total', v, direction=direction(tlang))
+        elif stage in ('eojeol_hit', 'eojeol_miss'):
+            metrics.inc('nmt_eojeol_cache_total', v, result=stage[7:])
+        elif isinstance(v, float):
+            metrics.observe('nmt_stage_seconds', v, stage=stage, direction=direction(tlang))
+    if sents > 0:
+        metrics.inc('nmt_sentences_total', sents, direction=direction(tlang))
+        metrics.inc('nmt_tokens_total', tokens, direction=direction(tlang))
+
+if backend == 'batch':
+    pool = None
+    scheduler = BatchScheduler(decode_batch,
+                               max_batch=int(os.environ.get('NMT_BATCH_SIZE', 16)),
+                               max_wait=float(os.environ.get('NMT_BATCH_WAIT_MS', 5)) / 1000,
+                               profiler=profiler)
+else:
+    # workers are forked after the model is loaded and inherit it copy-on-write
+    pool = TrnsPool(size=int(os.environ.get('NMT_POOL_SIZE', 0)) or plan['pool']['workers'],
+                    chunksize=int(os.environ.get('NMT_POOL_CHUNKSIZE', 4)),
+                    initializer=set_threads, initargs=(threads,))
+    pool.warmup()
+    scheduler = None
+
+# NMT_CACHE_MB=0 turns the sentence cache off
+cache_mb = float(os.environ.get('NMT_CACHE_MB', 64))
+cache_ttl = float(os.environ.get('NMT_CACHE_TTL', 0))
+cache = TranslationCache(max_bytes=int(cache_mb * 2**20), ttl=cache_ttl or None) if cache_mb > 0 else None
+
+# /api/translate: maximum number of source sentences per call, source sentences per pool task
+api_max_sents = int(os.environ.get('NMT_API_MAX_SENTENCES', 5000))
+api_chunk = int(os.environ.get('NMT_API_CHUNK', 16))
+
+# source tokens in flight before new requests get 429; seconds a request may take at most
+# (clients can ask for less with an X-Request-Timeout header)
+admission = Admission(max_tokens=int(os.environ.get('NMT_MAX_TOKENS', 4000)))
+request_timeout = float(os.environ.get('NMT_REQUEST_TIMEOUT', 60))
+# decoding ends this many seconds before the request deadline and degrades (narrower beam, greedy
+# search, unfinished hypotheses) to make it, leaving time for post-processing
+decode_margin = float(os.environ.get('NMT_DECODE_MARGIN', 0.5))
+
+def decode_deadline(deadline):
+    return None if deadline is None else deadline - decode_margin
+
+# on-disk translation memory shared by all gunicorn workers, off unless NMT_TM_PATH is set
+tm_path = os.environ.get('NMT_TM_PATH', '')
+# entries decoded with another output mode, shortlist, int8 model or early stop are not served
+model_name, vocab_hash = model_version(decoding=decoding_config(trns.model.partition_output, shortlist_files,
+                                                                trns.model.quantized, trns.model.early_stop))
+tm = TranslationMemory(tm_path, model_name, vocab_hash) if tm_path else None
+if tm is not None:
+    print('translation memory {}, model version {} {}'.format(tm_path, model_name, vocab_hash), file=sys.stderr)
+
+def results(futures, deadline=None):
+    """ Wait for futures. Whatever is unfinished at the deadline, or when the caller gives up, is
+    cancelled; sentences still queued are then never decoded.
+    """
+    try:
+        return [f.result(timeout=None if deadline is None else max(deadline - time.time(), 0)) for f in futures]
+    finally:
+        for f in futures:
+            f.cancel()
+
+def translate_units(XX, tlang, deadline=None, timings=None, profiled=False):
+    """ Translate source sentences with the configured backend.
+    @param XX (List[str]): source sentences as split by to_start
+    @param tlang (str): target language
+    @param deadline (float): time.time() by which the translations are needed
+    @param timings (Dict): if given, the stage timings are added to it
+    @param profiled (bool): profile the decoding too, in the pool workers or in the scheduler batches
+            holding these sentences
+    @returns X (List[List[Tuple[str, float, str]]]): (output, score, decoding) of every source sentence
+    """
+    timings = {} if timings is None else timings
+    if scheduler is not None:
+        futures = submit_units(XX, tlang, deadline, timings, profiled)
         start = time.time()
-        with Pool(2) as p:
-            X = p.map(mpko, XX)
+        X = results(futures, deadline)
+        add_timings(timings, {'decode': time.time() - start})
+        return X
+    X = pool.map(partial(mp if tlang == 'ko' else mpko, deadline=decode_deadline(deadline), profiled=profiled),
+                 [[x] for x in XX], deadline=deadline)
+    for _, t in X:
+        add_timings(timings, t)
+    return [x for x, _ in X]
+
+def submit_units(XX, tlang, deadline=None, timings=None, profiled=False):
+    """ Like translate_units, but returns one future per source sentence without waiting.
+    Read the results with unit_result.
+    """
+    if scheduler is not None:
+        return [scheduler.submit_group(prep([x], tlang, timings), tlang, deadline=decode_deadline(deadline),
+                                       profile_timings=timings if profiled else None, return_info=True) for x in XX]
+    return [pool.submit(mp if tlang == 'ko' else mpko, [x], decode_deadline(deadline)) for x in XX]
+
+def unit_result(f, timings):
+    """ Model outputs of a finished future of submit_units; the worker's stage timings are added to timings.
+    """
+    if scheduler is not None:
+        return f.result()
+    X, t = f.result()
+    add_timings(timings, t)
+    return X
+
+def lookup(XX, tlang):
+    """ Translations of source sentences found in the cache or the translation memory.
+    @returns done (Dict[str, str]): source sentence -> translation
+    """
+    done = {}
+    for x in dict.fromkeys(XX):
+        y = cache.get(x, tlang) if cache is not None else None
+        if y is None and tm is not None:
+            y = tm.get(x, tlang)
+            if y is not None and cache is not None:
+                cache.put(x, tlang, y)
+        if y is not None:
+            done[x] = y
+    return done
+
+def unit_text(y, tlang, planned=('beam',)):
+    """ Post-processed translation of a source sentence from its model outputs, and how it was
+    decoded: the strongest planned decoder (see planned_decoding) among its outputs, or the first
+    degradation among them.
+    """
+    text = post_proc([s for s, _, _ in y], tlang)
+    degraded = [dec for _, _, dec in y if dec not in planned]
+    if len(degraded) > 0:
+        return text, degraded[0]
+    return text, planned[max([planned.index(dec) for _, _, dec in y] + [0])]
+
+def store(items, tlang):
+    """ Remember new (source sentence, translation) pairs.
+    """
+    if cache is not None:
+        for x, y in items:
+            cache.put(x, tlang, y)
+    if tm is not None and len(items) > 0:
+        tm.put_many(items, tlang)
+
+def nmt(X, to_start, pre_ko, pre_en, trns, pool, deadline=None, timings=None, profiled=False):
+
+    timings = {} if timings is None else timings
+    start = time.time()
+    tlang, XX = split_units(X)
+    timings['to_start'] = time.time() - start
 
-        X = list(chain(*X))       
-        tt = time.time() - start      
-        X = rid_blank(X) #for x in X]            
-        Xout = X.strip() #for x in X]
+    # known sentences are not dispatched; repeated ones are translated once
+    t = time.time()
+    done = lookup(XX, tlang)
+    todo = [x for x in dict.fromkeys(XX) if x not in done]
+    timings['lookup'] = time.time() - t
+
+    t = time.time()
+    X = translate_units(todo, tlang, deadline, timings, profiled)
+    timings['translate'] = time.time() - t
+
+    t = time.time()
+    items = [(x, unit_text(y, tlang)) for x, y in zip(todo, X)] #for x in X]
+    # degraded translations are not remembered
+    store([(x, y) for x, (y, dec) in items if dec == 'beam'], tlang)
+    done.update([(x, y) for x, (y, _) in items])
+    Xout = join_sents([done[x] for x in XX])
+    timings['postproc'] = time.time() - t
+    timings['total'] = time.time() - start
+    record(timings, tlang, len(XX), len(' '.join(XX).split()))
 
     return Xout #'\n\n'.join(Xout)
 
+def translate_api(todo, tlang, profile, deadline=None, profiled=False):
+    """ Translate source sentences of one direction and profile for /api/translate.
+    @returns outs (List[List[Tuple[str, float, str]]]): (output, score, decoding) of every source sentence
+    @returns timings (Dict[str, float]): seconds spent per stage, and decode steps
+    """
+    timings = {}
+    if scheduler is not None:
+        XX = [prep([x], tlang, timings) for x in todo]
+        start = time.time()
+        futures = [scheduler.submit_group(x, tlang, deadline=decode_deadline(deadline), profile=profile, return_info=True,
+                                          profile_timings=timings if profiled else None) for x in XX]
+        outs = results(futures, deadline)
+        timings['decode'] = time.time() - start
+        return outs, timings
+    outs = []
+    jobs = [(todo[i:i+api_chunk], tlang, profile, deadline, profiled) for i in range(0, len(todo), api_chunk)]
+    for o, t in pool.map(mp_api, jobs, chunksize=1, deadline=deadline):
+        outs += o
+        add_timings(timings, t)
+    return outs, timings
+
+def api_docs(data):
+    """ Validate the body of /api/translate.
+    @returns docs (List[Dict]): text, tlang and profile of every document
+    """
+    if isinstance(data, dict):
+        data = data.get('documents')
+    if not isinstance(data, list):
+        raise ValueError('expected a JSON array of documents')
+    docs = []
+    for d in data:
+        if isinstance(d, str):
+            d = {'text': d}
+        if not isinstance(d, dict) or not isinstance(d.get('text'), str):
+            raise ValueError('a document is a string or an object with a "text" string')
+        if d.get('tlang') not in (None, 'ko', 'en'):
+            raise ValueError('tlang must be "ko" or "en"')
+        if d.get('profile', 'quality') not in DECODING_PROFILES:
+            raise ValueError('profile must be one of ' + ', '.join(sorted(DECODING_PROFILES)))
+        docs.append({'text': d['text'], 'tlang': d.get('tlang'), 'profile': d.get('profile', 'quality')})
+    return docs
+
+def nmt_api(docs, deadline=None, timings=None, profiled=False):
+    """ Translate documents for /api/translate. Sentences of all documents are pooled by direction
+    and profile and decoded together.
+    """
+    timings = {} if timings is None else timings
+    start = time.time()
+    units = []
+    for d in docs:
+        tlang, XX = split_units(d['text'])
+        units.append((d['tlang'] or tlang, d['profile'], XX))
+    if sum([len(XX) for _, _, XX in units]) > api_max_sents:
+        raise OverflowError('more than {} sentences'.format(api_max_sents))
+    timings['to_start'] = time.time() - start
+
+    # cache and translation memory hold translations of the default profile only, without scores
+    found = {}    # (tlang, profile) -> {source sentence: (translation, score, decoding)}
+    t = time.time()
+    for tlang, profile, XX in units:
+        done = found.setdefault((tlang, profile), {})
+        if profile == 'quality':
+            done.update([(x, (y, None, 'cached')) for x, y in lookup(XX, tlang).items()])
+    timings['lookup'] = time.time() - t
+
+    t = time.time()
+    todo = {}
+    for tlang, profile, XX in units:
+        todo.setdefault((tlang, profile), []).extend([x for x in XX if x not in found[(tlang, profile)]])
+    outs = {}
+    for key, XX in todo.items():
+        XX = list(dict.fromkeys(XX))
+        if len(XX) > 0:
+            outs[key] = (XX, translate_api(XX, *key, deadline=deadline, profiled=profiled))
+    timings['translate'] = time.time() - t
+
+    # segment, preproc_num and decode add up the time of every pool worker, they can exceed translate
+    t = time.time()
+    for (tlang, profile), (XX, (Y, tt)) in outs.items():
+        record(tt, tlang, len(XX), len(' '.join(XX).split()))
+        add_timings(timings, tt)
+        items = []
+        for x, y in zip(XX, Y):
+            text, dec = unit_text(y, tlang, planned_decoding(profile))
+            found[(tlang, profile)][x] = (text, sum([score for _, score, _ in y]) if len(y) > 0 else None, dec)
+            # degraded translations are not remembered
+            if dec == 'beam':
+                items.append((x, text))
+        if profile == 'quality':
+            store(items, tlang)
+
+    translations = []
+    for tlang, profile, XX in units:
+        done = found[(tlang, profile)]
+        translations.append({'text': join_sents([done[x][0] for x in XX]), 'tlang': tlang, 'profile': profile,
+                             'degraded': any([done[x][2] not in planned_decoding(profile) + ('cached',) for x in XX]),
+                             'sentences': [{'source': x, 'text': done[x][0], 'score': done[x][1], 'decoding': done[x][2]}
+                                           for x in XX]})
+    timings['postproc'] = time.time() - t
+    timings['total'] = time.time() - start
+    request_timings = dict([(k, v) for k, v in timings.items() if k in ('to_start', 'lookup', 'translate', 'postproc', 'total')])
+    record(request_timings, 'all', 0, 0)
+    return {'translations': translations, 'timings': timings}
+
+def nmt_stream(X, deadline=None, debug=False):
+    """ Translate X and yield Server-Sent Events as sentences finish:
+    first {"n": number of sentences}, then {"index": i, "text": translation} per sentence in
+    completion order (with "decoding" as in Trns.translate), then {"done": true, "text": whole translation}. Paragraph breaks come through
+    as sentences translated to '\n\n'. At the deadline, or if a pool worker dies, an {"error"} event ends the stream.
+    With debug the last event carries the timing breakdown.
+    """
+    timings = {}
+    start = time.time()
+    tlang, XX = split_units(X)
+    timings['to_start'] = time.time() - start
+    yield sse({'n': len(XX)})
+
+    t = time.time()
+    done = lookup(XX, tlang)
+    timings['lookup'] = time.time() - t
+    for i, x in enumerate(XX):
+        if x in done:
+            yield sse({'index': i, 'text': done[x]})
+
+    todo = [x for x in dict.fromkeys(XX) if x not in done]
+    t = time.time()
+    futures = dict(zip(submit_units(todo, tlang, deadline, timings), todo))
+    try:
+        for f in as_completed(futures, timeout=None if deadline is None else max(deadline - time.time(), 0)):
+            x = futures[f]
+            done[x], dec = unit_text(unit_result(f, timings), tlang)
+            if dec == 'beam':
+                store([(x, done[x])], tlang)
+            for i, xi in enumerate(XX):
+                if xi == x:
+                    yield sse({'index': i, 'text': done[x], 'decoding': dec})
+    except TimeoutError:
+        admission.timed_out()
+        yield sse({'error': 'deadline exceeded'})
+        return
+    except BrokenProcessPool:
+        # a pool worker died; the pool is rebuilt for the next requests
+        yield sse({'error': 'translation worker failed, please retry'})
+        return
+    finally:
+        # also reached when the client disconnects
+        for f in futures:
+            f.cancel()
+
+    timings['translate'] = time.time() - t
+    timings['total'] = time.time() - start
+    record(timings, tlang, len(XX), len(' '.join(XX).split()))
+    yield sse(dict([('done', True), ('text', join_sents([done[x] for x in XX]))] + ([('timings', timings)] if debug else [])))
+
+def sse(d):
+    return 'data: ' + json.dumps(d, ensure_ascii=False) + '\n\n'
+
+def request_deadline():
+    """ Deadline of the current request.
+    """
+    timeout = request_timeout
+    try:
+        timeout = min(timeout, float(request.headers.get('X-Request-Timeout', timeout)))
+    except ValueError:
+        pass
+    return time.time() + timeout
+
+def busy():
+    """ 429 response for a request that does not fit in the token budget.
+    """
+    resp = jsonify({'error': 'server busy, retry later'})
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(admission.retry_after())
+    return resp
+
+def debug():
+    """ Clients ask for the timing breakdown of a request with an X-NMT-Debug: 1 header.
+    """
+    return request.headers.get('X-NMT-Debug', '') == '1'
+
+def run_request(meta, timings, fn, *args, **kwargs):
+    """ Call fn, under the profiler if the request is sampled (fn then gets profiled=True).
+    @param meta (Dict): request description stored with the profile
+    """
+    if profiler is None or not profiler.sample():
+        return fn(*args, **kwargs)
+    return profiler.profile_request(meta, timings, fn, *args, profiled=True, **kwargs)
+
+def admit(X):
+    """ Source tokens of X if the request is admitted, else None.
+    """
+    tokens = len(X.split())
+    return tokens if admission.acquire(tokens) else None
+
 @app.route('/')
 def root():    
     X = ["네이버 뉴스, 위키피디아 등 복사해서 여기에 붙이고 아래 translate 버튼 누르면 됩니다.\n물론 문장을 직접 타이프해도 됩니다."]
@@ -75,8 +520,102 @@ def nmt_sub(Xout=None):
 @app.route('/nmt', methods=['POST'])
 def post():
     X = request.form['nmt']
-    Y = nmt(X, to_start, pre_ko, pre_en, trns, Pool)
-    return render_template('nmt.html',to_test = X, tested = Y)
+    tokens = admit(X)
+    if tokens is None:
+        return busy()
+    metrics.inc('nmt_requests_total', endpoint='nmt')
+    start = time.time()
+    timings = {}
+    try:
+        meta = {'endpoint': 'nmt', 'tlang': detect_tlang(X), 'chars': len(X), 'tokens': tokens}
+        Y = run_request(meta, timings, nmt, X, to_start, pre_ko, pre_en, trns, pool, deadline=request_deadline(),
+                        timings=timings)
+    except TimeoutError:
+        admission.timed_out()
+        return render_template('nmt.html', to_test = X, tested = 'Timed out, please retry.'), 504
+    except BrokenProcessPool:
+        return render_template('nmt.html', to_test = X, tested = 'Translation failed, please retry.'), 503
+    finally:
+        admission.release(tokens, time.time() - start)
+    resp = app.make_response(render_template('nmt.html',to_test = X, tested = Y))
+    if debug():
+        resp.headers['Server-Timing'] = server_timing(timings)
+    return resp
+
+@app.route('/nmt_stream', methods=['POST'])
+def post_stream():
+    X = request.form['nmt']
+    tokens = admit(X)
+    if tokens is None:
+        return busy()
+    metrics.inc('nmt_requests_total', endpoint='nmt_stream')
+    start = time.time()
+    # X-Accel-Buffering: the App Engine front end must not hold the events back
+    resp = Response(stream_with_context(nmt_stream(X, request_deadline(), debug())), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(lambda: admission.release(tokens, time.time() - start))
+    return resp
+
+@app.route('/api/translate', methods=['POST'])
+def api_translate():
+    """ JSON API: POST an array of documents, each a string or {"text", "tlang", "profile"}.
+    tlang ("ko" or "en") overrides the detected direction; profile is a key of DECODING_PROFILES.
+    """
+    try:
+        docs = api_docs(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    tokens = admit(' '.join([d['text'] for d in docs]))
+    if tokens is None:
+        return busy()
+    metrics.inc('nmt_requests_total', endpoint='api')
+    start = time.time()
+    try:
+        meta = {'endpoint': 'api', 'tlang': sorted(set([d['tlang'] or detect_tlang(d['text']) for d in docs])),
+                'documents': len(docs), 'chars': sum([len(d['text']) for d in docs]), 'tokens': tokens}
+        timings = {}
+        out = run_request(meta, timings, nmt_api, docs, request_deadline(), timings)
+        resp = jsonify(out)
+        if debug():
+            resp.headers['Server-Timing'] = server_timing(out['timings'])
+        return resp
+    except OverflowError as e:
+        return jsonify({'error': str(e)}), 413
+    except TimeoutError:
+        admission.timed_out()
+        return jsonify({'error': 'deadline exceeded'}), 504
+    except BrokenProcessPool:
+        return jsonify({'error': 'translation worker failed, please retry'}), 503
+    finally:
+        admission.release(tokens, time.time() - start)
+
+@app.route('/metrics')
+def prometheus():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles')
+def profiles():
+    """ Recent profiles, newest first; download with /profiles/<name>/prof or /profiles/<name>/torch.txt
+    """
+    if profiler is None:
+        abort(404)
+    return jsonify(profiler.list())
+
+@app.route('/profiles/<name>/<kind>')
+def profile_file(name, kind):
+    path = profiler.path(name, kind) if profiler is not None else None
+    if path is None:
+        abort(404)
+    return send_file(path, as_attachment=True)
+
+@app.route('/stats')
+def stats():
+    return jsonify({'backend': backend,
+                    'cache': cache.stats() if cache is not None else None,
+                    'tm': tm.stats() if tm is not None else None,
+                    'admission': admission.stats(),
+                    'queued_sentences': scheduler.pending() if scheduler is not None else None,
+                    'pool_restarts': pool.restarts if pool is not None else None})
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,40 @@
+import threading
+
+from app_admit import Admission
+
+
+def test_budget():
+    admission = Admission(max_tokens=10)
+    assert admission.acquire(8)
+    assert not admission.acquire(3)
+    assert admission.acquire(2)
+    admission.release(8)
+    admission.release(2)
+    assert admission.tokens == 0 and admission.requests == 0
+    stats = admission.stats()
+    assert stats['admitted'] == 2 and stats['rejected'] == 1
+
+
+def test_large_request_admitted_alone():
+    admission = Admission(max_tokens=10)
+    assert admission.acquire(50)
+    assert not admission.acquire(1)
+
+
+def test_retry_after():
+    admission = Admission(max_tokens=10000, sec_per_token=0.1)
+    assert admission.retry_after() == 1
+    admission.acquire(100)
+    assert admission.retry_after() == 10
+    admission.acquire(5000)
+    assert admission.retry_after() == 60
+
+
+def test_timed_out():
+    admission = Admission()
+    threads = [threading.Thread(target=lambda: [admission.timed_out() for _ in range(1000)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert admission.stats()['timeouts'] == 4000
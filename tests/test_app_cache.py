@@ -0,0 +1,39 @@
+import time
+
+from app_cache import TranslationCache, norm_key
+
+
+def test_norm_key():
+    assert norm_key('  a   b\n', 'ko') == norm_key('a b', 'ko')
+    assert norm_key('a b', 'ko') != norm_key('a b', 'en')
+
+
+def test_lru_eviction():
+    size = len(norm_key('a', 'ko').encode('utf-8')) + 1 + TranslationCache.overhead
+    cache = TranslationCache(max_bytes=2 * size)
+    cache.put('a', 'ko', 'A')
+    cache.put('b', 'ko', 'B')
+    assert cache.get('a', 'ko') == 'A'
+    cache.put('c', 'ko', 'C')
+    assert cache.get('b', 'ko') is None
+    assert cache.get('a', 'ko') == 'A'
+    assert cache.get('c', 'ko') == 'C'
+    assert cache.stats()['evictions'] == 1
+    assert cache.size == 2 * size
+
+
+def test_too_large_entry_is_not_stored():
+    cache = TranslationCache(max_bytes=100)
+    cache.put('a', 'ko', 'A' * 100)
+    assert cache.get('a', 'ko') is None
+    assert cache.size == 0
+
+
+def test_ttl():
+    cache = TranslationCache(ttl=0.01)
+    cache.put('a', 'ko', 'A')
+    assert cache.get('a', 'ko') == 'A'
+    time.sleep(0.02)
+    assert cache.get('a', 'ko') is None
+    assert cache.stats()['expired'] == 1
+    assert cache.size == 0
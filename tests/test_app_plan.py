@@ -0,0 +1,38 @@
+import json
+import os
+
+import app_plan
+
+
+def test_configurations():
+    configs = app_plan.configurations(4)
+    assert (1, 4) in configs and (4, 1) in configs and (2, 2) in configs
+    assert all([w * t <= 4 for w, t in configs])
+
+
+def test_default_plan():
+    plan = app_plan.default_plan(3)
+    assert plan == {'cpus': 3, 'pool': {'workers': 3, 'threads': 1}, 'batch': {'threads': 3}}
+
+
+def test_load_plan(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_plan, 'available_cpus', lambda: 4)
+    path = tmp_path / 'plan.json'
+    plan = {'cpus': 4, 'pool': {'workers': 2, 'threads': 2}, 'batch': {'threads': 4}}
+    path.write_text(json.dumps(plan))
+    assert app_plan.load_plan(str(path)) == plan
+    assert app_plan.load_plan(None) == app_plan.default_plan(4)
+    assert app_plan.load_plan(str(tmp_path / 'missing.json')) == app_plan.default_plan(4)
+
+    # made on another host
+    path.write_text(json.dumps(dict(plan, cpus=8)))
+    assert app_plan.load_plan(str(path)) == app_plan.default_plan(4)
+
+
+def test_set_thread_env_keeps_set_values(monkeypatch):
+    for name in app_plan.THREAD_ENV:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('OMP_NUM_THREADS', '3')
+    app_plan.set_thread_env(2)
+    assert os.environ['OMP_NUM_THREADS'] == '3'
+    assert os.environ['MKL_NUM_THREADS'] == '2'
@@ -0,0 +1,45 @@
+import io
+
+from app_tm import TranslationMemory, decoding_config, model_version
+
+
+def test_round_trip(tmp_path):
+    tm = TranslationMemory(str(tmp_path / 'tm.db'), 'model', 'vocab')
+    tm.put_many([('안녕  하세요', 'Hello'), ('고맙습니다', 'Thanks')], 'en')
+    assert tm.get('안녕 하세요', 'en') == 'Hello'
+    assert tm.get('안녕 하세요', 'ko') is None
+    assert tm.stats()['hits'] == 1 and tm.stats()['misses'] == 1
+
+    f = io.StringIO()
+    assert tm.export(f) == 2
+    other = TranslationMemory(str(tmp_path / 'other.db'), 'model', 'vocab')
+    assert other.load(io.StringIO(f.getvalue())) == 2
+    assert other.get('고맙습니다', 'en') == 'Thanks'
+
+
+def test_versions_are_separate(tmp_path):
+    path = str(tmp_path / 'tm.db')
+    TranslationMemory(path, 'model', 'vocab').put_many([('a', 'A')], 'ko')
+    tm = TranslationMemory(path, 'model:int8', 'vocab')
+    assert tm.get('a', 'ko') is None
+    assert tm.load(io.StringIO('{"tlang": "ko", "model": "model", "vocab": "vocab", "src": "b", "tgt": "B", '
+                               '"created": 0}\n')) == 0
+    assert tm.purge() == 1
+
+
+def test_model_version(tmp_path):
+    vocab = tmp_path / 'vocab.json'
+    vocab.write_text('{}')
+    shortlist = tmp_path / 'lex_ko.json'
+    shortlist.write_text('{}')
+    assert decoding_config() == []
+    decoding = decoding_config(True, [str(shortlist)], True)
+    assert decoding[0] == 'partition' and decoding[-1] == 'int8'
+    assert decoding[1].startswith('shortlist=lex_ko.json@')
+    assert decoding_config(early_stop=True) == ['early_stop']
+
+    name, vocab_hash = model_version('trns/model_bi_1105', str(vocab), decoding)
+    assert name == ':'.join(['model_bi_1105'] + decoding)
+    assert model_version('trns/model_bi_1105', str(vocab)) == ('model_bi_1105', vocab_hash)
+    shortlist.write_text('{"a": ["b"]}')
+    assert decoding_config(shortlist_files=[str(shortlist)]) != decoding[1:2]
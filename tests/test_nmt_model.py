@@ -0,0 +1,192 @@
+import random
+import time
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from trns.nmt_model import NMT, Khypothesis
+from trns.shortlist import Shortlist
+from trns.trns_koren import Trns, planned_decoding
+from trns.vocab import Vocab
+
+
+@pytest.fixture(scope='module')
+def model():
+    """ Random weights: the checks compare decoders with each other, not with references of the trained model.
+    """
+    torch.manual_seed(0)
+    model = NMT(vocab=Vocab.load('trns/vocab.json'), embed_size=300, hidden_size=300, char_size=85, wid2cid={},
+                dropout_rate=0.0)
+    model.eval()
+    return model
+
+
+def ko_sents(model, n, seed=0):
+    """ Korean source sentences of random vocabulary tokens, eojeol separated by '_'.
+    """
+    rng = random.Random(seed)
+    id2word = model.vocab.vocs.id2word
+    ko = [id2word[i] for i in range(model.ko_start + 100, model.ko_start + 3000)]
+    sents = []
+    for _ in range(n):
+        s = []
+        for _ in range(rng.randint(2, 8)):
+            s += ['_'] + rng.sample(ko, rng.randint(1, 2))
+        sents.append(s)
+    return sents
+
+
+def test_deadline_cut_is_not_stored(model):
+    """ main.py remembers only translations labeled with the planned decoder of their profile.
+    """
+    src_sents = ko_sents(model, 3)
+    projection = model.target_vocab_projection
+    # </s> is the best first token, so every sentence has a completed hypothesis when the deadline cuts it
+    eos_first = nn.Linear(projection.in_features, projection.out_features)
+    with torch.no_grad():
+        eos_first.weight.copy_(projection.weight)
+        eos_first.bias.zero_()
+        eos_first.bias[model.vocab.vocs['</s>']] = 50.
+    trns = Trns(model)
+    try:
+        for projection_t, label in [(eos_first, 'beam_cut'), (projection, 'truncated')]:
+            model.target_vocab_projection = projection_t
+            info = {}
+            with torch.no_grad():
+                model.ek_beam_search_batch(src_sents, beam_size=4, max_decoding_time_step=20, tlang='en',
+                                           deadline=time.time(), info=info)
+            assert info['decoding'] == [label] * len(src_sents)
+
+            outs = trns.translate(src_sents, 'en', return_info=True, deadline=time.time())
+            assert all([dec not in planned_decoding('quality') for _, _, dec in outs])
+    finally:
+        model.target_vocab_projection = projection
+
+
+def test_candidates_do_not_depend_on_the_batch(model):
+    """ With a shortlist or partitioned output, a sentence is decoded the same alone and in a batch.
+    """
+    src_sents = ko_sents(model, 4, seed=1)
+    id2word = model.vocab.vocs.id2word
+    en = [id2word[i] for i in range(100, 2000)]
+    rng = random.Random(1)
+    lex = dict([(w, rng.sample(en, 30)) for s in src_sents for w in s if w != '_'])
+    shortlist = Shortlist(model.vocab, lex, en[:20], 'en')
+
+    def decode(sents, partition):
+        model.partition_output = partition
+        vocab_ids = vocab_mask = None
+        if not partition:
+            vocab_ids, vocab_mask = shortlist.candidates(sents, model.device)
+        with torch.no_grad():
+            hyps = model.ek_beam_search_batch(sents, beam_size=3, max_decoding_time_step=10, tlang='en',
+                                              vocab_ids=vocab_ids, vocab_mask=vocab_mask)
+        return [(h[0].value, h[0].score) for h in hyps]
+
+    try:
+        for partition in [False, True]:
+            batch = decode(src_sents, partition)
+            for s, (value, score) in zip(src_sents, batch):
+                alone_value, alone_score = decode([s], partition)[0]
+                assert value == alone_value
+                assert abs(score - alone_score) < 1e-4
+    finally:
+        model.partition_output = False
+
+
+def reference_beam_search(model, src_sent, beam_size, max_decoding_time_step, tlang):
+    """ Beam search over one sentence with per-hypothesis Python bookkeeping: the algorithm of the
+    per-sentence ek_beam_search before it was batched, kept here as the reference of ek_beam_search_batch.
+    """
+    slang = 'en' if tlang == 'ko' else 'ko'
+    sbol_init = model.sbol_states(tlang)[0]
+    src_sents_var, src_len = model.parallel_encode_new([src_sent], slang)
+    encode = model.en_encode if slang == 'en' else model.ko_encode
+    src_encodings, h_tm1 = encode(src_sents_var, src_len)
+    att_projection = model.ko_att_projection if tlang == 'ko' else model.en_att_projection
+    src_encodings_att_linear = att_projection(src_encodings)
+    att_tm1 = torch.zeros(1, model.hidden_size, device=model.device)
+    n_vocab = len(model.vocab.vocs)
+
+    # per live hypothesis: tokens, xo, token log probabilities, attention per step
+    hypotheses = [(['<s>'], [1], [], [])]
+    hyp_scores = torch.zeros(1, device=model.device)
+    init_vecs = sbol_init[1][1]
+    completed = []
+    t = 0
+    while len(completed) < beam_size and t < max_decoding_time_step:
+        t += 1
+        n = len(hypotheses)
+        y_tm1 = torch.tensor([model.vocab.vocs[h[0][-1]] for h in hypotheses], dtype=torch.long, device=model.device)
+        y_t_embed, next_init_vecs = model.parallel_beam_encode2(y_tm1, tlang, init_vecs=init_vecs)
+        x = torch.cat([y_t_embed, att_tm1], dim=-1)
+        (h_t, cell_t), att_t, _, alpha_t = model.step(x, h_tm1, src_encodings.expand(n, -1, -1),
+                                                      src_encodings_att_linear.expand(n, -1, -1), enc_masks=None,
+                                                      tlang=tlang)
+        log_p_t = F.log_softmax(model.target_vocab_projection(att_t), dim=-1)
+        log_p2, xos = F.log_softmax(model.target_ox_projection(att_t), dim=-1).max(-1)
+        scores = (hyp_scores.unsqueeze(1) + log_p_t + log_p2.unsqueeze(1) * model.xo_weight).view(-1)
+        top_scores, top_pos = torch.topk(scores, k=beam_size - len(completed))
+
+        new_hypotheses, live_ids, new_scores, new_init_vecs = [], [], [], [[], []]
+        for pos, score in zip(top_pos.tolist(), top_scores.tolist()):
+            i, w = pos // n_vocab, pos % n_vocab
+            words, xo, u, a = hypotheses[i]
+            words, xo = words + [model.vocab.vocs.id2word[w]], xo + [xos[i].item()]
+            u, a = u + [log_p_t[i, w].item()], a + [alpha_t[i]]
+            if words[-1] == '</s>':
+                completed.append(Khypothesis(value=words[1:-1], xo=xo[1:-1], score=score,
+                                             u_score=sum([v**2 for v in u]), a_score=sum(a)))
+                continue
+            new_hypotheses.append((words, xo, u, a))
+            live_ids.append(i)
+            new_scores.append(score)
+            if xo[-1] < 1:
+                new_init_vecs[0].append(next_init_vecs[0][0][i].unsqueeze(0))
+                new_init_vecs[1].append(next_init_vecs[1][0][i].unsqueeze(0))
+            else:
+                new_init_vecs[0].append(sbol_init[xo[-1]][1][0].squeeze(0))
+                new_init_vecs[1].append(sbol_init[xo[-1]][1][1].squeeze(0))
+        if len(completed) == beam_size:
+            break
+
+        live_ids = torch.tensor(live_ids, dtype=torch.long, device=model.device)
+        h_tm1 = (h_t.index_select(1, live_ids), cell_t.index_select(1, live_ids))
+        att_tm1 = att_t.index_select(0, live_ids)
+        init_vecs = [torch.cat(v, 0).unsqueeze(0) for v in new_init_vecs]
+        hypotheses = new_hypotheses
+        hyp_scores = torch.tensor(new_scores, device=model.device)
+
+    if len(completed) == 0:
+        words, xo, u, a = hypotheses[0]
+        completed.append(Khypothesis(value=words[1:], xo=xo[1:], score=hyp_scores[0].item(),
+                                     u_score=sum([v**2 for v in u]), a_score=sum(a)))
+    return model.rescore_hypotheses(completed, src_len[0], slang)
+
+
+@pytest.mark.parametrize('eos_bias', [None, 0.035, 0.04])
+def test_batched_beam_search_matches_reference(model, eos_bias):
+    """ Without a bias on </s> the random model never ends a sentence; small biases make sentences end
+    at different steps, with from one to beam_size completed hypotheses.
+    """
+    src_sents = ko_sents(model, 6, seed=2)
+    projection = model.target_vocab_projection
+    if eos_bias is not None:
+        model.target_vocab_projection = nn.Linear(projection.in_features, projection.out_features)
+        with torch.no_grad():
+            model.target_vocab_projection.weight.copy_(projection.weight)
+            model.target_vocab_projection.bias.zero_()
+            model.target_vocab_projection.bias[model.vocab.vocs['</s>']] = eos_bias
+    model.early_stop = False
+    try:
+        with torch.no_grad():
+            batch = model.ek_beam_search_batch(src_sents, beam_size=4, max_decoding_time_step=15, tlang='en')
+            for s, hyps in zip(src_sents, batch):
+                ref = reference_beam_search(model, s, 4, 15, 'en')
+                assert hyps[0].value == ref[0].value
+                assert abs(hyps[0].score - ref[0].score) < 1e-3
+                assert sorted([h.value for h in hyps]) == sorted([h.value for h in ref])
+    finally:
+        model.target_vocab_projection = projection
@@ -0,0 +1,18 @@
+from trns.preproc_kor import EojeolCache
+
+
+def test_eojeol_cache(tmp_path):
+    cache = EojeolCache(max_size=2)
+    cache['가'] = ['가']
+    cache['나는'] = ['나', '는']
+    assert cache.get('가') == ['가']
+    cache['다'] = ['다']
+    assert cache.get('나는') is None
+    assert len(cache) == 2
+    assert cache.hit_rate() == 0.5
+
+    path = str(tmp_path / 'warm.json')
+    cache.save(path)
+    warm = EojeolCache()
+    warm.load(path)
+    assert warm.get('다') == ['다'] and warm.get('가') == ['가']
@@ -0,0 +1,38 @@
+from trns.shortlist import Shortlist, build_table
+from trns.utils import corpus_bleu
+from trns.vocab import Vocab
+
+
+def test_corpus_bleu():
+    ref = 'the cat sat on the mat today'.split()
+    assert abs(corpus_bleu([ref], [ref]) - 100.) < 1e-9
+    assert corpus_bleu([ref], ['a dog ran'.split()]) == 0.
+    assert corpus_bleu([ref], [[]]) == 0.
+    # shorter hypotheses pay the brevity penalty
+    assert corpus_bleu([ref], [ref[:5]]) < 100.
+    assert 0. < corpus_bleu([ref, ref], [ref, 'the cat sat on a mat today'.split()]) < 100.
+
+
+def test_build_table():
+    src = [['a', 'b', '.'], ['a', 'c'], ['a', 'b'], ['d']]
+    tgt = [['x', 'y', '.'], ['x', 'z'], ['x', 'y'], ['w']]
+    lex, frequent = build_table(src, tgt, per_source=20, min_count=2, frequent=1)
+    assert frequent == ['x']
+    # frequent tokens and special tokens are left out, rare pairs are dropped
+    assert lex == {'a': ['y'], 'b': ['y']}
+    lex, _ = build_table(src, tgt, per_source=1, min_count=1, frequent=0)
+    assert lex['a'] == ['x'] and lex['d'] == ['w'] and '.' not in lex
+
+
+def test_candidates_per_sentence():
+    vocab = Vocab.load('trns/vocab.json')
+    words = [vocab.vocs.id2word[i] for i in range(100, 106)]
+    shortlist = Shortlist(vocab, {words[0]: [words[1]], words[2]: [words[3]]}, [words[4]], 'en')
+    vocab_ids, vocab_mask = shortlist.candidates([[words[0]], [words[2]]], 'cpu')
+    ids = vocab_ids.tolist()
+    assert ids == sorted(ids) and vocab_mask.shape == (2, len(ids))
+    first = set([w for w, m in zip(ids, vocab_mask[0].tolist()) if m])
+    second = set([w for w, m in zip(ids, vocab_mask[1].tolist()) if m])
+    assert set([vocab.vocs[w] for w in words[:2] + words[4:5]]) <= first
+    assert vocab.vocs[words[1]] not in second and vocab.vocs[words[3]] in second
+    assert first | second == set(ids)
@@ -295,7 +295,8 @@ def get_vocs_dict(vocabs):
     
     return vocs_dict
 
-def to_bpe_sents10(sentences, vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs,k_args, cut):
+def to_bpe_sents10(sentences, vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs,k_args, cut, cache=None):
+    """ cache : dict-like, word -> its tokens (EojeolCache of preproc_kor.py) """
             
     vocabs.pop('',1) 
 
@@ -333,6 +334,234 @@ def to_bpe_sents10(sentences, vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,
     #(8220, 8216, 34, 39)
 
                    
+    def to_bpe_word(w):
+        # tokens of one word, depending only on the word: unknown <...> pieces count 1 and are not added to vocabs
+        if p.search(w) is not None:                       
+            #sentence += [w,'_']
+            return [z2.sub('__',w)]
+        #print(w)
+        n_fw = []
+        n_bw = []
+
+        bpe_w= ''.join([chr(i+BASE_CODE) for i in counter_convert2(w,key_vars)[1]])
+        
+        s_w = bpe_w + '걟걟'
+        """ 
+        if s_w in vocabs.keys():
+            n_bf = [s_w]
+        elif z.sub('',s_w[:-1]) in vocabs.keys():
+            n_bf = [z.sub('',s_w[:-1])]
+        else:
+            n_bf = []
+        """            
+        #n_fw = forward_check3(s_w,vocabs,logprob,fre_sum)
+        
+        n_word = []  
+        
+        ifw = 0  
+        pre_len = 0
+        
+        while len(z.sub('',s_w)):           
+            #print(s_w)
+            pre_sw = s_w
+            #print("s_w : {}".format(s_w))
+            
+
+            n_fw,_ = forward_check6(s_w,vocabs,vocs_dict,z,logprob,k_args,recursive=True)
+            if n_fw[0] != 'NotInVocabs':
+                n_word += n_fw
+                #sentence += n_word + ['걟'] if n_word[-1][-1] !='걟' else n_word
+                break
+
+            #nj = len(s_w)-ifw+2
+            #for i in reversed(range(1,len(s_w)-ifw+1)):
+            #    if s_w[i:nj] in josas:
+            #        nj = i
+            
+
+            for i in reversed(range(1,len(s_w)-ifw)): # len(s_w) -2 로 한 것은 n_bf와 중복을 피하기 위해 ...
+                #if (s_w[i:] == '걟갧') or (s_w[i:] == '걟'):continue
+                
+
+                if s_w[:i] in vocabs.keys():
+                    res_w = special_to_normal(s_w[i:],key_vars)
+                    if ord(res_w[0]) not in range(12593, 12644):
+   
+                        n_fw,_= forward_check6(s_w[:i],vocabs,vocs_dict,z,logprob,k_args,recursive=True)
+                        n_word += n_fw
+
+                        s_w = s_w[i:]
+                        break 
+                
+                    elif ((s_w[:i] in vms and res_w[0] in ['ㄴ','ㄹ','ㅁ','ㅆ','ㅏ','ㅓ'])
+                          or (s_w[:i] in extracted_vocs['nouns'] and res_w[0] in ['ㅅ'])):
+                        n_fw,_= forward_check6(s_w[:i],vocabs,vocs_dict,z,logprob,k_args,recursive=True)
+                        n_word += n_fw
+
+                        s_w = s_w[i:]
+                        break                             
+                
+                                   
+            if s_w == pre_sw:
+                not_in_vocabs = 1
+                for i in range(len(s_w)):
+                    if z.sub('',s_w[i:]) in vocs_dict[0].keys():
+                        n_word += ["<" + s_w[:i] +">"] + forward_check6(s_w[i:],vocabs,vocs_dict,z,logprob,k_args,recursive=True)[0]
+                        not_in_vocabs = 0                            
+                        break
+                if not_in_vocabs == 1:
+                    n_word.append("<" + s_w +">")
+                break
+
+
+        n_w = [z.sub('걟',w) for w in n_word[:-1]] + [n_word[-1]] if len(n_word)>1 else n_word
+
+        #if ii in range(3):
+        #    print(ii, [special_to_normal(ss,key_vars) for ss in n_w])
+                    
+        if len(n_w)>1:
+            window = 2
+            to_continue = 1
+            
+            while to_continue:
+                
+                to_continue = 0
+            
+                mx = 1.4 if n_w[-1] not in josas else 1.0
+                
+                for i in range(window,len(n_w)+1):
+                    
+                    to_ch = ''.join(n_w[i-window:i])
+                    if to_ch not in vocabs:
+                        continue
+                    
+                    nx = min(max(mx, 1.+(len(n_w)-i)*0.2), 1.4) # 조사의 잔존가능성은 유지하고 조사가 아닌 경우 가능한 결합
+                        
+                    temp_sum = [np.log(vocabs.get(ww,1))-logprob[len(ww)] + magic4(ww,z,k_args) for ww in n_w[i-window:i]]
+                    if sum(temp_sum)/len(temp_sum) < np.log(vocabs[to_ch])*nx-logprob[len(to_ch)] + magic4(to_ch,z,k_args):
+                        n_w = n_w[:i-window]+[to_ch]+n_w[i:]
+                        to_continue = 1 
+                        window = 2  # 결합된 것이 있으면 원도우는 다시 2로 세팅
+                        break
+                
+                if to_continue == 0:
+                    if window < len(n_w):
+                        window += 1
+                        to_continue = 1           
+        
+        """
+        n_bw = []
+        nj = 0
+        
+        #print([special_to_normal(ss,key_vars) for ss in n_w])
+
+        for i, ww in enumerate(reversed(n_w)):
+            
+            if ww in mids:
+                temp = ww
+                nj = 1
+                
+            elif nj==1:
+                if ww in verbs:
+                    n_bw +=[temp,ww]
+                    nj = 0
+                else:
+                    break
+                
+            elif ww in josas:
+                n_bw.append(ww)
+                
+            elif i==0 and len(special_to_normal3(ww,key_vars,keep_double=False))<2:
+                break
+                
+            elif ww in verbs:
+                wws = special_to_normal3(ww,key_vars,keep_double=False)
+                if len(wws)>1:
+                    n_bw.append(ww)
+                elif wws in ['당','하','해','되','이','오','가','지']:
+                    n_bw.append(ww)
+                else:
+                    break
+                    
+                
+            else:
+                break
+                
+        n_rw = n_w[:-len(n_bw)] if len(n_bw)>0 else n_w  
+        
+        #if normal_to_special('검',key_vars) in n_w: 
+        #    print('\n\n',n_rw, [special_to_normal(wkk,key_vars) for wkk in n_w],'\n\n\n')
+
+
+        if len(n_rw) > 1:
+            
+            len_avg = sum([len(ww) for ww in n_rw])/len(n_rw)
+            log_avg = sum([np.log(vocabs[ww])*len(ww)/len_avg for ww in n_rw])/len(n_rw) * (len_avg/6.0)              
+            
+            if log_avg < log_cut and len_avg < len_cut: 
+                
+                #if ''.join(n_rw) in vocabs().keys(): # 추가된 부분
+         
+                n_rw = [''.join(n_rw)]
+            
+            else:
+                n_temp = ['']
+                l = len(n_rw)
+                pre_pop = 0
+                for i,rw in enumerate(n_rw):
+                    wn = special_to_normal3(rw,key_vars,keep_double=False)    
+                    if pre_pop == 1:
+                        n_temp[-1] = n_temp[-1]+rw
+                        pre_pop = 0
+                    
+                    elif len(rw) < 2:
+                        n_temp[-1] = n_temp[-1]+rw
+                        pre_pop = 1                            
+                        
+                    elif len(wn) > 1:
+                        if ord(wn[0]) in range(12593,12644) and ord(wn[-1]) in range(12593,12644):
+                            n_temp[-1] = n_temp[-1]+rw
+                            pre_pop = 1
+                        elif ord(wn[0]) in range(12593,12644):
+                            n_temp[-1] = n_temp[-1]+rw
+                        elif ord(wn[-1]) in range(12593,12644):
+                            n_temp.append(rw)
+                            pre_pop = 1
+                        else:
+                            n_temp.append(rw)
+
+                    else:
+                          
+                        w1 = ''.join(n_rw[-l+i-1:i])
+                        w2 = ''.join(n_rw[i:i+1])
+                        if w1 != rw and w1 in vocabs.keys():
+                            if w2 in vocabs.keys():
+                                if vocabs[w1] > vocabs[w2]: 
+                                    n_temp[-1] = n_temp[-1]+rw
+                                else:
+                                    n_temp.append(rw)
+                                    pre_pop = 1
+                            else:
+                                n_temp[-1] = n_temp[-1]+rw
+                        else:
+                            if w2 in vocabs.keys():
+                                n_temp.append(rw)
+                                pre_pop = 1 
+                            else:
+                                n_temp[-1] = n_temp[-1]+rw #양방향 모두 의미 없으면 3개 글자 모두 합쳐 하나로!
+                                pre_pop = 1 
+
+                n_rw = [ww for ww in n_temp if ww!='']
+
+        n_w = n_rw + n_bw[::-1]                
+        """            
+        #if ii in range(3):
+        #    print(ii,'last',[special_to_normal(w,key_vars) for w in n_w])
+        #n_w = [z2.sub('_',chars) for chars in n_word]
+        #sentence += n_w + ['걟'] if n_w[-1][-1] !='걟' else n_w
+        
+        return n_w
+
     for ii,s in enumerate(sentences):
         st = []
 
@@ -374,235 +603,14 @@ def to_bpe_sents10(sentences, vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,
         sentence = []
         for w in st:
             if (w == '') or (w ==' '):continue
-
-            if p.search(w) is not None:                       
-                #sentence += [w,'_']
-                sentence += [z2.sub('__',w)]
-                continue                    
-            #print(w)
-            n_fw = []
-            n_bw = []
-
-            bpe_w= ''.join([chr(i+BASE_CODE) for i in counter_convert2(w,key_vars)[1]])
-            
-            s_w = bpe_w + '걟걟'
-            """ 
-            if s_w in vocabs.keys():
-                n_bf = [s_w]
-            elif z.sub('',s_w[:-1]) in vocabs.keys():
-                n_bf = [z.sub('',s_w[:-1])]
-            else:
-                n_bf = []
-            """            
-            #n_fw = forward_check3(s_w,vocabs,logprob,fre_sum)
-            
-            n_word = []  
-            
-            ifw = 0  
-            pre_len = 0
-            
-            while len(z.sub('',s_w)):           
-                #print(s_w)
-                pre_sw = s_w
-                #print("s_w : {}".format(s_w))
-                
-
-                n_fw,_ = forward_check6(s_w,vocabs,vocs_dict,z,logprob,k_args,recursive=True)
-                if n_fw[0] != 'NotInVocabs':
-                    n_word += n_fw
-                    #sentence += n_word + ['걟'] if n_word[-1][-1] !='걟' else n_word
-                    break
-
-                #nj = len(s_w)-ifw+2
-                #for i in reversed(range(1,len(s_w)-ifw+1)):
-                #    if s_w[i:nj] in josas:
-                #        nj = i
-                
- 
-                for i in reversed(range(1,len(s_w)-ifw)): # len(s_w) -2 로 한 것은 n_bf와 중복을 피하기 위해 ...
-                    #if (s_w[i:] == '걟갧') or (s_w[i:] == '걟'):continue
-                    
- 
-                    if s_w[:i] in vocabs.keys():
-                        res_w = special_to_normal(s_w[i:],key_vars)
-                        if ord(res_w[0]) not in range(12593, 12644):
-       
-                            n_fw,_= forward_check6(s_w[:i],vocabs,vocs_dict,z,logprob,k_args,recursive=True)
-                            n_word += n_fw
-
-                            s_w = s_w[i:]
-                            break 
-                    
-                        elif ((s_w[:i] in vms and res_w[0] in ['ㄴ','ㄹ','ㅁ','ㅆ','ㅏ','ㅓ'])
-                              or (s_w[:i] in extracted_vocs['nouns'] and res_w[0] in ['ㅅ'])):
-                            n_fw,_= forward_check6(s_w[:i],vocabs,vocs_dict,z,logprob,k_args,recursive=True)
-                            n_word += n_fw
-
-                            s_w = s_w[i:]
-                            break                             
-                    
-                                       
-                if s_w == pre_sw:
-                    not_in_vocabs = 1
-                    for i in range(len(s_w)):
-                        if z.sub('',s_w[i:]) in vocs_dict[0].keys():
-                            n_word += ["<" + s_w[:i] +">"] + forward_check6(s_w[i:],vocabs,vocs_dict,z,logprob,k_args,recursive=True)[0]
-                            insert_voc(vocabs,"<" + s_w[:i] +">",1)
-                            not_in_vocabs = 0                            
-                            break
-                    if not_in_vocabs == 1:
-                        n_word.append("<" + s_w +">")
-                        insert_voc(vocabs,"<" + s_w +">",1)
-                    break
- 
-
-            n_w = [z.sub('걟',w) for w in n_word[:-1]] + [n_word[-1]] if len(n_word)>1 else n_word
-    
-            #if ii in range(3):
-            #    print(ii, [special_to_normal(ss,key_vars) for ss in n_w])
-                        
-            if len(n_w)>1:
-                window = 2
-                to_continue = 1
-                
-                while to_continue:
-                    
-                    to_continue = 0
-                
-                    mx = 1.4 if n_w[-1] not in josas else 1.0
-                    
-                    for i in range(window,len(n_w)+1):
-                        
-                        to_ch = ''.join(n_w[i-window:i])
-                        if to_ch not in vocabs:
-                            continue
-                        
-                        nx = min(max(mx, 1.+(len(n_w)-i)*0.2), 1.4) # 조사의 잔존가능성은 유지하고 조사가 아닌 경우 가능한 결합
-                            
-                        temp_sum = [np.log(vocabs[ww])-logprob[len(ww)] + magic4(ww,z,k_args) for ww in n_w[i-window:i]]
-                        if sum(temp_sum)/len(temp_sum) < np.log(vocabs[to_ch])*nx-logprob[len(to_ch)] + magic4(to_ch,z,k_args):
-                            n_w = n_w[:i-window]+[to_ch]+n_w[i:]
-                            to_continue = 1 
-                            window = 2  # 결합된 것이 있으면 원도우는 다시 2로 세팅
-                            break
-                    
-                    if to_continue == 0:
-                        if window < len(n_w):
-                            window += 1
-                            to_continue = 1           
-            
-            """
-            n_bw = []
-            nj = 0
-            
-            #print([special_to_normal(ss,key_vars) for ss in n_w])
-
-            for i, ww in enumerate(reversed(n_w)):
-                
-                if ww in mids:
-                    temp = ww
-                    nj = 1
-                    
-                elif nj==1:
-                    if ww in verbs:
-                        n_bw +=[temp,ww]
-                        nj = 0
-                    else:
-                        break
-                    
-                elif ww in josas:
-                    n_bw.append(ww)
-                    
-                elif i==0 and len(special_to_normal3(ww,key_vars,keep_double=False))<2:
-                    break
-                    
-                elif ww in verbs:
-                    wws = special_to_normal3(ww,key_vars,keep_double=False)
-                    if len(wws)>1:
-                        n_bw.append(ww)
-                    elif wws in ['당','하','해','되','이','오','가','지']:
-                        n_bw.append(ww)
-                    else:
-                        break
-                        
-                    
-                else:
-                    break
-                    
-            n_rw = n_w[:-len(n_bw)] if len(n_bw)>0 else n_w  
-            
-            #if normal_to_special('검',key_vars) in n_w: 
-            #    print('\n\n',n_rw, [special_to_normal(wkk,key_vars) for wkk in n_w],'\n\n\n')
-
- 
-            if len(n_rw) > 1:
-                
-                len_avg = sum([len(ww) for ww in n_rw])/len(n_rw)
-                log_avg = sum([np.log(vocabs[ww])*len(ww)/len_avg for ww in n_rw])/len(n_rw) * (len_avg/6.0)              
-                
-                if log_avg < log_cut and len_avg < len_cut: 
-                    
-                    #if ''.join(n_rw) in vocabs().keys(): # 추가된 부분
-             
-                    n_rw = [''.join(n_rw)]
-                
-                else:
-                    n_temp = ['']
-                    l = len(n_rw)
-                    pre_pop = 0
-                    for i,rw in enumerate(n_rw):
-                        wn = special_to_normal3(rw,key_vars,keep_double=False)    
-                        if pre_pop == 1:
-                            n_temp[-1] = n_temp[-1]+rw
-                            pre_pop = 0
-                        
-                        elif len(rw) < 2:
-                            n_temp[-1] = n_temp[-1]+rw
-                            pre_pop = 1                            
-                            
-                        elif len(wn) > 1:
-                            if ord(wn[0]) in range(12593,12644) and ord(wn[-1]) in range(12593,12644):
-                                n_temp[-1] = n_temp[-1]+rw
-                                pre_pop = 1
-                            elif ord(wn[0]) in range(12593,12644):
-                                n_temp[-1] = n_temp[-1]+rw
-                            elif ord(wn[-1]) in range(12593,12644):
-                                n_temp.append(rw)
-                                pre_pop = 1
-                            else:
-                                n_temp.append(rw)
-
-                        else:
-                              
-                            w1 = ''.join(n_rw[-l+i-1:i])
-                            w2 = ''.join(n_rw[i:i+1])
-                            if w1 != rw and w1 in vocabs.keys():
-                                if w2 in vocabs.keys():
-                                    if vocabs[w1] > vocabs[w2]: 
-                                        n_temp[-1] = n_temp[-1]+rw
-                                    else:
-                                        n_temp.append(rw)
-                                        pre_pop = 1
-                                else:
-                                    n_temp[-1] = n_temp[-1]+rw
-                            else:
-                                if w2 in vocabs.keys():
-                                    n_temp.append(rw)
-                                    pre_pop = 1 
-                                else:
-                                    n_temp[-1] = n_temp[-1]+rw #양방향 모두 의미 없으면 3개 글자 모두 합쳐 하나로!
-                                    pre_pop = 1 
-
-                    n_rw = [ww for ww in n_temp if ww!='']
-
-            n_w = n_rw + n_bw[::-1]                
-            """            
-            #if ii in range(3):
-            #    print(ii,'last',[special_to_normal(w,key_vars) for w in n_w])
-            #n_w = [z2.sub('_',chars) for chars in n_word]
-            #sentence += n_w + ['걟'] if n_w[-1][-1] !='걟' else n_w
-            
-            sentence +=n_w
+            if cache is None:
+                sentence += to_bpe_word(w)
+                continue
+            n_w = cache.get(w)
+            if n_w is None:
+                n_w = to_bpe_word(w)
+                cache[w] = n_w
+            sentence += n_w
         #sentence = [sentence[0]] + [wds  for i,wds in enumerate(sentence[1:]) if sentence[i][-1] !='걟걟']
         all_s.append(sentence)
 
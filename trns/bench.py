@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+bench.py: Decoding benchmarks for the NMT model
+Run from the repository root, on preprocessed (subword) source sentences, one per line.
+
+Usage:
+    bench.py beam [options] SRC_FILE
+    bench.py shortlist [options] SRC_FILE REF_FILE LEX_FILE
+    bench.py steps [options] SRC_FILE [REF_FILE]
+    bench.py profiles [options] SRC_FILE REF_FILE
+    bench.py calibrate [options] SRC_FILE REF_FILE CALIBRATION_FILE
+    bench.py greedy [options] SRC_FILE
+    bench.py script [options] SCRIPT_FILE
+    bench.py quantize [options] DEV DECISION_FILE
+
+Options:
+    -h --help                               show this screen.
+    --model=<file>                          model path [default: trns/model_bi_1105]
+    --tlang=<str>                           target language [default: ko]
+    --beam-size=<int>                       beam size [default: 10]
+    --max-decoding-time-step=<int>          maximum number of decoding time steps [default: 200]
+    --batch-sizes=<str>                     comma separated batch sizes [default: 1,2,4,8,16,32,64]
+    --batch-size=<int>                      batch size [default: 32]
+    --request-size=<int>                    profiles: source sentences per request [default: 1]
+    --max-bleu-loss=<float>                 calibrate: BLEU the hybrid profile may lose to beam search,
+                                            quantize: BLEU the int8 model may lose [default: 0.5]
+    --partition                             beam: score only the target-language rows of the output projection
+    --limit=<int>                           number of sentences to decode [default: 256]
+    --src-len=<int>                         script, quantize: source length of the random inputs [default: 30]
+    --steps=<int>                           script, quantize: decoder steps timed per batch size [default: 200]
+"""
+import json
+import os
+import sys
+import time
+
+from docopt import docopt
+import torch
+
+from trns.get_model import nmt_model, quantize, model_size, dev_bleu, weights_hash
+from trns.nmt_script import example_inputs, eager_step, max_diff
+from trns.shortlist import Shortlist
+from trns.trns_koren import Trns, DECODING_PROFILES
+from trns.utils import read_corpus, corpus_bleu
+
+
+def bench_beam(args):
+    """ Decode the same sentences one by one (the reference) and in batches with `ek_beam_search_batch`,
+    check the best hypotheses agree and report sentences per second.
+    """
+    model = nmt_model(args['--model'])
+    src_sents = read_corpus(args['SRC_FILE'], source='src')[:int(args['--limit'])]
+    tlang = args['--tlang']
+    beam_size = int(args['--beam-size'])
+    max_step = int(args['--max-decoding-time-step'])
+    model.partition_output = args['--partition']
+    # the length limits and early stop are measured by `bench.py steps`
+    model.early_stop = False
+
+    with torch.no_grad():
+        start = time.time()
+        ref = [model.ek_beam_search_batch([s], beam_size=beam_size, max_decoding_time_step=max_step, tlang=tlang)[0][0].value
+               for s in src_sents]
+        elapsed = time.time() - start
+        print('per sentence : {:8.2f} sents/s'.format(len(src_sents) / elapsed), file=sys.stderr)
+
+        for batch_size in [int(b) for b in args['--batch-sizes'].split(',')]:
+            hyps = []
+            start = time.time()
+            for i in range(0, len(src_sents), batch_size):
+                hyps += model.ek_beam_search_batch(src_sents[i:i+batch_size], beam_size=beam_size,
+                                                   max_decoding_time_step=max_step, tlang=tlang)
+            elapsed = time.time() - start
+            diff = sum([1 for r, h in zip(ref, hyps) if r != h[0].value])
+            print('batch {:4d}   : {:8.2f} sents/s, {} of {} best hypotheses differ'.format(
+                batch_size, len(src_sents) / elapsed, diff, len(src_sents)), file=sys.stderr)
+
+
+def bench_shortlist(args):
+    """ Decode with the full vocabulary, with the target-language rows of the output projection and with
+    the shortlist of LEX_FILE, and report sentences per second and BLEU against REF_FILE (preprocessed
+    target sentences; separators are left out of BLEU).
+    """
+    model = nmt_model(args['--model'])
+    limit = int(args['--limit'])
+    src_sents = read_corpus(args['SRC_FILE'], source='src')[:limit]
+    refs = [[w for w in s if w not in model.sbol] for s in read_corpus(args['REF_FILE'], source='src')[:limit]]
+    tlang = args['--tlang']
+    beam_size = int(args['--beam-size'])
+    max_step = int(args['--max-decoding-time-step'])
+    batch_size = int(args['--batch-size'])
+    shortlist = Shortlist.load(args['LEX_FILE'], model.vocab)
+    assert shortlist.tlang == tlang, 'the table is for target language {}'.format(shortlist.tlang)
+
+    with torch.no_grad():
+        outs = {}
+        for mode in ['full', 'partition', 'shortlist']:
+            model.partition_output = mode == 'partition'
+            hyps = []
+            sizes = []
+            start = time.time()
+            for i in range(0, len(src_sents), batch_size):
+                batch = src_sents[i:i+batch_size]
+                vocab_ids = vocab_mask = None
+                if mode == 'shortlist':
+                    vocab_ids, vocab_mask = shortlist.candidates(batch, model.device)
+                    sizes.append(len(vocab_ids))
+                elif mode == 'partition':
+                    sizes.append(len(model.output_vocab(batch, tlang)[0]))
+                hyps += [h[0].value for h in model.ek_beam_search_batch(batch, beam_size=beam_size,
+                         max_decoding_time_step=max_step, tlang=tlang, vocab_ids=vocab_ids, vocab_mask=vocab_mask)]
+            elapsed = time.time() - start
+            outs[mode] = hyps
+            bleu = corpus_bleu(refs, [[w for w in h if w not in model.sbol] for h in hyps])
+            size = sum(sizes) / len(sizes) if len(sizes) > 0 else len(model.vocab.vocs)
+            print('{:9s} : {:8.2f} sents/s, BLEU {:6.2f}, {:8.0f} output tokens scored'.format(
+                mode, len(src_sents) / elapsed, bleu, size), file=sys.stderr)
+        for mode in ['partition', 'shortlist']:
+            diff = sum([1 for a, b in zip(outs['full'], outs[mode]) if a != b])
+            print('{}: {} of {} best hypotheses differ from full'.format(mode, diff, len(src_sents)), file=sys.stderr)
+
+
+def bench_steps(args):
+    """ Decode with and without the length limits and early stop of beam search (NMT.early_stop), and
+    report decoder time steps, sentences per second, BLEU against REF_FILE if given and how many best
+    hypotheses differ.
+    """
+    model = nmt_model(args['--model'])
+    src_sents = read_corpus(args['SRC_FILE'], source='src')[:int(args['--limit'])]
+    refs = None
+    if args['REF_FILE']:
+        refs = [[w for w in s if w not in model.sbol] for s in read_corpus(args['REF_FILE'], source='src')[:int(args['--limit'])]]
+    tlang = args['--tlang']
+    beam_size = int(args['--beam-size'])
+    max_step = int(args['--max-decoding-time-step'])
+    batch_size = int(args['--batch-size'])
+
+    with torch.no_grad():
+        outs = {}
+        for early_stop in [False, True]:
+            model.early_stop = early_stop
+            hyps = []
+            steps = 0
+            start = time.time()
+            for i in range(0, len(src_sents), batch_size):
+                info = {}
+                hyps += [h[0].value for h in model.ek_beam_search_batch(src_sents[i:i+batch_size], beam_size=beam_size,
+                         max_decoding_time_step=max_step, tlang=tlang, info=info)]
+                steps += info['steps']
+            elapsed = time.time() - start
+            outs[early_stop] = hyps
+            bleu = '' if refs is None else ', BLEU {:6.2f}'.format(
+                corpus_bleu(refs, [[w for w in h if w not in model.sbol] for h in hyps]))
+            print('early stop {:5s}: {:8d} steps, {:8.2f} sents/s{}'.format(str(early_stop), steps, len(src_sents) / elapsed, bleu),
+                  file=sys.stderr)
+        diff = sum([1 for a, b in zip(outs[False], outs[True]) if a != b])
+        print('{} of {} best hypotheses differ'.format(diff, len(src_sents)), file=sys.stderr)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def bench_profiles(args):
+    """ Translate a held-out set with every decoding profile, --request-size sentences per call as a
+    request would, and report p50/p95 latency per request, source tokens per second and BLEU against
+    REF_FILE (preprocessed target sentences; separators are left out of BLEU).
+    """
+    model = nmt_model(args['--model'])
+    trns = Trns(model, batch_size=int(args['--batch-size']))
+    limit = int(args['--limit'])
+    src_sents = read_corpus(args['SRC_FILE'], source='src')[:limit]
+    refs = [[w for w in s if w not in model.sbol] for s in read_corpus(args['REF_FILE'], source='src')[:limit]]
+    tlang = args['--tlang']
+    size = int(args['--request-size'])
+    tokens = sum([len([w for w in s if w not in model.sbol]) for s in src_sents])
+
+    for profile in sorted(DECODING_PROFILES):
+        hyps = []
+        latency = []
+        start = time.time()
+        for i in range(0, len(src_sents), size):
+            t = time.time()
+            hyps += trns.translate(src_sents[i:i+size], tlang, profile=profile)
+            latency.append(time.time() - t)
+        elapsed = time.time() - start
+        bleu = corpus_bleu(refs, [[w for w in h.split(' ') if w not in model.sbol] for h in hyps])
+        print('{:9s}: p50 {:7.3f}s, p95 {:7.3f}s, {:8.2f} tokens/s, BLEU {:6.2f}'.format(
+            profile, percentile(latency, 0.5), percentile(latency, 0.95), tokens / elapsed, bleu), file=sys.stderr)
+
+
+def bench_calibrate(args):
+    """ Calibrate the gate of the 'hybrid' profile on a dev set: decode it with greedy and with beam search,
+    and pick the lowest min_score (most greedy outputs kept) whose BLEU against REF_FILE is within
+    --max-bleu-loss of beam search alone. The length ratio bounds of the profile are kept.
+    """
+    model = nmt_model(args['--model'])
+    trns = Trns(model, batch_size=int(args['--batch-size']))
+    limit = int(args['--limit'])
+    src_sents = read_corpus(args['SRC_FILE'], source='src')[:limit]
+    refs = [[w for w in s if w not in model.sbol] for s in read_corpus(args['REF_FILE'], source='src')[:limit]]
+    tlang = args['--tlang']
+    settings = DECODING_PROFILES['hybrid']
+    max_step = settings['max_decoding_time_step']
+
+    def tokens(sent):
+        return [w for w in sent.split(' ') if w not in model.sbol]
+
+    greedy = trns.greedy_search(model, src_sents, max_step, tlang)[0]
+    beam = [' '.join(h[0].value) for h in trns.beam_search(model, src_sents, settings['beam_size'], max_step, tlang)[0]]
+    beam_bleu = corpus_bleu(refs, [tokens(s) for s in beam])
+    # the length gate alone
+    length_ok = [trns.confident(x, sent, 0., tlang, dict(settings, min_score=-float('inf')))
+                 for x, (sent, _) in zip(src_sents, greedy)]
+
+    scores = [score for _, score in greedy]
+    thresholds = sorted(set([percentile(scores, q / 100.) for q in range(101)] + [max(scores) + 1.]))
+    min_score = thresholds[-1]
+    print('beam     : BLEU {:6.2f}'.format(beam_bleu), file=sys.stderr)
+    for thr in thresholds:
+        kept = [ok and score >= thr for ok, score in zip(length_ok, scores)]
+        bleu = corpus_bleu(refs, [tokens(g if k else b) for (g, _), b, k in zip(greedy, beam, kept)])
+        print('min_score {:8.4f}: {:5.1f}% greedy, BLEU {:6.2f}'.format(thr, 100. * sum(kept) / len(kept), bleu),
+              file=sys.stderr)
+        if beam_bleu - bleu <= float(args['--max-bleu-loss']):
+            min_score = thr
+            break
+    json.dump({'min_score': min_score}, open(args['CALIBRATION_FILE'], 'w'))
+    print('min_score {} saved to {}'.format(min_score, args['CALIBRATION_FILE']), file=sys.stderr)
+
+
+def bench_greedy(args):
+    """ Regression check of batched `greedy_search`: decode the same sentences one by one and in batches,
+    report sentences per second, outputs that differ and the largest score difference.
+    """
+    model = nmt_model(args['--model'])
+    src_sents = read_corpus(args['SRC_FILE'], source='src')[:int(args['--limit'])]
+    tlang = args['--tlang']
+    slang = 'en' if tlang == 'ko' else 'ko'
+    max_step = int(args['--max-decoding-time-step'])
+
+    with torch.no_grad():
+        outs = []
+        for batch_size in [1, int(args['--batch-size'])]:
+            sents, scores = [], []
+            start = time.time()
+            for i in range(0, len(src_sents), batch_size):
+                s, sc = model.greedy_search(src_sents[i:i+batch_size], max_decoding_time_step=max_step, slang=slang, tlang=tlang)
+                sents += s
+                scores += sc
+            elapsed = time.time() - start
+            outs.append((sents, scores))
+            print('batch {:3d}: {:8.2f} sents/s'.format(batch_size, len(src_sents) / elapsed), file=sys.stderr)
+    (one_sents, one_scores), (sents, scores) = outs
+    diff = sum([1 for a, b in zip(one_sents, sents) if a != b])
+    score_diff = max([abs(a - b) for a, b in zip(one_scores, scores)] + [0.])
+    print('{} of {} outputs differ, largest score difference {:.2e}'.format(diff, len(src_sents), score_diff), file=sys.stderr)
+
+
+def bench_script(args):
+    """ Per-step latency of the decoder step saved by `nmt_script.py` against the eager model, on random
+    inputs, and the largest difference of their outputs.
+    """
+    model = nmt_model(args['--model'])
+    scripted = torch.jit.load(args['SCRIPT_FILE'], map_location=model.device)
+    tlang = args['--tlang']
+    step = getattr(scripted, 'step_' + tlang)
+    n_steps = int(args['--steps'])
+
+    with torch.no_grad():
+        for batch_size in [int(b) for b in args['--batch-sizes'].split(',')]:
+            _, step_inputs = example_inputs(model, tlang, batch_size, int(args['--src-len']))
+            times = []
+            for run in [lambda: eager_step(model, tlang, step_inputs), lambda: step(*step_inputs)]:
+                run()   # warm up
+                start = time.time()
+                for _ in range(n_steps):
+                    run()
+                times.append((time.time() - start) / n_steps * 1000)
+            diff = max_diff(step(*step_inputs), eager_step(model, tlang, step_inputs))
+            print('batch {:3d}: eager {:7.3f} ms/step, scripted {:7.3f} ms/step, largest difference {:.2e}'
+                  .format(batch_size, times[0], times[1], diff), file=sys.stderr)
+
+
+def bench_quantize(args):
+    """ The float model against its dynamic int8 copy (get_model.quantize): weight size, per-step latency on
+    random inputs, and sentences per second and BLEU on the dev sets DEV (comma separated
+    tlang:source_file:reference_file) with the 'quality' profile. The int8 model is accepted if it loses at
+    most --max-bleu-loss BLEU on every dev set; the decision goes to DECISION_FILE, which the server reads
+    from NMT_QUANTIZE (see get_model.load_quantized).
+    """
+    model = nmt_model(args['--model'])
+    qmodel = quantize(model)
+    if qmodel is None:
+        print('this torch has no dynamic quantization', file=sys.stderr)
+        return
+    dev = [tuple(d.split(':')) for d in args['DEV'].split(',')]
+    limit = int(args['--limit'])
+    n_steps = int(args['--steps'])
+
+    bleu = {}
+    for name, m in [('float', model), ('int8', qmodel)]:
+        print('{:5s}: {:8.1f} MB'.format(name, model_size(m) / 2**20), file=sys.stderr)
+        with torch.no_grad():
+            for batch_size in [int(b) for b in args['--batch-sizes'].split(',')]:
+                _, step_inputs = example_inputs(m, dev[0][0], batch_size, int(args['--src-len']))
+                eager_step(m, dev[0][0], step_inputs)   # warm up
+                start = time.time()
+                for _ in range(n_steps):
+                    eager_step(m, dev[0][0], step_inputs)
+                print('       batch {:3d}: {:7.3f} ms/step'.format(batch_size, (time.time() - start) / n_steps * 1000),
+                      file=sys.stderr)
+        start = time.time()
+        bleu[name] = dev_bleu([m], dev, batch_size=int(args['--batch-size']), limit=limit)[0]
+        elapsed = time.time() - start
+        print('       {:8.2f} s for the dev sets, BLEU {}'.format(elapsed, ' '.join(['{:6.2f}'.format(b) for b in bleu[name]])),
+              file=sys.stderr)
+
+    max_bleu_loss = float(args['--max-bleu-loss'])
+    accepted = all([b - q <= max_bleu_loss for b, q in zip(bleu['float'], bleu['int8'])])
+    json.dump({'model': os.path.basename(args['--model']), 'model_hash': weights_hash(args['--model']),
+               'int8': accepted, 'max_bleu_loss': max_bleu_loss,
+               'dev': [list(d) for d in dev], 'bleu': bleu}, open(args['DECISION_FILE'], 'w'))
+    print('int8 {} (largest BLEU loss allowed {}), saved to {}'.format('accepted' if accepted else 'rejected',
+          max_bleu_loss, args['DECISION_FILE']), file=sys.stderr)
+
+
+def main():
+    args = docopt(__doc__)
+    if args['beam']:
+        bench_beam(args)
+    elif args['shortlist']:
+        bench_shortlist(args)
+    elif args['steps']:
+        bench_steps(args)
+    elif args['profiles']:
+        bench_profiles(args)
+    elif args['calibrate']:
+        bench_calibrate(args)
+    elif args['greedy']:
+        bench_greedy(args)
+    elif args['script']:
+        bench_script(args)
+    elif args['quantize']:
+        bench_quantize(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,110 @@
+import hashlib
+import io
+import json
+import os
+import sys
 import torch
+import torch.nn as nn
 from trns.vocab import Vocab, get_wid2cid
 from trns.nmt_model import NMT
 from trns.preproc_En import Pre_en
 from trns.preproc_kor import preproc_ko2en
 from trns.trns_koren import Trns
+from trns.shortlist import Shortlist
+from trns.utils import read_corpus, corpus_bleu
 
-def trns_model():
-    pre_en = Pre_en()
-    pre_ko = preproc_ko2en()
+def nmt_model(model_path='trns/model_bi_1105'):
     vocab_trns = Vocab.load('trns/vocab.json')
     wid2cid = get_wid2cid()
     model = NMT(vocab=vocab_trns, embed_size=300, hidden_size=300, char_size=85, wid2cid=wid2cid, dropout_rate=0.0)
-    model.load_state_dict(torch.load('trns/model_bi_1105', map_location=lambda storage, loc: storage))
+    model.load_state_dict(torch.load(model_path, map_location=lambda storage, loc: storage))
     model.eval()
-    trns = Trns(model)
-    
+    precompute(model)
+    return model
+
+def precompute(model):
+    with torch.no_grad():
+        for tlang in ['ko', 'en']:
+            # shared by all decoding calls, and by forked workers
+            model.sbol_states(tlang)
+            model.output_block(tlang)
+
+def quantize(model):
+    """ Dynamic int8 copy of a model: its LSTMs and Linear layers keep int8 weights and quantize their
+    inputs on the fly. target_vocab_projection stays float, the decoders score blocks of its rows
+    (see NMT.output_block).
+    @returns qmodel (NMT): None if this torch has no dynamic quantization
+    """
+    if not hasattr(torch, 'quantization') or not hasattr(torch.quantization, 'quantize_dynamic'):
+        return None
+    names = set([name for name, m in model.named_modules()
+                 if isinstance(m, (nn.LSTM, nn.Linear)) and name != 'target_vocab_projection'])
+    qmodel = torch.quantization.quantize_dynamic(model, names, dtype=torch.qint8)
+    qmodel.quantized = True
+    qmodel.eval()   # drops the caches copied from the float model
+    precompute(qmodel)
+    return qmodel
+
+def model_size(model):
+    """ Bytes of the serialized weights, packed int8 weights included.
+    """
+    f = io.BytesIO()
+    torch.save(model.state_dict(), f)
+    return f.tell()
+
+def dev_bleu(models, dev, batch_size=32, limit=200):
+    """ BLEU of models on dev sets, decoded with the 'quality' profile.
+    @param models (List[NMT]): models sharing a vocabulary
+    @param dev (List[Tuple[str, str, str]]): (tlang, source file, reference file) of preprocessed sentences
+    @returns bleu (List[List[float]]): BLEU of every model on every dev set
+    """
+    sbol = models[0].sbol
+    sets = []
+    for tlang, src_file, ref_file in dev:
+        src_sents = read_corpus(src_file, source='src')[:limit]
+        refs = [[w for w in s if w not in sbol] for s in read_corpus(ref_file, source='src')[:limit]]
+        sets.append((tlang, src_sents, refs))
+    return [[corpus_bleu(refs, [[w for w in h.split(' ') if w not in sbol]
+                                for h in Trns(model, batch_size=batch_size).translate(src_sents, tlang)])
+             for tlang, src_sents, refs in sets] for model in models]
+
+def weights_hash(model_path):
+    """ Hash of a model file, so that a decision is not reused for other weights saved under the same name.
+    """
+    h = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+def load_quantized(model, decision_file, model_path='trns/model_bi_1105'):
+    """ The int8 copy of a model if `bench.py quantize` accepted it for these weights, else the model.
+    @param decision_file (str): file written by `bench.py quantize`
+    """
+    decision = json.load(open(decision_file, 'r'))
+    if decision.get('model_hash') != weights_hash(model_path) or not decision['int8']:
+        print('int8 quantization not used: not accepted for {} in {}'.format(os.path.basename(model_path), decision_file),
+              file=sys.stderr)
+        return model
+    qmodel = quantize(model)
+    if qmodel is None:
+        print('int8 quantization not used: not supported by this torch', file=sys.stderr)
+        return model
+    return qmodel
+
+def trns_model(shortlist_files=(), quantize_file=None, eojeol_cache=100000, eojeol_warm=None):
+    """
+    @param shortlist_files (List[str]): lexical tables built by trns/shortlist.py, at most one per target language
+    @param quantize_file (str): decision of `bench.py quantize`; the int8 model is used if it was accepted
+    @param eojeol_cache (int): size of the Korean eojeol segmentation cache, 0 for none
+    @param eojeol_warm (str): its warm-start file, built by trns/preproc_kor.py
+    """
+    pre_en = Pre_en()
+    pre_ko = preproc_ko2en(eojeol_cache, eojeol_warm)
+    model = nmt_model()
+    if quantize_file:
+        model = load_quantized(model, quantize_file)
+    shortlists = [Shortlist.load(f, model.vocab) for f in shortlist_files]
+    trns = Trns(model, shortlists={s.tlang: s for s in shortlists})
+
     return pre_en, pre_ko, trns
@@ -9,6 +9,7 @@ Sahil Chopra <schopra8@stanford.edu>
 """
 from collections import namedtuple
 import sys
+import time
 from typing import List, Tuple, Dict, Set, Union
 import torch
 import torch.nn as nn
@@ -22,6 +23,7 @@ from trns.model_embeddings import ModelEmbeddings
 from trns.char_embeddings import CharEmbeddings
 
 Ehypothesis = namedtuple('Ehypothesis', ['value', 'score'])
+# u_score: sum of the squared log probabilities of the tokens, a_score: (1, src_len) attention summed over the steps
 Khypothesis = namedtuple('Khypothesis', ['value', 'xo', 'score', 'u_score', 'a_score'])
 
 
@@ -55,6 +57,15 @@ class NMT(nn.Module):
         self.ko_start = 54621
         self.xo_weight = 1.0
         self.notEn = get_notEn(self.vocab)
+        self.sbol_cache = {}    # (tlang, device) -> sub-coder states after the separators, see sbol_states
+        self.partition_output = False   # decoding scores only the target-language rows of the output projection
+        self.len_ratio = {'en': 1.06, 'ko': 0.94}   # expected target length / source length, by source language
+        self.early_stop = False # beam search stops a sentence at max_target_len, or when it cannot change the result;
+                                # it changes outputs, compare with bench.py steps before turning it on
+        self.max_len_factor = 2.0
+        self.max_len_slack = 10
+        self.output_cache = {}  # (tlang, device) -> target-language rows of the output projection, see output_block
+        self.quantized = False  # LSTMs and Linear layers are dynamic int8, see get_model.quantize
         #self.sbol_padded = self.vocab.vocs.to_input_tensor([['_'],['^'],['`']], device=self.device)
 
         # default values
@@ -710,6 +721,88 @@ class NMT(nn.Module):
         
         return X_way, (h,c)
 
+    def sbol_states(self, tlang):
+        """ Sub-coder outputs for the separator symbols self.sbol, which start every target word.
+        They only depend on the weights and the target language, so in eval mode they are computed once
+        per direction and device and shared by all decoding calls.
+        @param tlang (str): target language
+        @returns sbol_init (List): [''] + parallel_beam_encode2 output (X_way, (h, c)) per separator, indexed by xo
+        @returns sbol_h (torch.Tensor): h of sbol_init stacked by xo, shape (len(self.sbol)+1, hidden); row 0 unused
+        @returns sbol_c (torch.Tensor): c of sbol_init stacked the same way
+        """
+        key = (tlang, self.device)
+        if not self.training and key in self.sbol_cache:
+            return self.sbol_cache[key]
+
+        sbolX = [torch.tensor([self.vocab.vocs[w]], dtype=torch.long, device=self.device) for w in self.sbol]      
+        sbol_init = ['']+[self.parallel_beam_encode2(sb, tlang) for sb in sbolX]
+        sbol_h = torch.cat([torch.zeros_like(sbol_init[1][1][0][0])] + [sb[1][0][0] for sb in sbol_init[1:]], 0)
+        sbol_c = torch.cat([torch.zeros_like(sbol_init[1][1][1][0])] + [sb[1][1][0] for sb in sbol_init[1:]], 0)
+
+        states = (sbol_init, sbol_h, sbol_c)
+        if not self.training:
+            self.sbol_cache[key] = states
+        return states
+
+    def output_block(self, tlang):
+        """ Rows of target_vocab_projection a translation into tlang can use. The vocabulary holds the
+        English tokens below ko_start and the Korean ones from ko_start on; tokens below ko_start that are not
+        English words (punctuation, digits, special tokens) are shared, and so are English words above it.
+        Cached in eval mode like sbol_states.
+        @param tlang (str): target language
+        @returns vocab_ids (torch.Tensor): vocabulary ids of the block, shape (n,)
+        @returns weight (torch.Tensor): their rows of the projection, shape (n, hidden)
+        @returns in_block (torch.Tensor): 1 for the vocabulary ids in the block, shape (vocab size,)
+        """
+        key = (tlang, self.device)
+        if not self.training and key in self.output_cache:
+            return self.output_cache[key]
+
+        ids = torch.arange(len(self.vocab.vocs), dtype=torch.long, device=self.device)
+        not_en = torch.tensor([self.notEn[i] for i in range(len(self.vocab.vocs))], device=self.device) > 0
+        if tlang == 'ko':
+            in_block = (ids >= self.ko_start) | not_en
+        else:
+            in_block = (ids < self.ko_start) | (not_en == 0)
+        vocab_ids = in_block.nonzero().squeeze(1)
+
+        block = (vocab_ids, self.target_vocab_projection.weight.index_select(0, vocab_ids), in_block)
+        if not self.training:
+            self.output_cache[key] = block
+        return block
+
+    def output_vocab(self, src_sents, tlang):
+        """ Output rows for decoding src_sents into tlang: the tlang block of output_block, and the source
+        tokens outside it, which a translation may copy (e.g. names and acronyms in Latin script). A sentence
+        may only copy its own tokens, so that it is translated the same whatever it is decoded with.
+        @returns vocab_ids (torch.Tensor): vocabulary ids, shape (n,); column i of the scores is vocab_ids[i]
+        @returns weight (torch.Tensor): their rows of target_vocab_projection, shape (n, hidden)
+        @returns allowed (torch.Tensor): 1 for the columns each sentence may output, shape (b, n); None if
+                all sentences may output all columns
+        """
+        vocab_ids, weight, in_block = self.output_block(tlang)
+        src_ids = torch.tensor(sorted(set([self.vocab.vocs[w] for s in src_sents for w in s])), dtype=torch.long, device=self.device)
+        extra = src_ids[in_block[src_ids] == 0]
+        if len(extra) == 0:
+            return vocab_ids, weight, None
+        sent_ids = torch.zeros((len(src_sents), len(vocab_ids) + len(extra)), dtype=torch.long, device=self.device)
+        sent_ids[:, :len(vocab_ids)] = 1
+        pos = dict([(w, len(vocab_ids) + j) for j, w in enumerate(extra.tolist())])
+        for i, s in enumerate(src_sents):
+            for w in s:
+                j = pos.get(self.vocab.vocs[w])
+                if j is not None:
+                    sent_ids[i, j] = 1
+        vocab_ids = torch.cat([vocab_ids, extra])
+        weight = torch.cat([weight, self.target_vocab_projection.weight.index_select(0, extra)], 0)
+        return vocab_ids, weight, sent_ids > 0
+
+    def train(self, mode=True):
+        # the separator states and output blocks change with the weights
+        self.sbol_cache = {}
+        self.output_cache = {}
+        return super(NMT, self).train(mode)
+
     def en_encode_origin(self, source_padded: torch.Tensor, source_lengths: List[int]) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
         """ Apply the encoder to source sentences to obtain encoder hidden states.
             Additionally, take the final states of the encoder and project them to obtain initial states for decoder.
@@ -1029,7 +1122,7 @@ class NMT(nn.Module):
 
         # Set e_t to -inf where enc_masks has 1
         if enc_masks is not None:
-            e_t.data.masked_fill_(enc_masks.byte(), -float('inf'))
+            e_t.data.masked_fill_(enc_masks == 1, -float('inf'))
 
         ### YOUR CODE HERE (~6 Lines)
         ### TODO:
@@ -1092,218 +1185,49 @@ class NMT(nn.Module):
         return enc_masks.to(self.device)
 
 
-    def ek_beam_search(self, src_sent: List[str], beam_size: int=5, max_decoding_time_step: int=70, tlang:str='en') -> List[Khypothesis]:
-        """ Given a single source sentence, perform beam search, yielding translations in the target language.
-        @param src_sent (List[str]): a single source sentence (words)
-        @param beam_size (int): beam size
-        @param max_decoding_time_step (int): maximum number of time steps to unroll the decoding RNN
-        @returns hypotheses (List[Hypothesis]): a list of hypothesis, each hypothesis has two fields:
-                value: List[str]: the decoded target sentence, represented as a list of words
-                score: float: the log-likelihood of the target sentence
+    def rescore_hypotheses(self, completed_hypotheses: List[Khypothesis], src_len: int, slang: str) -> List[Khypothesis]:
+        """ Sort completed hypotheses by score, put the best one under the length-normalized GNMT score
+        with coverage penalty first and restore its separator symbols from xo.
+        @param completed_hypotheses (List[Khypothesis]): completed hypotheses of one sentence
+        @param src_len (int): source sentence length
+        @param slang (str): source language
+        @returns hypotheses (List[Khypothesis]): hypotheses, the first one is the translation
         """
- 
-        #source_padded, source_lengths = self.parallel_encode(src_sent) 
-
-        #src_sents_var =  source_padded
-        #src_len = source_lengths[0]
-
-        slang = 'en' if tlang == 'ko' else 'ko'
-
-        sbolX = [torch.tensor([self.vocab.vocs[w]], dtype=torch.long, device=self.device) for w in self.sbol]      
-        sbol_init = ['']+[self.parallel_beam_encode2(sb,lang=tlang) for sb in sbolX]
-
-        src_sents_var, src_len = self.parallel_encode_new(src_sent, slang) 
-        if slang == 'en':
-            src_encodings, dec_init_vec = self.en_encode(src_sents_var, src_len)
-        else:
-            src_encodings, dec_init_vec = self.ko_encode(src_sents_var, src_len)
-
-        if tlang =='ko':
-            #src_encodings, dec_init_vec = self.en2_encode(src_sents_var, src_len)
-            src_encodings_att_linear = self.ko_att_projection(src_encodings)
-        else:
-            #src_encodings, dec_init_vec = self.ko_encode(src_sents_var, src_len)
-            src_encodings_att_linear = self.en_att_projection(src_encodings)
-
-        """
-        src_sents_var = self.vocab.vocs.to_input_tensor([src_sent], self.device)e
-        #src_encodings, dec_init_vec = self.encode(src_sents_var, [src_len])
-        src_encodings_att_linear = self.ko_att_projection(src_encodings)
-        """
-        h_tm1 = dec_init_vec
-        att_tm1 = torch.zeros(1, self.hidden_size, device=self.device)
-
-        eos_id = self.vocab.vocs['</s>']
-
-        hypotheses = [['<s>']]
-        xhypotheses = [[1]]  ###??????? 나중에 지워질 것이므로 값 의미 없음 
-        ahypotheses = [[]]
-        uhypotheses = [[]]
-        hyp_scores = torch.zeros(len(hypotheses), dtype=torch.float, device=self.device)
-        completed_hypotheses = []
-
-        t = 0
-        while len(completed_hypotheses) < beam_size and t < max_decoding_time_step:
-            t += 1
-            hyp_num = len(hypotheses)
-
-            exp_src_encodings = src_encodings.expand(hyp_num,
-                                                     src_encodings.size(1),
-                                                     src_encodings.size(2))  # shape (b, src_len, h*2)
-
-            exp_src_encodings_att_linear = src_encodings_att_linear.expand(hyp_num,
-                                                                           src_encodings_att_linear.size(1),
-                                                                           src_encodings_att_linear.size(2))
-
-            #y_tm1 = torch.tensor([self.vocab.vocs[hyp[-1]] for hyp in hypotheses], dtype=torch.long, device=self.device)
-            #y_t_embed = self.model_embeddings.target(y_tm1)                                # 수정된 부분
-            if t<2:
-                y_tm1 = torch.tensor([self.vocab.vocs[hyp[-1]] for hyp in hypotheses], dtype=torch.long, device=self.device)       
-                y_t_embed,next_init_vecs = self.parallel_beam_encode2(y_tm1, tlang, init_vecs=sbol_init[1][1]) # '<s>' 앞의  '_' 의 초기화 
-            else:
-                #####xxo = torch.tensor(prev_xos, dtype=torch.float,device=self.device)[:,-1].unsqueeze(0).unsqueeze(-1) #shape(1,batch,1)
-                #print( "prev_init_vecs[0][0].shape:{}".format( prev_init_vecs[0][0].shape))   
-                
-                prev_init_vecs = [torch.cat(vecs,0).unsqueeze(0) for vecs in prev_init_vecs]    # shape (h,c) = ((1,batch,h),(1,batch,h)
-                #prev_init_vecs = [torch.cat(vecs,0).unsqueeze(0) * xxo for vecs in prev_init_vecs]
-                #print( "prev_init_vecs[0].shape:{}, xxo.shape".format( prev_init_vecs[0].shape),xxo.shape)           
-                y_tm1 = torch.tensor([self.vocab.vocs[hyp[-1]] for hyp in hypotheses], dtype=torch.long, device=self.device)
-                y_t_embed, next_init_vecs = self.parallel_beam_encode2(y_tm1,tlang, init_vecs=prev_init_vecs)   # 수정된 부분
-
-            #y_t_embed = self.parallel_beam_encode(y_tm1)
-
-            #print(y_t_embed.shape, att_tm1.shape)
-
-            #x = torch.cat([y_t_embed.squeeze(0), att_tm1], dim=-1)
-            x = torch.cat([y_t_embed, att_tm1], dim=-1)
-
-            (h_t, cell_t), att_t, _, alpha_t  = self.step(x, h_tm1,
-                                                      exp_src_encodings, exp_src_encodings_att_linear, enc_masks=None, tlang=tlang)
-
-            # log probabilities over target words
-            """
-            if tlang == 'ko':
-                log_p_t = F.log_softmax(self.target_vocab_projection(att_t), dim=-1)   #att_t's shape = (batch,hidden)
-            else:
-                log_p_t = F.log_softmax(self.target_vocab_projection(att_t), dim=-1)  
-            """
-            log_p_t = F.log_softmax(self.target_vocab_projection(att_t), dim=-1)
-            log_p2, xos = F.log_softmax(self.target_ox_projection(att_t), dim=-1).max(-1)
-            
-            log_p2 = log_p2.unsqueeze(1).expand_as(log_p_t) * self.xo_weight   # 추가된 부분
-            #xos = xos.unsqueeze(0).unsqueeze(-1)  # 추가된 부분
-
-            #print("vecs, xos : {} {}".format(next_init_vecs[0].shape, xos.shape))
-            #next_init_vecs = [vecs * torch.tensor(xos,dtype=torch.float,device=self.device) for vecs in next_init_vecs]
-
-            live_hyp_num = beam_size - len(completed_hypotheses)
-            contiuating_hyp_scores = (hyp_scores.unsqueeze(1).expand_as(log_p_t) + log_p_t+log_p2).view(-1)
-            top_cand_hyp_scores, top_cand_hyp_pos = torch.topk(contiuating_hyp_scores, k=live_hyp_num)
-
-            prev_hyp_ids = top_cand_hyp_pos / len(self.vocab.vocs)
-            hyp_word_ids = top_cand_hyp_pos % len(self.vocab.vocs)
-
-            next_init_vecs = [next_vecs.squeeze(0) for next_vecs in next_init_vecs]
-
-            new_hypotheses = []
-            live_hyp_ids = []
-            new_hyp_scores = []
-            prev_xos = []
-            prev_init_vecs = [[],[]]
-            new_u_scores = []
-            new_a_scores = []
-
-            for prev_hyp_id, hyp_word_id, cand_new_hyp_score in zip(prev_hyp_ids, hyp_word_ids, top_cand_hyp_scores ):
-                prev_hyp_id = prev_hyp_id.item()
-                hyp_word_id = hyp_word_id.item()
-                cand_new_hyp_score = cand_new_hyp_score.item()
-
-                hyp_word = self.vocab.vocs.id2word[hyp_word_id]
-                new_hyp_sent = hypotheses[prev_hyp_id] + [hyp_word]
-                #print("len(hypotheses):{},len(xhypotheses):{}, prev_hyp_ids :{}, xos:{}".format(
-                #    len(hypotheses),len(xhypotheses),prev_hyp_ids, xos))
-                new_xo = xhypotheses[prev_hyp_id] + [xos[prev_hyp_id]]
-                new_u_score = uhypotheses[prev_hyp_id] + [log_p_t[prev_hyp_id,hyp_word_id].item()]
-                new_a_score = ahypotheses[prev_hyp_id] + [alpha_t[prev_hyp_id]]
-                if hyp_word == '</s>':
-                    completed_hypotheses.append(Khypothesis(value=new_hyp_sent[1:-1], 
-                                                           xo = new_xo[1:-1],
-                                                           score=cand_new_hyp_score,
-                                                           u_score=new_u_score,
-                                                           a_score=new_a_score)) #scalar or vector 선택할 것)
-                else:
-                    new_hypotheses.append(new_hyp_sent)
-                    live_hyp_ids.append(prev_hyp_id)   # to select (h_tm1, att_tm1)'s items matching new set
-                    new_hyp_scores.append(cand_new_hyp_score)
-                    prev_xos.append(new_xo)
-                    new_u_scores.append(new_u_score)
-                    new_a_scores.append(new_a_score)
-                    if new_xo[-1] < 1:
-                        prev_init_vecs[0].append(next_init_vecs[0][prev_hyp_id].unsqueeze(0))  #add batch array shape(hidden) = > (1,hidden) 
-                        prev_init_vecs[1].append(next_init_vecs[1][prev_hyp_id].unsqueeze(0))
-                    else:
-                        prev_init_vecs[0].append(sbol_init[new_xo[-1]][1][0].squeeze(0))    #  remove direction shape(1,1,hidden) =>(1,hidden)
-                        prev_init_vecs[1].append(sbol_init[new_xo[-1]][1][1].squeeze(0))                            
-
-            if len(completed_hypotheses) == beam_size:
-                break
-
-            live_hyp_ids = torch.tensor(live_hyp_ids, dtype=torch.long, device=self.device)
-            #h_tm1 = (h_t[live_hyp_ids], cell_t[live_hyp_ids])
-            h_t = h_t.transpose(1,0)[live_hyp_ids].transpose(1,0).contiguous()
-            cell_t = cell_t.transpose(1,0)[live_hyp_ids].transpose(1,0).contiguous()
-            h_tm1 = (h_t, cell_t)
-            att_tm1 = att_t[live_hyp_ids]
-
-            hypotheses = new_hypotheses
-            xhypotheses = prev_xos
-            hyp_scores = torch.tensor(new_hyp_scores, dtype=torch.float, device=self.device)
-            uhypotheses = new_u_scores
-            ahypotheses = new_a_scores
-
-        if len(completed_hypotheses) == 0:
-            completed_hypotheses.append(Khypothesis(value=hypotheses[0][1:],
-                                                   xo = prev_xos[0][1:],
-                                                   score=hyp_scores[0].item(),
-                                                   u_score=new_u_scores[0],
-                                                   a_score=new_a_scores[0]))
         completed_hypotheses.sort(key=lambda hyp: hyp.score, reverse=True)
 
         #print([w for w in completed_hypotheses[0].value][:20])
         #print([w for w in completed_hypotheses[0].xo][:20])
 
         best_score = -1000000.
-        rL = src_len[0] * (1.06 if slang=='en' else 0.94)
+        rL = src_len * self.len_ratio[slang]
         lk = rL//6
         rL = (sorted([len(hy.value) for hy in completed_hypotheses])[len(completed_hypotheses)//2]+rL)/2
         
-        print('\n')
         for i,v in enumerate(completed_hypotheses): 
             snl = len(v.value)  #sentence lenth
             rpb = 1.4e-05*snl**2 - 0.0043*snl + 0.82 if slang=='en' else 1.6e-05*snl**2 - 0.0037*snl + 0.84 #repeat penalty base
             rp = 5 * min(len(list(set(v.value))) / (snl+0.0001) - rpb, 0)
 
-            u_mean = sum([u**2 for u in v.u_score])/(snl+0.0001)
-            a_mean = 1.0*(sum(torch.log(torch.min(sum(v.a_score),torch.ones((1,src_len[0])).to(self.device)).squeeze(0))/src_len[0]))
+            u_mean = v.u_score/(snl+0.0001)
+            a_mean = self.coverage_score(v.a_score, src_len)
             
             #to_check = 1 * v.score/(snl+0.0001) - 4* a_mean - 1.0 * u_mean + rp
-            bx= 1.1
-            to_check = 1 * v.score/(max(bx-1,0.001)/bx+snl/bx)**1.0 + 0.9* a_mean  #from GNMT
+            to_check = 1 * v.score/self.length_norm(snl) + 0.9* a_mean  #from GNMT
             
             #print(f"to_check = {to_check}, score = {1 * v.score/(snl+0.0001)}, u_mean = {u_mean}, a_mean = {a_mean}, rp = {rp}")
 
             #to_check =  v.score/(snl+0.0001) + (-4*(snl/rL-1)**2 if snl/rL<1 else -0.05*(snl/rL-1)**2) + rp
             #to_check =  v.score/(snl+0.0001) + (-2*(snl/rL-1)**2+(snl/rL-1)*0.4 if snl/rL<1 else -0.2*(snl/rL-1)**2+(snl/rL-1)*0.4) + rp
-            #to_check = v.score/(snl+0.0001) + 0.7*len(list(set(v.value))) /(snl+0.0001) + 1.0 * ((snl*2/src_len[0])**0.4-1)
+            #to_check = v.score/(snl+0.0001) + 0.7*len(list(set(v.value))) /(snl+0.0001) + 1.0 * ((snl*2/src_len)**0.4-1)
             
             #to_check =  v.score/(len(v.xo)+0.0001) + 0.85*min(1-rL/(len(v.value)+0.0001),0)
             #bp = [min(1-rL/(len(v.value)+il+0.0001),0) for il in list(range(-ik,ik+1,1)) if len(v.value)+il>-1]
             #to_check =  v.score/(len(v.xo)+0.0001) + 0.3*sum(bp)/len(bp) #min(1-rL/(len(v.value)+0.0001),0)
             #if v.score/len(v.xo) > best_score:
             #if completed_hypotheses[i].score/len(completed_hypotheses[i].xo) > best_score:
-            #print("v.score {}, len of v.xo {} len of set {} src len {}".format(v.score, len(v.xo), len(list(set(v.value))), src_len[0]))
-            ###to_check = v.score/(len(v.xo)+0.0001) + 0.7*len(list(set(v.value))) / len(v.value) + 1.0 * ((len(v.value)*2/src_len[0])**0.4-1)
-            #to_check =  v.score/(len(v.xo)+0.0001) + (1.0*len(list(set(v.value))) / (len(v.value)+0.0001) + 0.5 * ((len(v.value)*2/(src_len[0]+0.0001))**0.4-1)) * min(src_len[0]/15,1)
+            #print("v.score {}, len of v.xo {} len of set {} src len {}".format(v.score, len(v.xo), len(list(set(v.value))), src_len))
+            ###to_check = v.score/(len(v.xo)+0.0001) + 0.7*len(list(set(v.value))) / len(v.value) + 1.0 * ((len(v.value)*2/src_len)**0.4-1)
+            #to_check =  v.score/(len(v.xo)+0.0001) + (1.0*len(list(set(v.value))) / (len(v.value)+0.0001) + 0.5 * ((len(v.value)*2/(src_len+0.0001))**0.4-1)) * min(src_len/15,1)
             if to_check > best_score: 
                 #best_score = completed_hypotheses[i].score/len(completed_hypotheses[i].xo)
                 #best_score = v.score/(len(v.xo)+0.0001)
@@ -1329,6 +1253,310 @@ class NMT(nn.Module):
 
         return completed_hypotheses
 
+
+    def length_norm(self, snl):
+        """ Length normalization of the rescoring score (from GNMT), for a length or a tensor of lengths. """
+        bx= 1.1
+        return (max(bx-1,0.001)/bx+snl/bx)**1.0
+
+    def coverage_score(self, a_score, src_len):
+        """ Coverage term of the rescoring score, 0 when every source token got a total attention of 1 or more.
+        @param a_score (torch.Tensor): attention summed over the steps, shape (1, src_len)
+        """
+        return 1.0*(sum(torch.log(torch.min(a_score,torch.ones((1,src_len)).to(self.device)).squeeze(0))/src_len))
+
+    def max_target_len(self, src_len, slang, max_decoding_time_step):
+        """ Length limit of a translation, from the expected length ratio of the direction.
+        """
+        return min(int(src_len * self.len_ratio[slang] * self.max_len_factor) + self.max_len_slack, max_decoding_time_step)
+
+    def ek_beam_search(self, src_sent: List[str], beam_size: int=5, max_decoding_time_step: int=70, tlang:str='en') -> List[Khypothesis]:
+        """ Given a single source sentence, perform beam search, yielding translations in the target language.
+        Decoded by `ek_beam_search_batch` as a batch of one.
+        @param src_sent (List[str]): a single source sentence (words)
+        @param beam_size (int): beam size
+        @param max_decoding_time_step (int): maximum number of time steps to unroll the decoding RNN
+        @returns hypotheses (List[Hypothesis]): a list of hypothesis, each hypothesis has two fields:
+                value: List[str]: the decoded target sentence, represented as a list of words
+                score: float: the log-likelihood of the target sentence
+        """
+        return self.ek_beam_search_batch([src_sent], beam_size=beam_size, max_decoding_time_step=max_decoding_time_step, tlang=tlang)[0]
+
+    def ek_beam_search_batch(self, src_sents: List[List[str]], beam_size: int=5, max_decoding_time_step: int=70, tlang:str='en',
+                             deadline: float=None, info: Dict=None, vocab_ids: torch.Tensor=None,
+                             vocab_mask: torch.Tensor=None) -> List[List[Khypothesis]]:
+        """ Beam search over a list of source sentences at once. The sentences are encoded in one pass and
+        the live hypotheses of all of them are decoded as one (batch*beam) decoder state; every sentence keeps
+        its own beam and finishes independently, with the same hypotheses as when it is decoded alone.
+
+        The beam state stays in tensors: every step records the chosen token ids, xo and backpointers of
+        the candidates, and hypotheses are only rebuilt from them at the end. The rescoring terms are kept
+        as running sums per hypothesis (attention coverage and squared token log probabilities), reordered
+        with the candidates, so memory stays O(beam * src_len) per sentence.
+
+        With early_stop, a sentence stops at max_target_len, and as soon as its best completed hypothesis
+        is certain to stay the best under the rescoring score: a live hypothesis only loses log probability,
+        its length normalization is at most that of the length limit and the coverage term is at most 0, which
+        bounds the score of all its continuations. The second stop keeps the best translation of the
+        length-limited search; the length limit itself can change it (a longer translation is cut off).
+
+        With a deadline the search degrades instead of running late: when the remaining time looks too short
+        for the remaining steps the beam is halved (down to 1), and when not even one more step fits the
+        search stops: unfinished sentences get their best completed hypothesis ('beam_cut'), or their best live
+        one without any ('truncated').
+
+        With vocab_ids (a vocabulary shortlist, see trns/shortlist.py) only those rows of the output
+        projection are scored, and the softmax is taken over them; otherwise, with partition_output, the
+        rows of the target language (see output_vocab). vocab_mask restricts every sentence to its own
+        candidates among them, so its translation does not depend on the sentences decoded with it.
+        @param src_sents (List[List[str]]): source sentences (words)
+        @param beam_size (int): beam size
+        @param max_decoding_time_step (int): maximum number of time steps to unroll the decoding RNN
+        @param tlang (str): target language
+        @param deadline (float): time.time() by which the search must end, None for no limit
+        @param info (Dict): if given, filled with 'steps', 'beam_size' (final beam size) and 'decoding', how
+                each sentence was decoded: 'beam', 'beam_reduced', 'beam_cut' or 'truncated'
+        @param vocab_ids (torch.Tensor): target vocabulary ids the search may output
+        @param vocab_mask (torch.Tensor): 1 for the vocab_ids each sentence may output, shape (b, n)
+        @returns hypotheses (List[List[Khypothesis]]): hypotheses of every sentence, in the order of src_sents
+        """
+        if len(src_sents) == 0:
+            return []
+
+        slang = 'en' if tlang == 'ko' else 'ko'
+
+        # pack_padded_sequence needs the longest sentence first
+        _, _, Z_sub = get_sents_lenth_new(src_sents, self.sbol)
+        s_len = [sum(z) for z in Z_sub]
+        sent_order = sorted(range(len(src_sents)), key=lambda i: s_len[i], reverse=True)
+        src_sents = [src_sents[i] for i in sent_order]
+        if vocab_mask is not None:
+            vocab_mask = vocab_mask.index_select(0, torch.tensor(sent_order, dtype=torch.long, device=vocab_mask.device))
+
+        # row xo of sbol_h / sbol_c is the sub-coder state after separator xo
+        sbol_init, sbol_h, sbol_c = self.sbol_states(tlang)
+
+        src_sents_var, src_len = self.parallel_encode_new(src_sents, slang) 
+        if slang == 'en':
+            src_encodings, dec_init_vec = self.en_encode(src_sents_var, src_len)
+        else:
+            src_encodings, dec_init_vec = self.ko_encode(src_sents_var, src_len)
+
+        if tlang =='ko':
+            src_encodings_att_linear = self.ko_att_projection(src_encodings)
+        else:
+            src_encodings_att_linear = self.en_att_projection(src_encodings)
+
+        enc_masks = self.generate_sent_masks(src_encodings, src_len)
+
+        b_size = len(src_sents)
+        eos_id = self.vocab.vocs['</s>']
+        if self.early_stop:
+            max_len = [self.max_target_len(l, slang, max_decoding_time_step) for l in src_len]
+        else:
+            max_len = [max_decoding_time_step] * b_size
+        max_len_t = torch.tensor(max_len, dtype=torch.long, device=self.device)
+        best_done = [-float('inf')] * b_size     # best rescoring score of the completed hypotheses
+        if vocab_ids is not None:
+            out_weight = self.target_vocab_projection.weight.index_select(0, vocab_ids)
+        elif self.partition_output:
+            vocab_ids, out_weight, vocab_mask = self.output_vocab(src_sents, tlang)
+        h_tm1 = dec_init_vec
+        att_tm1 = torch.zeros(b_size, self.hidden_size, device=self.device)
+
+        # live hypotheses of all sentences, grouped by sentence and best first within a sentence:
+        # hyp_sents[j] is the sentence of hypothesis j, hyp_slots[j] its rank in the sentence
+        hyp_sents = torch.arange(b_size, dtype=torch.long, device=self.device)
+        hyp_slots = torch.zeros(b_size, dtype=torch.long, device=self.device)
+        y_tm1 = torch.full((b_size,), self.vocab.vocs['<s>'], dtype=torch.long, device=self.device)
+        hyp_scores = torch.zeros(b_size, dtype=torch.float, device=self.device)
+        hyp_cands = None            # index of every live hypothesis among the candidates of the last step
+        hyp_cov = torch.zeros((b_size, 1, src_encodings.size(1)), dtype=torch.float, device=self.device)  # attention summed over the steps
+        hyp_u_sq = torch.zeros(b_size, dtype=torch.double, device=self.device)   # squared token log probabilities summed
+        completed = torch.zeros(b_size, dtype=torch.long, device=self.device)    # completed hypotheses per sentence
+
+        # per step, for every candidate kept: token id, xo, backpointer (candidate index at the step before);
+        # candidates that ended, with </s> or at the length limit, as (step, index, sentence, score, coverage, u_sq, eos)
+        tok_hist, xo_hist, bp_hist = [], [], []
+        ends = []
+        decoding = ['beam'] * b_size
+
+        t = 0
+        step_start = time.time()
+        while len(hyp_sents) > 0 and t < max_decoding_time_step:
+            if deadline is not None and t > 0:
+                now = time.time()
+                step_time = now - step_start
+                step_start = now
+                live_sents = hyp_sents.unique().tolist()
+                if now + step_time > deadline:
+                    # the hypotheses still live could have beaten the completed ones
+                    for b in live_sents:
+                        decoding[b] = 'truncated' if completed[b].item() == 0 else 'beam_cut'
+                    break
+                # steps still needed, guessed from the longest unfinished source sentence
+                steps_left = max([max_len[b] for b in live_sents]) - t
+                if beam_size > 1 and now + step_time * max(steps_left, 1) > deadline:
+                    beam_size = max(beam_size // 2, 1)
+                    for b in live_sents:
+                        decoding[b] = 'beam_reduced'
+            t += 1
+
+            exp_src_encodings = src_encodings.index_select(0, hyp_sents)                       # shape (b*beam, src_len, h*2)
+            exp_src_encodings_att_linear = src_encodings_att_linear.index_select(0, hyp_sents)
+            exp_enc_masks = enc_masks.index_select(0, hyp_sents)
+
+            if t<2:
+                prev_init_vecs = [sb.expand(1,b_size,self.hidden_size).contiguous() for sb in sbol_init[1][1]]  # '<s>' 앞의  '_' 의 초기화 
+            y_t_embed, next_init_vecs = self.parallel_beam_encode2(y_tm1, tlang, init_vecs=prev_init_vecs)
+
+            x = torch.cat([y_t_embed, att_tm1], dim=-1)
+
+            (h_t, cell_t), att_t, _, alpha_t  = self.step(x, h_tm1,
+                                                      exp_src_encodings, exp_src_encodings_att_linear, enc_masks=exp_enc_masks, tlang=tlang)
+
+            if vocab_ids is None:
+                log_p_t = F.log_softmax(self.target_vocab_projection(att_t), dim=-1)
+            elif vocab_mask is None:
+                log_p_t = F.log_softmax(F.linear(att_t, out_weight), dim=-1)     # over vocab_ids
+            else:
+                # over the candidates of the hypothesis' sentence
+                log_p_t = F.log_softmax(F.linear(att_t, out_weight).masked_fill(vocab_mask[hyp_sents] == 0, -float('inf')), dim=-1)
+            log_p2, xos = F.log_softmax(self.target_ox_projection(att_t), dim=-1).max(-1)
+            log_p2 = log_p2.unsqueeze(1).expand_as(log_p_t) * self.xo_weight
+            contiuating_hyp_scores = hyp_scores.unsqueeze(1).expand_as(log_p_t) + log_p_t + log_p2
+
+            # the best candidates of a sentence are among the best candidates of its hypotheses:
+            # top k per hypothesis, then top k over the (k*k) candidates of every sentence
+            k = beam_size
+            n_slots = hyp_slots.max().item() + 1     # can exceed k right after the beam was halved
+            row_scores, row_words = torch.topk(contiuating_hyp_scores, k=k, dim=-1)
+            cand_scores = torch.full((b_size, n_slots, k), -float('inf'), device=self.device)
+            cand_words = torch.zeros((b_size, n_slots, k), dtype=torch.long, device=self.device)
+            cand_hyps = torch.zeros((b_size, n_slots), dtype=torch.long, device=self.device)
+            cand_scores[hyp_sents, hyp_slots] = row_scores
+            cand_words[hyp_sents, hyp_slots] = row_words
+            cand_hyps[hyp_sents, hyp_slots] = torch.arange(len(hyp_sents), device=self.device)
+            top_cand_hyp_scores, top_cand_pos = torch.topk(cand_scores.view(b_size, -1), k=k, dim=-1)
+            top_cand_words = cand_words.view(b_size, -1).gather(1, top_cand_pos)
+            top_cand_hyps = cand_hyps.gather(1, top_cand_pos // k)
+
+            # a sentence keeps (beam size - completed hypotheses) candidates
+            live_hyp_num = (beam_size - completed).clamp(min=0)
+            keep = (torch.arange(k, device=self.device).unsqueeze(0) < live_hyp_num.unsqueeze(1)) & (top_cand_hyp_scores > -float('inf'))
+            keep = keep.view(-1).nonzero().squeeze(1)
+            c_sents = keep // k
+            c_hyps = top_cand_hyps.view(-1)[keep]
+            c_pos = top_cand_words.view(-1)[keep]      # column of log_p_t
+            c_words = c_pos if vocab_ids is None else vocab_ids[c_pos]
+            c_scores = top_cand_hyp_scores.view(-1)[keep]
+            c_xos = xos[c_hyps]
+
+            tok_hist.append(c_words)
+            xo_hist.append(c_xos)
+            bp_hist.append(hyp_cands[c_hyps] if hyp_cands is not None else c_hyps)
+            c_cov = hyp_cov[c_hyps] + alpha_t[c_hyps]
+            c_u_sq = hyp_u_sq[c_hyps] + log_p_t[c_hyps, c_pos].double()**2
+
+            is_end = c_words == eos_id
+            end_ids = is_end.nonzero().squeeze(1)
+            if len(end_ids) > 0:
+                ends.append((t, end_ids, c_sents[end_ids], c_scores[end_ids], c_cov[end_ids], c_u_sq[end_ids], True))
+                completed += torch.bincount(c_sents[end_ids], minlength=b_size)
+                if self.early_stop:
+                    for n, (b, score) in enumerate(zip(c_sents[end_ids].tolist(), c_scores[end_ids].tolist())):
+                        best_done[b] = max(best_done[b], float(score / self.length_norm(t - 1)
+                                           + 0.9 * self.coverage_score(c_cov[end_ids[n]][:, :src_len[b]], src_len[b])))
+
+            live_ids = (is_end == 0).nonzero().squeeze(1)
+            if len(live_ids) > 0:
+                # sentences whose best live hypothesis (the first) is at the length limit or cannot beat the best
+                # completed one stop here; at the limit without a completed hypothesis, the best live one ends it
+                l_sents = c_sents[live_ids]
+                first = torch.ones_like(l_sents)
+                first[1:] = l_sents[1:] != l_sents[:-1]
+                bound = c_scores[live_ids] / self.length_norm(max_len_t[l_sents].float())
+                best = torch.tensor(best_done, dtype=torch.float, device=self.device)[l_sents]
+                stop = (first > 0) & ((max_len_t[l_sents] <= t) | (bound < best))
+                stop_ids = stop.nonzero().squeeze(1)
+                if len(stop_ids) > 0:
+                    cut = stop_ids[completed[l_sents[stop_ids]] == 0]
+                    if len(cut) > 0:
+                        cut = live_ids[cut]
+                        ends.append((t, cut, c_sents[cut], c_scores[cut], c_cov[cut], c_u_sq[cut], False))
+                    stopped = torch.zeros(b_size, dtype=torch.long, device=self.device)
+                    stopped[l_sents[stop_ids]] = 1
+                    live_ids = live_ids[stopped[l_sents] == 0]
+            hyp_cands = live_ids
+            hyp_sents = c_sents[live_ids]
+            if len(hyp_sents) == 0:
+                break
+            counts = torch.bincount(hyp_sents, minlength=b_size)
+            hyp_slots = torch.arange(len(hyp_sents), device=self.device) - (counts.cumsum(0) - counts)[hyp_sents]
+            y_tm1 = c_words[live_ids]
+            hyp_scores = c_scores[live_ids]
+            hyp_cov = c_cov[live_ids]
+            hyp_u_sq = c_u_sq[live_ids]
+
+            # sub-coder state of the next token: carried on inside a word (xo 0), restarted after a separator
+            prev_hyps = c_hyps[live_ids]
+            live_xos = c_xos[live_ids]
+            after_sbol = (live_xos > 0).unsqueeze(1)
+            prev_init_vecs = [torch.where(after_sbol, sbol_h[live_xos], next_init_vecs[0][0].index_select(0, prev_hyps)).unsqueeze(0),
+                              torch.where(after_sbol, sbol_c[live_xos], next_init_vecs[1][0].index_select(0, prev_hyps)).unsqueeze(0)]
+
+            h_tm1 = (h_t.index_select(1, prev_hyps), cell_t.index_select(1, prev_hyps))
+            att_tm1 = att_t.index_select(0, prev_hyps)
+
+        # rebuild hypotheses from the history
+        tok_hist = [x.tolist() for x in tok_hist]
+        xo_hist = [x.tolist() for x in xo_hist]
+        bp_hist = [x.tolist() for x in bp_hist]
+
+        def backtrack(s, i):
+            """ Tokens and xo of candidate i at step s, first step first. """
+            words, xo = [], []
+            while s > 0:
+                words.append(self.vocab.vocs.id2word[tok_hist[s-1][i]])
+                xo.append(xo_hist[s-1][i])
+                i = bp_hist[s-1][i]
+                s -= 1
+            return words[::-1], xo[::-1]
+
+        completed_hypotheses = [[] for b in range(b_size)]
+        for s, end_ids, end_sents, end_scores, end_cov, end_u_sq, eos in ends:
+            for n, (i, b, score) in enumerate(zip(end_ids.tolist(), end_sents.tolist(), end_scores.tolist())):
+                words, xo = backtrack(s, i)
+                if eos:
+                    words, xo = words[:-1], xo[:-1]
+                completed_hypotheses[b].append(Khypothesis(value=words,
+                                                           xo = xo,
+                                                           score=score,
+                                                           u_score=end_u_sq[n].item(),
+                                                           a_score=end_cov[n][:, :src_len[b]]))
+
+        results = [None] * b_size
+        live_sents = hyp_sents.tolist()
+        for b in range(b_size):
+            if len(completed_hypotheses[b]) == 0:
+                j = live_sents.index(b)    # the best live hypothesis of the sentence comes first
+                words, xo = backtrack(t, hyp_cands[j].item())
+                completed_hypotheses[b].append(Khypothesis(value=words,
+                                                           xo = xo,
+                                                           score=hyp_scores[j].item(),
+                                                           u_score=hyp_u_sq[j].item(),
+                                                           a_score=hyp_cov[j][:, :src_len[b]]))
+            results[sent_order[b]] = self.rescore_hypotheses(completed_hypotheses[b], src_len[b], slang)
+
+        if info is not None:
+            info['steps'] = t
+            info['beam_size'] = beam_size
+            info['decoding'] = [None] * b_size
+            for b in range(b_size):
+                info['decoding'][sent_order[b]] = decoding[b]
+
+        return results
+
     
     def ke_beam_search(self, src_sent: List[str], beam_size: int=5, max_decoding_time_step: int=70) -> List[Ehypothesis]:
         """ Given a single source sentence, perform beam search, yielding translations in the target language.
@@ -1463,34 +1691,23 @@ class NMT(nn.Module):
         torch.save(params, path)
 
 
-    def greedy_search(self, src_sent: List[str], max_decoding_time_step: int=70, slang:str='en', tlang:str='ko', mapping:int=0) -> List[Khypothesis]:
-        """ Given a single source sentence, perform beam search, yielding translations in the target language.
-        @param src_sent (List[str]): a single source sentence (words)
-        @param beam_size (int): beam size
+    def greedy_search(self, src_sent: List[List[str]], max_decoding_time_step: int=70, slang:str='en', tlang:str='ko', mapping:int=0,
+                      compact_every: int=8):
+        """ Greedy search over a batch of source sentences.
+        The decoding state stays in tensors: tokens and xo go to buffers preallocated to the maximum length,
+        finished sentences are masked out and dropped from the decoder state only every compact_every steps.
+        @param src_sent (List[List[str]]): source sentences (words)
         @param max_decoding_time_step (int): maximum number of time steps to unroll the decoding RNN
-        @returns hypotheses (List[Hypothesis]): a list of hypothesis, each hypothesis has two fields:
-                value: List[str]: the decoded target sentence, represented as a list of words
-                score: float: the log-likelihood of the target sentence
+        @param compact_every (int): steps between removals of the finished sentences from the decoder state
+        @returns sents (List[str]): translations, tokens and separators joined by spaces, in the order of src_sent
+        @returns scores (List[float]): their log probabilities per token
         """
- 
-        #source_padded, source_lengths = self.parallel_encode(src_sent) 
-
-        #src_sents_var =  source_padded
-        #src_len = source_lengths[0]
-        #slang = 'en' if tlang == 'ko' else 'ko'
-
         slen = [(i, len([k for k in s if k not in self.sbol])) for i,s in enumerate(src_sent)]
         slen = sorted(slen, key = lambda x:x[1], reverse=True)
         src_sent = [src_sent[s[0]] for s in slen]
         sent_order = [ss[0] for ss in sorted([(i,s[0]) for i,s in enumerate(slen)], key = lambda x:x[1])]
-        #  1:3     2 7    1 2     3
-        #  2:7  => 4 5 => 2 4 =>  1
-        #  3:2     1 3    3 1     4   =>sent_order = [3,1,4,2]
-        #  4:5     3 2    4 3     2
 
-        sbolX = [torch.tensor([self.vocab.vocs[w]], dtype=torch.long, device=self.device) for w in self.sbol]      
-        sbol_init = ['']+[self.parallel_beam_encode2(sb, tlang) for sb in sbolX]
-        #print("mapping : {}".format(mapping))
+        sbol_init, sbol_h, sbol_c = self.sbol_states(tlang)
         src_sents_var, src_len = self.parallel_encode_new(src_sent, slang, mapping=mapping) 
         if slang == 'en':
             src_encodings, dec_init_vec = self.en_encode(src_sents_var, src_len)  
@@ -1503,184 +1720,103 @@ class NMT(nn.Module):
             src_encodings_att_linear = self.en_att_projection(src_encodings)
 
         enc_masks = self.generate_sent_masks(src_encodings, src_len)
+        if self.partition_output:
+            vocab_ids, out_weight, vocab_mask = self.output_vocab(src_sent, tlang)
 
-        """
-        src_sents_var = self.vocab.vocs.to_input_tensor([src_sent], self.device)e
-        #src_encodings, dec_init_vec = self.encode(src_sents_var, [src_len])
-        src_encodings_att_linear = self.ko_att_projection(src_encodings)
-        """
-        h_tm1 = dec_init_vec
         b_size = src_encodings.size(0)
-        att_tm1 = torch.zeros(b_size, self.hidden_size, device=self.device)
-
         eos_id = self.vocab.vocs['</s>']
-
-        #hypotheses = [['<s>'] * b_size]
-        sents = [['<s>']] * b_size
-        #print("sents : {}".format(len(sents)))
-        xos = [[1]] * b_size  ### '1' 은 사용되지 않고 버려짐 xos[1:-1]
-        #sents_id = [[[1]] * b_size]
-        live_sent_ids = torch.arange(b_size)
+        T = max_decoding_time_step
+        words = torch.zeros((b_size, T), dtype=torch.long, device=self.device)   # token of every sentence and step
+        xos = torch.zeros((b_size, T), dtype=torch.long, device=self.device)
+        lengths = torch.zeros(b_size, dtype=torch.long, device=self.device)      # steps until the sentence ended
+        final_scores = torch.zeros(b_size, dtype=torch.float, device=self.device)
+
+        # decoder state of the sentences in `live` (indices into the batch); some of them may have finished
+        live = torch.arange(b_size, dtype=torch.long, device=self.device)
+        # masks are comparison results, uint8 or bool depending on the torch version
+        done = torch.zeros(b_size, dtype=torch.long, device=self.device) > 0
         scores = torch.zeros(b_size, dtype=torch.float, device=self.device)
-        #completed_hypotheses = []
-        batch_done = [{} for i in range(b_size)]
-
-        t = 0
-        while len(live_sent_ids) > 0: # and t < max_decoding_time_step:
-            t += 1
-            #hyp_num = len(hypotheses)
-            """
-            exp_src_encodings = src_encodings.expand(hyp_num,
-                                                     src_encodings.size(1),
-                                                     src_encodings.size(2))  # shape (b, src_len, h*2)
-
-            exp_src_encodings_att_linear = src_encodings_att_linear.expand(hyp_num,
-                                                                           src_encodings_att_linear.size(1),
-                                                                           src_encodings_att_linear.size(2))
-            """
-            #y_tm1 = torch.tensor([self.vocab.vocs[hyp[-1]] for hyp in hypotheses], dtype=torch.long, device=self.device)
-            #y_t_embed = self.model_embeddings.target(y_tm1)                                # 수정된 부분
-            if t<2:
-                y_tm1 = torch.tensor([self.vocab.vocs[s[-1]] for s in sents], dtype=torch.long, device=self.device) #.squeeze(-1)      
-                #print("y_tm1.size()  : {}, sents[0][-1]: {}".format(y_tm1.size(), sents[0][-1]))
-                pre_init_vecs=[sb.expand(1,b_size,self.hidden_size).contiguous() for sb in sbol_init[1][1]]
-
-                y_t_embed,next_init_vecs = self.parallel_beam_encode2(y_tm1, tlang, init_vecs=pre_init_vecs)
-            else:
-                #####xxo = torch.tensor(prev_xos, dtype=torch.float,device=self.device)[:,-1].unsqueeze(0).unsqueeze(-1) #shape(1,batch,1)
-                #print( "prev_init_vecs[0][0].shape:{}".format( prev_init_vecs[0][0].shape))   
-                if len(prev_init_vecs[0]) >1:
-                    prev_init_vecs = [torch.cat(vecs,0).unsqueeze(0).contiguous() for vecs in prev_init_vecs]    # shape (h,c) = ((1,batch,h),(1,batch,h)
-                else:
-                    prev_init_vecs = [vecs[0].unsqueeze(0).contiguous() for vecs in prev_init_vecs] 
-                #prev_init_vecs = [torch.cat(vecs,0).unsqueeze(0) * xxo for vecs in prev_init_vecs]
-                #print( "prev_init_vecs[0].shape:{}, xxo.shape".format( prev_init_vecs[0].shape),xxo.shape)           
-                y_tm1 = torch.tensor([self.vocab.vocs[s[-1]] for s in sents], dtype=torch.long, device=self.device)
-                y_t_embed, next_init_vecs = self.parallel_beam_encode2(y_tm1,tlang, init_vecs=prev_init_vecs)   # 수정된 부분
-
-            #y_t_embed = self.parallel_beam_encode(y_tm1)
-
-            #print(y_t_embed.shape, att_tm1.shape)
+        h_tm1 = dec_init_vec
+        att_tm1 = torch.zeros(b_size, self.hidden_size, device=self.device)
+        y_tm1 = torch.full((b_size,), self.vocab.vocs['<s>'], dtype=torch.long, device=self.device)
+        prev_init_vecs = [sb.expand(1,b_size,self.hidden_size).contiguous() for sb in sbol_init[1][1]]  # '<s>' 앞의  '_' 의 초기화 
 
-            #x = torch.cat([y_t_embed.squeeze(0), att_tm1], dim=-1)
+        for t in range(1, T + 1):
+            y_t_embed, next_init_vecs = self.parallel_beam_encode2(y_tm1, tlang, init_vecs=prev_init_vecs)
             x = torch.cat([y_t_embed, att_tm1], dim=-1)
-
             (h_t, cell_t), att_t, _, alpha_t  = self.step(x, h_tm1,
                                                       src_encodings, src_encodings_att_linear, enc_masks=enc_masks, tlang=tlang)
 
-            # log probabilities over target words
-            log_p_t, wid = F.log_softmax(self.target_vocab_projection(att_t), dim=-1).max(-1)
-            """
-            if tlang == 'ko':
-                log_p_t, wid = F.log_softmax(self.target_vocab_projection(att_t), dim=-1).max(-1)   #att_t's shape = (batch,hidden)
+            if self.partition_output:
+                logits = F.linear(att_t, out_weight)
+                if vocab_mask is not None:
+                    logits = logits.masked_fill(vocab_mask[live] == 0, -float('inf'))
+                log_p_t, wid = F.log_softmax(logits, dim=-1).max(-1)
+                wid = vocab_ids[wid]
             else:
-                log_p_t, wid = F.log_softmax(self.target_vocab_projection(att_t), dim=-1).max(-1)  
-            """
+                log_p_t, wid = F.log_softmax(self.target_vocab_projection(att_t), dim=-1).max(-1)
             log_p2, xo = F.log_softmax(self.target_ox_projection(att_t), dim=-1).max(-1)  
             log_p2 = log_p2 * self.xo_weight          
-            #log_p2 = log_p2.unsqueeze(1).expand_as(log_p_t) * self.xo_weight   # 추가된 부분
-            #xos = xos.unsqueeze(0).unsqueeze(-1)  # 추가된 부분
-
-            #print("vecs, xos : {} {}".format(next_init_vecs[0].shape, xos.shape))
-            #next_init_vecs = [vecs * torch.tensor(xos,dtype=torch.float,device=self.device) for vecs in next_init_vecs]
-
-            #live_hyp_num = b_size - len(batch_done)
-            scores = (scores + log_p_t+log_p2)
-            #contiuating_hyp_scores = (hyp_scores.unsqueeze(1).expand_as(log_p_t) + log_p_t+log_p2).view(-1)
-            # top_cand_hyp_scores, top_cand_hyp_pos = torch.topk(contiuating_hyp_scores, k=live_hyp_num)
-
-            #prev_hyp_ids = list(range(len(wid))) #top_cand_hyp_pos / len(self.vocab.vocs)
-            #hyp_word_ids = wid #top_cand_hyp_pos % len(self.vocab.vocs)
-            next_init_vecs = [next_vecs.squeeze(0) for next_vecs in next_init_vecs]
-            sents  = [sents[i]+[self.vocab.vocs.id2word[wid[i].item()]] for i in range(len(live_sent_ids))]
-            #print("b_size :{},len(xos) : {}, wid.size() : {}, xo.size() : {}".format(b_size,len(xos),wid.size(), xo.size()))
-            xos = [xos[i] + [xo[i].item()] for i in range(len(live_sent_ids)) ]
-
-            prev_init_vecs = [[],[]]
-
-            if eos_id not in wid and t < max_decoding_time_step:
-                for i in range(len(live_sent_ids)):
-                    if xo[i].item() < 1:
-                        prev_init_vecs[0].append(next_init_vecs[0][i].unsqueeze(0))  #add batch array shape(hidden) = > (1,hidden) 
-                        prev_init_vecs[1].append(next_init_vecs[1][i].unsqueeze(0))
-                    else:
-                        prev_init_vecs[0].append(sbol_init[xo[i].item()][1][0].squeeze(0))    #  remove direction shape(1,1,hidden) =>(1,hidden)
-                        prev_init_vecs[1].append(sbol_init[xo[i].item()][1][1].squeeze(0)) 
-                h_tm1 = (h_t, cell_t)
-                att_tm1 = att_t
 
-            else:
-                #prev_init_vecs = [[],[]]
-                new_live_sent_ids = []
-                new_temp_ids = []
-                new_sents = []
-                new_xos = []
-
-                for i in range(len(live_sent_ids)):
-                    b_id = live_sent_ids[i]
-                    if wid[i].item() == eos_id or t == max_decoding_time_step:                       
-                        batch_done[b_id] = {'sent':sents[i][1:-1], 'xo':xos[i][1:-1], 'score':scores[i].item()}
-                    else:
-                        new_live_sent_ids.append(b_id)
-                        new_temp_ids.append(i)
-                        new_sents.append(sents[i])
-                        new_xos.append(xos[i])
-
-                        if xo[i].item() < 1:
-                            prev_init_vecs[0].append(next_init_vecs[0][i].unsqueeze(0))  #add batch array shape(hidden) = > (1,hidden) 
-                            prev_init_vecs[1].append(next_init_vecs[1][i].unsqueeze(0))
-                        else:
-                            prev_init_vecs[0].append(sbol_init[xo[i].item()][1][0].squeeze(0))    #  remove direction shape(1,1,hidden) =>(1,hidden)
-                            prev_init_vecs[1].append(sbol_init[xo[i].item()][1][1].squeeze(0)) 
-
-                live_ids = torch.tensor(new_temp_ids, dtype=torch.long, device=self.device)
-                #h_tm1 = (h_t[live_ids], cell_t[live_ids])
-                h_tm1 = (torch.cat((h_t[0][live_ids].unsqueeze(0),h_t[1][live_ids].unsqueeze(0)),0),
-                         torch.cat((cell_t[0][live_ids].unsqueeze(0),cell_t[1][live_ids].unsqueeze(0)),0))
-                att_tm1 = att_t[live_ids]
-                src_encodings = src_encodings[live_ids]
-                src_encodings_att_linear = src_encodings_att_linear[live_ids]
-                enc_masks = enc_masks[live_ids]
-                live_sent_ids = new_live_sent_ids
-                sents = new_sents
-                xos = new_xos
-                scores = scores[live_ids]
-
-            if len(live_sent_ids) == 0:
-                break
+            scores = torch.where(done, scores, scores + log_p_t + log_p2)
+            words[live, t-1] = wid
+            xos[live, t-1] = xo
+            ended = (done == 0) & ((wid == eos_id) | (t == T))
+            if ended.any():
+                ended_ids = ended.nonzero().squeeze(1)
+                lengths[live[ended_ids]] = t
+                final_scores[live[ended_ids]] = scores[ended_ids]
+                done = done | ended
+                if done.all():
+                    break
+
+            # sub-coder state of the next token: carried on inside a word (xo 0), restarted after a separator
+            after_sbol = (xo > 0).unsqueeze(1)
+            prev_init_vecs = [torch.where(after_sbol, sbol_h[xo], next_init_vecs[0][0]).unsqueeze(0),
+                              torch.where(after_sbol, sbol_c[xo], next_init_vecs[1][0]).unsqueeze(0)]
+            y_tm1 = wid
+            h_tm1 = (h_t, cell_t)
+            att_tm1 = att_t
+
+            if t % compact_every == 0 and done.any():
+                keep = (done == 0).nonzero().squeeze(1)
+                live = live[keep]
+                done = done[keep]
+                scores = scores[keep]
+                y_tm1 = y_tm1[keep]
+                prev_init_vecs = [v.index_select(1, keep) for v in prev_init_vecs]
+                h_tm1 = (h_tm1[0].index_select(1, keep), h_tm1[1].index_select(1, keep))
+                att_tm1 = att_tm1.index_select(0, keep)
+                src_encodings = src_encodings.index_select(0, keep)
+                src_encodings_att_linear = src_encodings_att_linear.index_select(0, keep)
+                enc_masks = enc_masks.index_select(0, keep)
 
         sents = []
         scores = []
-        #print(len(batch_done),batch_done[1])
-        for b in batch_done:
-
-            sent = b['sent']
-            xo = b['xo']
-
-            #if len(sent) < 1: continue
+        words = words.tolist()
+        xos = xos.tolist()
+        for b, n, score in zip(range(b_size), lengths.tolist(), final_scores.tolist()):
+            # the last step (</s>, or the token at the length limit) is left out
+            sent = [self.vocab.vocs.id2word[w] for w in words[b][:n-1]]
+            xo = xos[b][:n-1]
 
             X = []
-            #pre_v = ''
             if len(xo) < 1:
                 xo = [1]
                 sent = ['a']
-                b['score'] = -100.0
-                print("xo : {}, sent : {}, len(batch_done) : {}".format(xo, sent,len(batch_done)))
+                score = -100.0
             if xo[0] ==0:
-                print("Starting word sbol is empty space !!!!")
+                # the first token cannot follow a space
                 xo[0] = 1
             for i,v in enumerate(sent):
-                #if v in self.sbol:
-                #    continue
                 if xo[i] == 0:
                     X += [v]
-                elif v not in ['', ' ', '_', '^', '`']: #else:
+                elif v not in ['', ' ', '_', '^', '`']:
                     X += [self.sbol[xo[i]-1], v]
             sents.append(' '.join(X))
-            scores.append(b['score']/len(sent))
+            scores.append(score/len(sent))
 
         sents = [sents[i] for i in sent_order]
         scores = [scores[i] for i in sent_order]
-        #print(sents[0])
 
         return sents, scores
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+nmt_script.py: TorchScript inference graph of the NMT model
+Traces, per direction, the encoder over embedded source sentences and one decoder step (sub-coder,
+decoder LSTM with attention, vocabulary and xo heads) into a single TorchScript file, checks it against
+the eager model and saves it. The loaded module has the methods encode_<slang> and step_<tlang> and,
+per target language, the separator states <tlang>_sbol_h / <tlang>_sbol_c (see NMT.sbol_states) and
+the target-language output rows <tlang>_vocab_ids / <tlang>_out_weight (see NMT.output_block).
+
+Scope: this is a benchmarking artifact, not a standalone translator. The graph starts after the source
+embedding: NMT.parallel_encode_new (token strings to subword and character embeddings, capitalization)
+is Python over strings and is not traced, and the beam search stays in NMT.ek_beam_search_batch. The
+file loads with torch.jit.load alone, but translating still needs the eager model for both, so nothing
+in serving (get_model.trns_model) loads it. It measures the encoder and the decoder step against the
+eager model (bench.py script). A standalone translator would need a scripted search loop over
+pre-embedded inputs and a loader path in trns_model; neither is done here.
+
+Usage:
+    nmt_script.py [options] OUT_FILE
+
+Options:
+    -h --help                               show this screen.
+    --model=<file>                          model path [default: trns/model_bi_1105]
+    --batch-size=<int>                      batch size of the example inputs [default: 8]
+    --src-len=<int>                         source length of the example inputs [default: 20]
+    --tolerance=<float>                     largest difference allowed to the eager model [default: 1e-4]
+"""
+import sys
+
+from docopt import docopt
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
+
+DIRECTIONS = [('en', 'ko'), ('ko', 'en')]   # (slang, tlang)
+
+
+class Encoder(nn.Module):
+    """ NMT.en_encode / NMT.ko_encode and the attention projection of the target language.
+    """
+    def __init__(self, model, slang, tlang):
+        super(Encoder, self).__init__()
+        p = slang + '_'
+        self.encoder = getattr(model, p + 'encoder')
+        self.h1_projection = getattr(model, p + 'h1_projection')
+        self.h2_projection = getattr(model, p + 'h2_projection')
+        self.c1_projection = getattr(model, p + 'c1_projection')
+        self.c2_projection = getattr(model, p + 'c2_projection')
+        self.att_projection = getattr(model, tlang + '_att_projection')
+
+    def forward(self, source_padded, source_lengths):
+        """
+        @param source_padded (Tensor): embedded source sentences (NMT.parallel_encode_new), shape (src_len, b, e),
+                longest first
+        @param source_lengths (Tensor): their lengths, shape (b,)
+        @returns enc_hiddens (Tensor): shape (b, src_len, 2h)
+        @returns enc_hiddens_proj (Tensor): shape (b, src_len, h)
+        @returns h, c (Tensor): initial decoder state, shape (2, b, h)
+        """
+        out, (last_h, last_c) = self.encoder(pack_padded_sequence(source_padded, source_lengths))
+        enc_hiddens = pad_packed_sequence(out, batch_first=True)[0]
+        h = torch.cat((self.h1_projection(torch.cat((last_h[0], last_h[1]), -1)).unsqueeze(0),
+                       self.h2_projection(torch.cat((last_h[2], last_h[3]), -1)).unsqueeze(0)), 0)
+        c = torch.cat((self.c1_projection(torch.cat((last_c[0], last_c[1]), -1)).unsqueeze(0),
+                       self.c2_projection(torch.cat((last_c[2], last_c[3]), -1)).unsqueeze(0)), 0)
+        return enc_hiddens, self.att_projection(enc_hiddens), h, c
+
+
+class DecoderStep(nn.Module):
+    """ One decoding step into tlang: NMT.parallel_beam_encode2, NMT.step and the two output heads.
+    The rows of the vocabulary projection are an input, so the caller picks the full matrix, the
+    target-language block or a shortlist.
+    """
+    def __init__(self, model, tlang):
+        super(DecoderStep, self).__init__()
+        p = tlang + '_'
+        self.embeddings = model.model_embeddings.vocabs
+        self.sub_coder = getattr(model, 'sub_' + p + 'coder')
+        self.sub_projection = getattr(model, 'sub_' + p + 'projection')
+        self.gate = getattr(model, p + 'gate')
+        self.decoder = getattr(model, p + 'decoder')
+        self.combined_output_projection = getattr(model, p + 'combined_output_projection')
+        self.ox_projection = model.target_ox_projection
+
+    def forward(self, y_tm1, init_h, init_c, att_tm1, h_tm1, c_tm1, enc_hiddens, enc_hiddens_proj, enc_masks, out_weight):
+        """
+        @param y_tm1 (Tensor): previous tokens, shape (b,)
+        @param init_h, init_c (Tensor): sub-coder state, shape (1, b, h)
+        @param att_tm1 (Tensor): previous combined output, shape (b, h)
+        @param h_tm1, c_tm1 (Tensor): decoder state, shape (2, b, h)
+        @param enc_masks (Tensor): 1 on padding, shape (b, src_len)
+        @param out_weight (Tensor): rows of target_vocab_projection to score, shape (n, h)
+        @returns log_p_t (Tensor): log probabilities over the rows of out_weight, shape (b, n)
+        @returns log_p_xo (Tensor): log probabilities of the xo classes, shape (b, 4)
+        @returns next_h, next_c (Tensor): sub-coder state after y_tm1, shape (1, b, h)
+        @returns h_t, c_t (Tensor): decoder state, shape (2, b, h)
+        @returns att_t (Tensor): combined output, shape (b, h)
+        @returns alpha_t (Tensor): attention, shape (b, 1, src_len)
+        """
+        X_embed = self.embeddings(y_tm1).unsqueeze(0)
+        out, (next_h, next_c) = self.sub_coder(X_embed, (init_h, init_c))
+        X_gate = torch.sigmoid(self.gate(X_embed))
+        y_t_embed = (X_gate * X_embed + (1 - X_gate) * self.sub_projection(out)).squeeze(0)
+
+        x = torch.cat([y_t_embed, att_tm1], dim=-1)
+        _, (h_t, c_t) = self.decoder(x.unsqueeze(0), (h_tm1, c_tm1))
+        e_t = torch.bmm(enc_hiddens_proj, h_t[1].unsqueeze(-1)).squeeze(-1)
+        e_t = e_t.masked_fill(enc_masks == 1, -float('inf'))
+        alpha_t = torch.softmax(e_t, -1).unsqueeze(-2)
+        a_t = torch.bmm(alpha_t, enc_hiddens).squeeze(-2)
+        att_t = torch.tanh(self.combined_output_projection(torch.cat((a_t, h_t[1]), -1)))
+
+        log_p_t = F.log_softmax(F.linear(att_t, out_weight), dim=-1)
+        log_p_xo = F.log_softmax(self.ox_projection(att_t), dim=-1)
+        return log_p_t, log_p_xo, next_h, next_c, h_t, c_t, att_t, alpha_t
+
+
+class InferenceGraph(nn.Module):
+    """ The encoders and decoder steps of both directions, with the output rows and separator states
+    they need, as one module to trace.
+    """
+    def __init__(self, model):
+        super(InferenceGraph, self).__init__()
+        for slang, tlang in DIRECTIONS:
+            self.add_module(slang + '_encoder', Encoder(model, slang, tlang))
+            self.add_module(tlang + '_step', DecoderStep(model, tlang))
+            _, sbol_h, sbol_c = model.sbol_states(tlang)
+            vocab_ids, out_weight, _ = model.output_block(tlang)
+            self.register_buffer(tlang + '_sbol_h', sbol_h)
+            self.register_buffer(tlang + '_sbol_c', sbol_c)
+            self.register_buffer(tlang + '_vocab_ids', vocab_ids)
+            self.register_buffer(tlang + '_out_weight', out_weight)
+
+    def encode_en(self, source_padded, source_lengths):
+        return self.en_encoder(source_padded, source_lengths)
+
+    def encode_ko(self, source_padded, source_lengths):
+        return self.ko_encoder(source_padded, source_lengths)
+
+    def step_ko(self, y_tm1, init_h, init_c, att_tm1, h_tm1, c_tm1, enc_hiddens, enc_hiddens_proj, enc_masks, out_weight):
+        return self.ko_step(y_tm1, init_h, init_c, att_tm1, h_tm1, c_tm1, enc_hiddens, enc_hiddens_proj, enc_masks, out_weight)
+
+    def step_en(self, y_tm1, init_h, init_c, att_tm1, h_tm1, c_tm1, enc_hiddens, enc_hiddens_proj, enc_masks, out_weight):
+        return self.en_step(y_tm1, init_h, init_c, att_tm1, h_tm1, c_tm1, enc_hiddens, enc_hiddens_proj, enc_masks, out_weight)
+
+
+def example_inputs(model, tlang, batch_size, src_len):
+    """ Random encoder and step inputs of the given shape, for tracing, checks and benchmarks.
+    @returns encoder_inputs (Tuple): source_padded, source_lengths
+    @returns step_inputs (Tuple): the inputs of DecoderStep.forward, with the target-language output rows
+    """
+    h = model.hidden_size
+    lengths = sorted([src_len] + torch.randint(1, src_len + 1, (batch_size - 1,)).tolist(), reverse=True)
+    source_padded = torch.randn(src_len, batch_size, model.model_embeddings.embed_size, device=model.device)
+    enc_masks = torch.zeros(batch_size, src_len, device=model.device)
+    for i, l in enumerate(lengths):
+        enc_masks[i, l:] = 1
+    step_inputs = (torch.randint(0, len(model.vocab.vocs), (batch_size,), dtype=torch.long, device=model.device),
+                   torch.randn(1, batch_size, h, device=model.device), torch.randn(1, batch_size, h, device=model.device),
+                   torch.randn(batch_size, h, device=model.device),
+                   torch.randn(2, batch_size, h, device=model.device), torch.randn(2, batch_size, h, device=model.device),
+                   torch.randn(batch_size, src_len, 2 * h, device=model.device), torch.randn(batch_size, src_len, h, device=model.device),
+                   enc_masks, model.output_block(tlang)[1])
+    return (source_padded, torch.tensor(lengths, dtype=torch.long)), step_inputs
+
+
+def eager_step(model, tlang, step_inputs):
+    """ The decoding step of the eager model, for the same inputs and outputs as DecoderStep.
+    """
+    y_tm1, init_h, init_c, att_tm1, h_tm1, c_tm1, enc_hiddens, enc_hiddens_proj, enc_masks, out_weight = step_inputs
+    y_t_embed, (next_h, next_c) = model.parallel_beam_encode2(y_tm1, tlang, init_vecs=(init_h, init_c))
+    x = torch.cat([y_t_embed, att_tm1], dim=-1)
+    (h_t, c_t), att_t, _, alpha_t = model.step(x, (h_tm1, c_tm1), enc_hiddens, enc_hiddens_proj, enc_masks, tlang)
+    log_p_t = F.log_softmax(F.linear(att_t, out_weight), dim=-1)
+    log_p_xo = F.log_softmax(model.target_ox_projection(att_t), dim=-1)
+    return log_p_t, log_p_xo, next_h, next_c, h_t, c_t, att_t, alpha_t
+
+
+def eager_encode(model, slang, tlang, encoder_inputs):
+    source_padded, source_lengths = encoder_inputs
+    encode = model.en_encode if slang == 'en' else model.ko_encode
+    enc_hiddens, (h, c) = encode(source_padded, source_lengths.tolist())
+    att_projection = model.ko_att_projection if tlang == 'ko' else model.en_att_projection
+    return enc_hiddens, att_projection(enc_hiddens), h, c
+
+
+def max_diff(outs, refs):
+    # -inf log probabilities (masked attention) compare equal
+    return max([(o - r).masked_fill(o == r, 0).abs().max().item() for o, r in zip(outs, refs)])
+
+
+def build(model, batch_size=8, src_len=20, tolerance=1e-4):
+    """ Trace the encoders and decoder steps of a model in eval mode and check them against it on new
+    random inputs of another batch size and source length.
+    @returns scripted (torch.jit.ScriptModule): the traced InferenceGraph, see the module docstring
+    @returns diff (float): largest difference to the eager model
+    """
+    if not hasattr(torch.jit, 'trace_module'):
+        raise RuntimeError('this torch has no torch.jit.trace_module')
+    diff = 0.
+    with torch.no_grad():
+        graph = InferenceGraph(model)
+        inputs = {}
+        for slang, tlang in DIRECTIONS:
+            encoder_inputs, step_inputs = example_inputs(model, tlang, batch_size, src_len)
+            inputs['encode_' + slang] = encoder_inputs
+            inputs['step_' + tlang] = step_inputs
+        scripted = torch.jit.trace_module(graph, inputs)
+
+        for slang, tlang in DIRECTIONS:
+            encoder_inputs, step_inputs = example_inputs(model, tlang, batch_size + 3, src_len + 5)
+            encode, step = getattr(scripted, 'encode_' + slang), getattr(scripted, 'step_' + tlang)
+            diff = max(diff, max_diff(encode(*encoder_inputs), eager_encode(model, slang, tlang, encoder_inputs)),
+                       max_diff(step(*step_inputs), eager_step(model, tlang, step_inputs)))
+    if diff > tolerance:
+        raise ValueError('traced model differs from the eager model by {}'.format(diff))
+    return scripted, diff
+
+
+def main():
+    from trns.get_model import nmt_model
+
+    args = docopt(__doc__)
+    model = nmt_model(args['--model'])
+    scripted, diff = build(model, int(args['--batch-size']), int(args['--src-len']), float(args['--tolerance']))
+    torch.jit.save(scripted, args['OUT_FILE'])
+    print('saved to {}, largest difference to the eager model {:.2e}'.format(args['OUT_FILE'], diff), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+preproc_kor.py: Korean preprocessing (subword segmentation) of the ko -> en direction
+Run as a script, it segments the most frequent eojeol of a frequency list and saves them as a warm-start
+file of the eojeol cache (see EojeolCache and preproc_ko2en).
+
+Usage:
+    preproc_kor.py [options] FREQ_FILE WARM_FILE
+
+Options:
+    -h --help                               show this screen.
+    --top=<int>                             number of eojeol kept [default: 50000]
+"""
+from collections import OrderedDict
 import copy
+import json
+import threading
 #from trns.NMT.xutils_for_sents_preproc import log_prob_by_len3,to_bpe_sents10, save_sents
 from trns.NMT.xutils_for_key_vars import make_key_vars
 #from trns.NMT.utils_etc import filter_chin_num, json_read, json_save
@@ -30,9 +48,51 @@ def get_data():
            
     return vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs, en_vocs
 
+class EojeolCache(object):
+    """ Bounded LRU map from an eojeol (whitespace separated word) to its tokens, shared by all calls of a
+    Preproc in a process (the batch backend segments in several threads). Lookups are counted.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, word):
+        with self.lock:
+            tokens = self.entries.get(word)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(word)
+            self.hits += 1
+            return tokens
+
+    def __setitem__(self, word, tokens):
+        with self.lock:
+            self.entries[word] = tokens
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def load(self, file_path):
+        for word, tokens in json.load(open(file_path, 'r')).items():
+            self[word] = tokens
+
+    def save(self, file_path):
+        with self.lock:
+            entries = dict(self.entries)
+        json.dump(entries, open(file_path, 'w'), ensure_ascii=False)
+
 class Preproc(object):
     
-    def __init__(self, vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs, en_vocs):
+    def __init__(self, vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs, en_vocs, cache=None):
         self.vocabs = vocabs
         self.vocs_dict = vocs_dict
         self.logprob = logprob
@@ -40,17 +100,47 @@ class Preproc(object):
         self.sum_voc_vals = sum_voc_vals
         self.extracted_vocs = extracted_vocs
         self.en_vocs = en_vocs
+        self.cache = cache
     
     def forward(self, X):          
         X = [''.join([c for c in s if ord(c) < 55204]) for s in X]
         X = to_bpe_sents10(X, self.vocabs, self.vocs_dict, self.logprob, self.key_vars, 
-                           self.sum_voc_vals,self.extracted_vocs,(1.3,3.2,20,1),(6,5)) #default (1,3,12)
+                           self.sum_voc_vals,self.extracted_vocs,(1.3,3.2,20,1),(6,5), cache=self.cache) #default (1,3,12)
         X = save_sents(X, self.en_vocs)
         return X  
     
-def preproc_ko2en():
-
+def preproc_ko2en(cache_size=100000, warm_file=None):
+    """
+    @param cache_size (int): eojeol kept in the cache, 0 for no cache
+    @param warm_file (str): eojeol cache entries written by this script
+    """
     vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs, en_vocs = get_data()
-    pre_fn = Preproc(vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs, en_vocs)
+    cache = EojeolCache(cache_size) if cache_size > 0 else None
+    if cache is not None and warm_file:
+        cache.load(warm_file)
+    pre_fn = Preproc(vocabs,vocs_dict, logprob, key_vars, sum_voc_vals,extracted_vocs, en_vocs, cache)
 
     return pre_fn
+
+def main():
+    from docopt import docopt
+
+    args = docopt(__doc__)
+    top = int(args['--top'])
+    # one eojeol, or 'eojeol count', per line
+    freq = []
+    for line in open(args['FREQ_FILE'], 'r'):
+        parts = line.split()
+        if len(parts) > 0:
+            freq.append((parts[0], int(parts[1]) if len(parts) > 1 else 0))
+    words = [w for w, _ in sorted(freq, key=lambda x: x[1], reverse=True)[:top]]
+
+    # words with punctuation are split further, every part gets its own entry
+    pre_fn = preproc_ko2en(cache_size=2 * top)
+    for i in range(0, len(words), 1000):
+        pre_fn.forward(words[i:i+1000])
+    pre_fn.cache.save(args['WARM_FILE'])
+    print('{} eojeol saved to {}'.format(len(pre_fn.cache), args['WARM_FILE']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+shortlist.py: Lexical translation table for vocabulary shortlists
+Learns, from a parallel corpus of preprocessed (subword) sentences, which target tokens each source
+token translates to, and keeps the most frequent target tokens. At decoding time the output projection
+is restricted to the candidates of the source sentences (see Shortlist and NMT.ek_beam_search_batch).
+
+Usage:
+    shortlist.py [options] SRC_FILE TGT_FILE LEX_FILE
+
+Options:
+    -h --help                  show this screen.
+    --tlang=<str>              target language of the table, 'ko' or 'en' [default: ko]
+    --per-source=<int>         target tokens kept per source token [default: 20]
+    --min-count=<int>          minimum co-occurrences of a source and target token [default: 2]
+    --frequent=<int>           most frequent target tokens, always candidates [default: 2000]
+    --limit=<int>              number of sentence pairs to read, 0 for all [default: 0]
+"""
+from collections import Counter, defaultdict
+import json
+
+from docopt import docopt
+import torch
+
+from trns.utils import read_corpus
+
+# candidates of every sentence besides the table: sentence marks, separators and punctuation
+SPECIAL = ['<s>', '</s>', '<unk>', '_', '^', '`', '(', ')', ',', "'", '"', '.', '?', '!', ':', ';', '-', '%']
+
+
+def build_table(src_sents, tgt_sents, per_source=20, min_count=2, frequent=2000):
+    """ Count, for every source token, the target sentences it occurs with, and keep the target tokens
+    with the highest p(target | source). Tokens among the frequent ones are candidates anyway and are
+    left out of the per-token lists.
+    @param src_sents (List[List[str]]): source sentences
+    @param tgt_sents (List[List[str]]): target sentences, aligned with src_sents
+    @returns lex (Dict[str, List[str]]): target tokens per source token, best first
+    @returns frequent (List[str]): most frequent target tokens
+    """
+    src_count = Counter()
+    tgt_count = Counter()
+    cooc = defaultdict(Counter)
+    for src, tgt in zip(src_sents, tgt_sents):
+        src = set(src) - set(SPECIAL)
+        tgt = set(tgt) - set(SPECIAL)
+        src_count.update(src)
+        tgt_count.update(tgt)
+        for s in src:
+            cooc[s].update(tgt)
+
+    frequent = [w for w, _ in tgt_count.most_common(frequent)]
+    common = set(frequent)
+    lex = {}
+    for s, c in cooc.items():
+        tgts = sorted([t for t, n in c.items() if n >= min_count and t not in common],
+                      key=lambda t: c[t], reverse=True)[:per_source]
+        if len(tgts) > 0:
+            lex[s] = tgts
+    return lex, frequent
+
+
+class Shortlist(object):
+    """ Candidate target tokens of a source sentence: the special tokens, the most frequent target
+    tokens, the table entries of every source token and the source tokens themselves (numbers, names
+    and English words kept in Korean output are copied).
+    """
+    def __init__(self, vocab, lex, frequent, tlang):
+        """
+        @param vocab (Vocab): model vocabulary, tokens outside it are dropped
+        @param lex (Dict[str, List[str]]): target tokens per source token
+        @param frequent (List[str]): target tokens that are always candidates
+        @param tlang (str): target language
+        """
+        self.vocab = vocab
+        self.tlang = tlang
+        self.base = set([vocab.vocs[w] for w in SPECIAL + frequent if w in vocab.vocs])
+        self.lex = {s: [vocab.vocs[t] for t in tgts if t in vocab.vocs] for s, tgts in lex.items()}
+
+    @staticmethod
+    def load(file_path, vocab):
+        entry = json.load(open(file_path, 'r'))
+        return Shortlist(vocab, entry['lex'], entry['frequent'], entry['tlang'])
+
+    def candidates(self, src_sents, device):
+        """ Candidates of every sentence, and their union as the rows of the output projection to score.
+        A sentence is decoded over its own candidates only, whatever it is batched with.
+        @param src_sents (List[List[str]]): source sentences decoded together
+        @returns vocab_ids (torch.Tensor): sorted vocabulary ids of the candidates of all sentences, shape (n,)
+        @returns vocab_mask (torch.Tensor): 1 for the candidates of every sentence, shape (len(src_sents), n)
+        """
+        sent_ids = []
+        for s in src_sents:
+            ids = set(self.base)
+            for w in set(s):
+                ids.update(self.lex.get(w, []))
+                if w in self.vocab.vocs:
+                    ids.add(self.vocab.vocs[w])
+            sent_ids.append(ids)
+        vocab_ids = sorted(set().union(*sent_ids))
+        pos = dict([(w, j) for j, w in enumerate(vocab_ids)])
+        mask = torch.zeros((len(src_sents), len(vocab_ids)), dtype=torch.long)
+        for i, ids in enumerate(sent_ids):
+            mask[i, [pos[w] for w in ids]] = 1
+        return torch.tensor(vocab_ids, dtype=torch.long, device=device), (mask > 0).to(device)
+
+
+def main():
+    args = docopt(__doc__)
+    src_sents = read_corpus(args['SRC_FILE'], source='src')
+    tgt_sents = read_corpus(args['TGT_FILE'], source='src')
+    assert len(src_sents) == len(tgt_sents), 'source and target files have different numbers of lines'
+    if int(args['--limit']) > 0:
+        src_sents = src_sents[:int(args['--limit'])]
+        tgt_sents = tgt_sents[:int(args['--limit'])]
+
+    lex, frequent = build_table(src_sents, tgt_sents, per_source=int(args['--per-source']),
+                                min_count=int(args['--min-count']), frequent=int(args['--frequent']))
+    json.dump({'tlang': args['--tlang'], 'lex': lex, 'frequent': frequent}, open(args['LEX_FILE'], 'w'),
+              ensure_ascii=False)
+    print('{} source tokens, {} frequent target tokens, saved to {}'.format(len(lex), len(frequent), args['LEX_FILE']))
+
+
+if __name__ == '__main__':
+    main()
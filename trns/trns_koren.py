@@ -1,7 +1,9 @@
 # trns_koren.py
 
+import json
 import os
 import re
+import time
 import torch
 import torch.nn.utils
 #from flaskr.vocab import Vocab, VocabEntry
@@ -9,54 +11,188 @@ import torch.nn.utils
 
 #from flaskr.nmt_model import Hypothesis, NMT
 
+# decoding settings selectable per request and per bulk job; decoder is 'beam', 'greedy' (batched,
+# beam_size is not used) or 'hybrid': greedy first, then beam search for the sentences whose greedy
+# output scores below min_score (per token) or whose length ratio to the expected length is outside
+# [min_len_ratio, max_len_ratio]. Calibrate min_score with `bench.py calibrate` and load_calibration.
+DECODING_PROFILES = {
+    'quality': {'decoder': 'beam', 'beam_size': 10, 'max_decoding_time_step': 200},
+    'balanced': {'decoder': 'beam', 'beam_size': 4, 'max_decoding_time_step': 200},
+    'fast': {'decoder': 'greedy', 'beam_size': 1, 'max_decoding_time_step': 200},
+    'hybrid': {'decoder': 'hybrid', 'beam_size': 10, 'max_decoding_time_step': 200,
+               'min_score': -0.5, 'min_len_ratio': 0.5, 'max_len_ratio': 2.0},
+}
+
+def planned_decoding(profile):
+    """ How Trns.translate labels the outputs of a profile that were not degraded, weakest decoder first.
+    """
+    decoder = DECODING_PROFILES[profile]['decoder']
+    return ('greedy', 'beam') if decoder == 'hybrid' else (decoder,)
+
+def load_calibration(file_path):
+    """ Set the fallback gate of the 'hybrid' profile from a file written by `bench.py calibrate`.
+    """
+    DECODING_PROFILES['hybrid'].update(json.load(open(file_path)))
+
 class Trns(object):
     
-    def __init__(self, model):
-        
+    def __init__(self, model, batch_size=32, shortlists=None):
+        """
+        @param model (NMT): NMT model
+        @param batch_size (int): sentences decoded together
+        @param shortlists (Dict[str, Shortlist]): vocabulary shortlist per target language; beam search
+                into those languages scores only the candidates of each source sentence
+        """
         self.model = model  #NMT.load('/home/john/flaskr/model.bin')
+        self.batch_size = batch_size
+        self.shortlists = shortlists or {}
         
                 
-    def translate(self, test_data_src, tlang):
+    def translate(self, test_data_src, tlang, profile='quality', return_info=False, deadline=None, stats=None):
         """ Performs decoding on a test set, and save the best-scoring decoding results.
         If the target gold-standard sentences are given, the function also computes
         corpus-level BLEU score.
-        @param args (Dict): args from cmd line
+        @param test_data_src (List[List[str]]): preprocessed source sentences
+        @param tlang (str): target language
+        @param profile (str): key of DECODING_PROFILES
+        @param return_info (bool): return (sentence, score, decoding) triples instead of sentences, where
+                decoding is the decoder used (see planned_decoding), or how the sentence was degraded to
+                meet the deadline: 'beam_reduced', 'beam_cut', 'truncated', 'greedy' for beam profiles, and
+                'low_confidence' for a hybrid greedy output that could not be decoded again in time
+        @param deadline (float): time.time() by which decoding must end, None for no limit
+        @param stats (Dict): if given, 'steps' (decoder time steps) and 'batches' are added to it
         """
+        if profile not in DECODING_PROFILES:
+            raise ValueError('unknown decoding profile: {}'.format(profile))
+        settings = DECODING_PROFILES[profile]
 
-        hypotheses = self.beam_search(self.model, test_data_src,
-                                 beam_size=int(10),
-                                 max_decoding_time_step=int(200),
-                                 tlang = tlang)
+        if settings['decoder'] == 'greedy':
+            hypotheses, decoding = self.greedy_search(self.model, test_data_src,
+                                     max_decoding_time_step=settings['max_decoding_time_step'],
+                                     tlang = tlang, stats = stats)
+        elif settings['decoder'] == 'hybrid':
+            hypotheses, decoding = self.hybrid_search(self.model, test_data_src, settings,
+                                     tlang = tlang, deadline = deadline, stats = stats)
+        else:
+            hypotheses, decoding = self.beam_search(self.model, test_data_src,
+                                     beam_size=settings['beam_size'],
+                                     max_decoding_time_step=settings['max_decoding_time_step'],
+                                     tlang = tlang, deadline = deadline, stats = stats)
 
         sents = []
 
-        for src_sent, hyps in zip(test_data_src, hypotheses):
-            top_hyp = hyps[0]
-            hyp_sent = ' '.join(top_hyp.value) 
-            sents.append(hyp_sent)
+        for src_sent, hyps, dec in zip(test_data_src, hypotheses, decoding):
+            if isinstance(hyps, tuple):     # from greedy search
+                hyp_sent, score = hyps
+            else:
+                hyp_sent, score = ' '.join(hyps[0].value), float(hyps[0].score)
+            sents.append((hyp_sent, score, dec) if return_info else hyp_sent)
 
         return sents
 
-    def beam_search(self, model, test_data_src, beam_size, max_decoding_time_step, tlang):
+    def beam_search(self, model, test_data_src, beam_size, max_decoding_time_step, tlang, deadline=None, stats=None):
         """ Run beam search to construct hypotheses for a list of src-language sentences.
+        With a deadline, the sentences left when the previous batches show that beam search would not
+        finish in time are decoded with greedy search instead.
         @param model (NMT): NMT Model
         @param test_data_src (List[List[str]]): List of sentences (words) in source language, from test set.
         @param beam_size (int): beam_size (# of hypotheses to hold for a translation at every step)
         @param max_decoding_time_step (int): maximum sentence length that Beam search can produce
-        @returns hypotheses (List[List[Hypothesis]]): List of Hypothesis translations for every source sentence.
+        @param deadline (float): time.time() by which decoding must end, None for no limit
+        @param stats (Dict): if given, 'steps' and 'batches' are added to it
+        @returns hypotheses (List[List[Hypothesis]]): List of Hypothesis translations for every source sentence,
+                a (sentence, score) pair for the ones decoded greedily.
+        @returns decoding (List[str]): how every sentence was decoded
         """
         #was_training = model.training
         model.eval()
 
-        hypotheses = []
+        # sentences of similar length are decoded together to keep padding low
+        sent_order = sorted(range(len(test_data_src)), key=lambda i: len(test_data_src[i]), reverse=True)
+        hypotheses = [None] * len(test_data_src)
+        decoding = [None] * len(test_data_src)
+        start = time.time()
         with torch.no_grad():
-            for src_sent in test_data_src:
+            for i in range(0, len(sent_order), self.batch_size):
+                ids = sent_order[i:i+self.batch_size]
 
-                example_hyps = model.ek_beam_search(src_sent, beam_size=beam_size, max_decoding_time_step=max_decoding_time_step, tlang=tlang)
+                # batches get shorter, so the time per sentence so far bounds the time of the next batch
+                if deadline is not None and i > 0 and time.time() + (time.time() - start) / i * len(ids) > deadline:
+                    ids = sent_order[i:]
+                    slang = 'en' if tlang == 'ko' else 'ko'
+                    sents, scores = model.greedy_search([test_data_src[k] for k in ids], max_decoding_time_step=max_decoding_time_step, slang=slang, tlang=tlang)
+                    for k, sent, score in zip(ids, sents, scores):
+                        hypotheses[k] = (sent, score)
+                        decoding[k] = 'greedy'
+                    break
 
-                hypotheses.append(example_hyps)
+                info = {}
+                src_sents = [test_data_src[k] for k in ids]
+                vocab_ids, vocab_mask = self.shortlists[tlang].candidates(src_sents, model.device) if tlang in self.shortlists else (None, None)
+                batch_hyps = model.ek_beam_search_batch(src_sents, beam_size=beam_size, max_decoding_time_step=max_decoding_time_step, tlang=tlang,
+                                                        deadline=deadline, info=info, vocab_ids=vocab_ids, vocab_mask=vocab_mask)
+
+                for k, example_hyps, dec in zip(ids, batch_hyps, info['decoding']):
+                    hypotheses[k] = example_hyps
+                    decoding[k] = dec
+                if stats is not None:
+                    stats['steps'] = stats.get('steps', 0) + info['steps']
+                    stats['batches'] = stats.get('batches', 0) + 1
 
         #if was_training: model.train(was_training)
 
-        return hypotheses
+        return hypotheses, decoding
+
+    def greedy_search(self, model, test_data_src, max_decoding_time_step, tlang, stats=None):
+        """ Run greedy search over a list of src-language sentences, in batches of sentences of similar length.
+        @returns hypotheses (List[Tuple[str, float]]): (sentence, score) of every source sentence
+        @returns decoding (List[str]): 'greedy' for every sentence
+        """
+        model.eval()
+        slang = 'en' if tlang == 'ko' else 'ko'
+        sent_order = sorted(range(len(test_data_src)), key=lambda i: len(test_data_src[i]), reverse=True)
+        hypotheses = [None] * len(test_data_src)
+        with torch.no_grad():
+            for i in range(0, len(sent_order), self.batch_size):
+                ids = sent_order[i:i+self.batch_size]
+                sents, scores = model.greedy_search([test_data_src[k] for k in ids], max_decoding_time_step=max_decoding_time_step, slang=slang, tlang=tlang)
+                for k, sent, score in zip(ids, sents, scores):
+                    hypotheses[k] = (sent, score)
+                if stats is not None:
+                    stats['batches'] = stats.get('batches', 0) + 1
+        return hypotheses, ['greedy'] * len(test_data_src)
+
+    def hybrid_search(self, model, test_data_src, settings, tlang, deadline=None, stats=None):
+        """ Greedy search for every sentence, then beam search for those whose greedy output is not
+        confident (see DECODING_PROFILES).
+        @param settings (Dict): the 'hybrid' profile
+        @returns hypotheses (List): (sentence, score) of the greedy outputs kept, hypotheses of the others
+        @returns decoding (List[str]): 'greedy', 'beam', or how the sentence was degraded
+        """
+        hypotheses, decoding = self.greedy_search(model, test_data_src, settings['max_decoding_time_step'], tlang, stats)
+        redo = [i for i, (sent, score) in enumerate(hypotheses)
+                if not self.confident(test_data_src[i], sent, score, tlang, settings)]
+        if len(redo) > 0:
+            beam_hyps, beam_decoding = self.beam_search(model, [test_data_src[i] for i in redo], settings['beam_size'],
+                                                        settings['max_decoding_time_step'], tlang, deadline, stats)
+            for i, hyps, dec in zip(redo, beam_hyps, beam_decoding):
+                if dec == 'greedy':
+                    # beam search ran out of time, the greedy output stays
+                    decoding[i] = 'low_confidence'
+                else:
+                    hypotheses[i] = hyps
+                    decoding[i] = dec
+        return hypotheses, decoding
+
+    def confident(self, src_sent, sent, score, tlang, settings):
+        """ Whether a greedy output is kept by the 'hybrid' profile.
+        @param src_sent (List[str]): source sentence
+        @param sent (str): greedy output, tokens and separators joined by spaces
+        @param score (float): its log probability per token
+        """
+        sbol = self.model.sbol
+        slang = 'en' if tlang == 'ko' else 'ko'
+        expected = len([w for w in src_sent if w not in sbol]) * self.model.len_ratio[slang]
+        ratio = len([w for w in sent.split(' ') if w not in sbol]) / max(expected, 1.)
+        return score >= settings['min_score'] and settings['min_len_ratio'] <= ratio <= settings['max_len_ratio']
     
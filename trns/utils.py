@@ -18,6 +18,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from itertools import chain
+from collections import Counter
 
 
 def pad_sents(sents, pad_token):
@@ -58,6 +59,29 @@ def read_corpus(file_path, source):
 
     return data
 
+def corpus_bleu(references, hypotheses, max_n=4):
+    """ Corpus-level BLEU (uniform weights, brevity penalty) of tokenized sentences, on a 0-100 scale.
+    @param references (List[List[str]]): one reference per sentence
+    @param hypotheses (List[List[str]]): translations, aligned with references
+    @returns bleu (float)
+    """
+    matches = [0] * max_n
+    totals = [0] * max_n
+    ref_len = hyp_len = 0
+    for ref, hyp in zip(references, hypotheses):
+        ref_len += len(ref)
+        hyp_len += len(hyp)
+        for n in range(1, max_n + 1):
+            ref_ngrams = Counter([tuple(ref[i:i+n]) for i in range(len(ref) - n + 1)])
+            hyp_ngrams = Counter([tuple(hyp[i:i+n]) for i in range(len(hyp) - n + 1)])
+            matches[n-1] += sum([min(c, ref_ngrams[g]) for g, c in hyp_ngrams.items()])
+            totals[n-1] += max(len(hyp) - n + 1, 0)
+    if hyp_len == 0 or min(matches) == 0:
+        return 0.
+    log_precision = sum([math.log(m / t) for m, t in zip(matches, totals)]) / max_n
+    brevity = min(1 - ref_len / hyp_len, 0)
+    return 100 * math.exp(log_precision + brevity)
+
 def get_sents_lenth4(source, sbol):
 
     if type(source[0]) is not list: